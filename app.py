@@ -1,59 +1,1017 @@
+# Marca de inicio para medir cuánto tarda en importarse este módulo (ver ARRANQUE RÁPIDO)
+import time
+MODULE_IMPORT_STARTED_AT = time.perf_counter()
+
 import os
 import json
 import base64
-from flask import Flask, request, jsonify, make_response
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import tempfile
+import atexit
+import bisect
+import hashlib
+import hmac
+import logging
+import queue
+import random
+import re
+import socket
+import string
+import sys
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from logging.handlers import QueueHandler, QueueListener
+from flask import Flask, request, jsonify, make_response, Response
+# El resto de la pila de Google (google-auth, httplib2, googleapiclient.discovery) se importa en el primer uso
 from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 
 # --- Importaciones de SQLAlchemy para la Base de Datos ---
-from sqlalchemy import create_engine, Column, String, Integer
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, delete, distinct, event, func, insert, inspect, literal, or_, select, text, tuple_, update, Column, Index, String, Integer, Text, DateTime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as SqlAlchemySession, declarative_base, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 
 # Cargar variables de entorno al inicio (esencial para desarrollo local y Render)
 load_dotenv()
 
 app = Flask(__name__)
 
+# --- JSON RÁPIDO (orjson opcional) ---
+# Los payloads de Guesty pesan decenas de KB: si orjson está instalado se usa para parsear los
+# webhooks, (de)serializar el outbox y escribir los logs; si no, la librería estándar.
+# Las huellas de fila (row_data_json) siguen en json estándar para que los hashes guardados no cambien.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data) # Acepta bytes o str y lanza JSONDecodeError (subclase de ValueError)
+    return json.loads(data)
+
+# Devuelve str. orjson no serializa lo que no conoce sin 'default' ni enteros de más de 64 bits:
+# en ese caso se cae a la librería estándar en lugar de fallar.
+def json_dumps(value, default=None):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, default=default)
+
+# --- LOGGING ESTRUCTURADO (JSON lines, asíncrono, con muestreo y redacción) ---
+# Los registros se encolan en el hilo que los emite y un QueueListener en segundo plano los
+# serializa a JSON y los escribe en stdout, así la solicitud nunca se bloquea en stdout.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Proporción de registros que se conservan por nivel, p. ej. "DEBUG=0.01,INFO=1" (por defecto, todos)
+LOG_SAMPLE_RATES = {
+    level.strip().upper(): float(rate)
+    for level, rate in (item.split("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if "=" in item)
+}
+# Campos cuyo valor nunca se escribe en los logs (datos personales del huésped)
+LOG_REDACTED_FIELDS = {
+    field.strip() for field in os.getenv("LOG_REDACTED_FIELDS", "guest_email,guest_phone,emails,phones,email,phone").split(",") if field.strip()
+}
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: "[REDACTED]" if k in LOG_REDACTED_FIELDS else redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(redact(getattr(record, "fields", None) or {}))
+        return json_dumps(entry, default=str)
+
+class LevelSamplingFilter(logging.Filter):
+    def filter(self, record):
+        rate = LOG_SAMPLE_RATES.get(record.levelname, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+# Campos estructurados para un registro: logger.info("...", extra=log_fields(reservation_id=...)). El mensaje
+# es siempre constante y los valores van en los campos: no se formatea nada en la llamada (tampoco si el
+# muestreo descarta el registro) y cada valor llega al JSON como campo propio.
+def log_fields(**fields):
+    return {"fields": fields}
+
+def setup_logging():
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(LevelSamplingFilter()) # Se muestrea antes de encolar: lo descartado no cuesta nada más
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop) # Vacía la cola al salir
+
+    app_logger = logging.getLogger("guesty_sheets")
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.addHandler(queue_handler)
+    app_logger.propagate = False
+    return app_logger
+
+logger = setup_logging()
+
 # --- CONFIGURACIÓN GLOBAL DE GOOGLE SHEETS ---
 # Estas variables se leerán de las variables de entorno de Render
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "1UqW44Uu1r44mDX6_UBn0MSox9cIiW4E6Zmm7xQ9AWm8")
 RANGE_NAME = os.getenv("RANGE_NAME", 'test')
 
-# --- CAMBIO CLAVE 1: Añadir "conversationId" a la lista de cabeceras en la posición deseada (Columna H) ---
-# Define el orden de las columnas en tu Google Sheet
-# ¡Asegúrate de que tu hoja de cálculo tenga estas columnas y en este orden exacto!
-field_names = [
-    "event", "eventId", "messageId", "reservation_id", "accountId", "guestId", "listingId",
-    "conversationId", # <-- AÑADIDO AQUÍ (Esto lo hará la columna H en la hoja)
-    "checkIn", "checkOut", "numberOfGuests", "platform", "reservationStatus", "guestFirstName",
-    "guestLastName", "totalAmount", "cleaningFee", "serviceFee", "securityDeposit",
-    "listing_name", "listing_city", "guest_email", "guest_phone", "nights"
+# --- ENRUTADO A VARIAS HOJAS / PESTAÑAS ---
+# Por defecto todo va a SPREADSHEET_ID / RANGE_NAME. SHEETS_ROUTES_FILE es un JSON con una lista de
+# reglas; la primera que coincide decide en qué hoja y pestaña se AÑADEN las reservas nuevas:
+#   [{"match": {"accountId": "5f1..."}, "spreadsheet_id": "1Abc...", "tab": "reservas_{year}"},
+#    {"match": {"listingId": ["L1", "L2"]}, "tab": "premium"},
+#    {"tab": "{year}-{month}"}]
+# 'match' compara accountId, listingId, year y month (los dos últimos del checkIn) con un valor o una
+# lista; 'spreadsheet_id' y 'tab' (por defecto los globales) admiten esos campos entre llaves, y la
+# regla no coincide si al evento le falta alguno de los que usa. Una reserva ya escrita se actualiza
+# siempre donde está (columna 'target' de reservation_index), aunque ahora le tocara otra regla.
+SHEETS_ROUTES_FILE = os.getenv("SHEETS_ROUTES_FILE")
+# Al llegar a SHEETS_TAB_MAX_ROWS filas, las reservas nuevas pasan a '<pestaña>_2', '<pestaña>_3'... (0 = sin límite)
+SHEETS_TAB_MAX_ROWS = int(os.getenv("SHEETS_TAB_MAX_ROWS", 200000))
+
+# Destino de escritura: hoja y pestaña. En la DB se guarda como 'spreadsheet_id/pestaña' (target_key)
+SheetTarget = namedtuple("SheetTarget", ["spreadsheet_id", "tab"])
+SheetRoute = namedtuple("SheetRoute", ["match", "spreadsheet_id", "tab", "fields"])
+ROUTE_FIELDS = ("accountId", "listingId", "year", "month")
+
+def target_key(target):
+    return f"{target.spreadsheet_id}/{target.tab}"
+
+def parse_target_key(key):
+    spreadsheet_id, _, tab = key.partition("/")
+    return SheetTarget(spreadsheet_id, tab)
+
+# Rango A1 de una pestaña; el nombre va entre comillas si no es un identificador simple ('2025-03'!A1)
+def a1_range(tab, cells=None):
+    name = tab if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", tab) else "'" + tab.replace("'", "''") + "'"
+    return f"{name}!{cells}" if cells else name
+
+def load_sheet_routes(path):
+    with open(path) as routes_file:
+        spec = json.load(routes_file)
+    routes = []
+    for rule in spec:
+        match = {
+            field: [str(value) for value in (expected if isinstance(expected, list) else [expected])]
+            for field, expected in (rule.get("match") or {}).items()
+        }
+        spreadsheet_id, tab = rule.get("spreadsheet_id", SPREADSHEET_ID), rule.get("tab", RANGE_NAME)
+        fields = {name for template in (spreadsheet_id, tab) for _, name, _, _ in string.Formatter().parse(template) if name}
+        unknown = (set(match) | fields) - set(ROUTE_FIELDS)
+        if unknown:
+            raise ValueError(f"Campos desconocidos {sorted(unknown)} en la regla de enrutado {rule}. Disponibles: {list(ROUTE_FIELDS)}")
+        routes.append(SheetRoute(match, spreadsheet_id, tab, tuple(sorted(fields))))
+    return routes
+
+SHEET_ROUTES = load_sheet_routes(SHEETS_ROUTES_FILE) if SHEETS_ROUTES_FILE else []
+DEFAULT_SHEET_TARGET = SheetTarget(SPREADSHEET_ID, RANGE_NAME)
+
+def route_values(data):
+    reservation_data = data.get("reservation") or {}
+    check_in = str(reservation_data.get("checkIn") or "")
+    return {
+        "accountId": str(reservation_data.get("accountId") or ""),
+        "listingId": str(reservation_data.get("listingId") or ""),
+        "year": check_in[:4],
+        "month": check_in[5:7],
+    }
+
+# Hoja y pestaña base (sin rollover) en la que se añadiría la reserva del webhook si fuera nueva
+def route_event(data):
+    if not SHEET_ROUTES:
+        return DEFAULT_SHEET_TARGET
+    values = route_values(data)
+    for route in SHEET_ROUTES:
+        if any(values[field] not in expected for field, expected in route.match.items()):
+            continue
+        if any(not values[field] for field in route.fields):
+            continue
+        return SheetTarget(route.spreadsheet_id.format(**values), route.tab.format(**values))
+    return DEFAULT_SHEET_TARGET
+
+# Pestaña número 'sequence' de un destino: la base y después '<pestaña>_2', '<pestaña>_3'...
+def rollover_target(route, sequence):
+    return route if sequence <= 1 else SheetTarget(route.spreadsheet_id, f"{route.tab}_{sequence}")
+
+# --- MAPEO DECLARATIVO: COLUMNA DE LA HOJA -> CAMPO DEL WEBHOOK DE GUESTY ---
+# Cada columna se define UNA sola vez y el orden de la lista es el orden de las columnas de la hoja.
+# Una ruta son claves separadas por puntos desde la raíz del webhook; un número indexa una lista
+# ('guest.emails.0'), 'clave[campo=valor]' elige el primer elemento de una lista con ese campo
+# (útil para customFields) y '|transformación' al final aplica una de ROW_TRANSFORMS. Con varias
+# rutas se usa la primera que tenga valor (ni None ni ""); si ninguna lo tiene, el valor por defecto.
+# Una ruta única sin transformación se comporta como dict.get(clave, por_defecto).
+# Las columnas 'volatile' cambian en cada evento aunque la reserva no cambie: no cuentan para
+# la huella de la fila (ver row_fingerprint) y solo se escriben junto con algún cambio real.
+SheetField = namedtuple("SheetField", ["column", "paths", "default", "volatile"], defaults=(False,))
+
+SHEET_FIELDS = [
+    SheetField("event", ["event"], "", volatile=True),
+    SheetField("eventId", ["meta.eventId"], "", volatile=True),
+    SheetField("messageId", ["meta.messageId"], "", volatile=True),
+    SheetField("reservation_id", ["reservation._id"], ""),
+    SheetField("accountId", ["reservation.accountId"], ""),
+    SheetField("guestId", ["reservation.guestId"], ""),
+    SheetField("listingId", ["reservation.listingId"], ""),
+    SheetField("conversationId", ["reservation.conversationId"], ""), # Columna H
+    SheetField("checkIn", ["reservation.checkIn"], ""),
+    SheetField("checkOut", ["reservation.checkOut"], ""),
+    SheetField("numberOfGuests", ["reservation.guestsCount"], 0),
+    SheetField("platform", ["reservation.integration.platform"], ""),
+    SheetField("reservationStatus", ["reservation.status"], ""),
+    SheetField("guestFirstName", ["reservation.guest.firstName"], ""),
+    SheetField("guestLastName", ["reservation.guest.lastName", "reservation.guest.fullName|last_word"], ""),
+    SheetField("totalAmount", ["reservation.money.subTotalPrice"], 0),
+    SheetField("cleaningFee", ["reservation.money.fareCleaning"], 0),
+    SheetField("serviceFee", ["reservation.money.hostServiceFee"], 0),
+    SheetField("securityDeposit", [], 0), # Guesty no lo envía en el webhook
+    SheetField("listing_name", ["reservation.listing.nickname", "reservation.listing.name"], ""),
+    SheetField("listing_city", ["reservation.listing.address.city"], ""),
+    SheetField("guest_email", ["reservation.guest.emails.0"], ""),
+    SheetField("guest_phone", ["reservation.guest.phones.0"], ""),
+    SheetField("nights", ["reservation.nightsCount"], 0),
 ]
 
-# --- INICIALIZACIÓN GLOBAL DEL SERVICIO DE GOOGLE SHEETS ---
-# Esta instancia se inicializará una sola vez al arrancar la aplicación.
-# Esto es una buena práctica para evitar la recreación costosa en cada solicitud.
-sheets_service = None
+# Columnas adicionales sin tocar el código: fichero JSON con una lista de
+# {"column": "hostPayout", "paths": ["reservation.money.hostPayout|round2"], "default": 0}
+# que se añaden, en ese orden, a la derecha de las columnas anteriores.
+SHEETS_EXTRA_FIELDS_FILE = os.getenv("SHEETS_EXTRA_FIELDS_FILE")
+
+def load_extra_sheet_fields(path):
+    with open(path) as extra_fields_file:
+        spec = json.load(extra_fields_file)
+    return [
+        SheetField(
+            field["column"], field.get("paths") or ([field["path"]] if field.get("path") else []),
+            field.get("default", ""), bool(field.get("volatile", False))
+        )
+        for field in spec
+    ]
+
+if SHEETS_EXTRA_FIELDS_FILE:
+    SHEET_FIELDS = SHEET_FIELDS + load_extra_sheet_fields(SHEETS_EXTRA_FIELDS_FILE)
+
+def last_word(value):
+    words = str(value).split()
+    return words[-1] if words else ""
+
+def join_values(value):
+    return ", ".join(str(item) for item in value) if isinstance(value, list) else value
+
+ROW_TRANSFORMS = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "round2": lambda value: round(float(value), 2),
+    "upper": lambda value: str(value).upper(),
+    "lower": lambda value: str(value).lower(),
+    "first_word": lambda value: (str(value).split() or [""])[0],
+    "last_word": last_word,
+    "date": lambda value: str(value)[:10], # '2025-03-01T15:00:00.000Z' -> '2025-03-01'
+    "join": join_values,
+    "json": lambda value: json.dumps(value, ensure_ascii=False),
+}
+
+PATH_MATCH_STEP = re.compile(r"^(?P<key>[^\[\]]+)\[(?P<field>[^=\]]+)=(?P<value>[^\]]*)\]$")
+
+# Divide una ruta en pasos ('key'/'index'/'match', argumento) y su transformación. Los errores salen al arrancar.
+def parse_field_path(path):
+    path, _, transform_name = path.partition("|")
+    if transform_name and transform_name not in ROW_TRANSFORMS:
+        raise ValueError(f"Transformación desconocida '{transform_name}' en la ruta '{path}'. Disponibles: {sorted(ROW_TRANSFORMS)}")
+    steps = []
+    for part in path.split("."):
+        match = PATH_MATCH_STEP.match(part)
+        if match:
+            steps.append(("key", match.group("key")))
+            steps.append(("match", (match.group("field"), match.group("value"))))
+        elif part.isdigit():
+            steps.append(("index", int(part)))
+        else:
+            steps.append(("key", part))
+    return tuple(steps), transform_name or None
+
+def match_list_item(items, field, expected):
+    if not isinstance(items, list):
+        return None
+    return next((item for item in items if isinstance(item, dict) and str(item.get(field)) == expected), None)
+
+def apply_transform(transform, value):
+    if value is None or value == "":
+        return value
+    try:
+        return transform(value)
+    except (TypeError, ValueError):
+        return None
+
+# Cuerpo (líneas de Python) de la función de extracción. Cada prefijo de ruta compartido
+# ('reservation', 'reservation.guest', ...) se lee una sola vez por evento en una variable local.
+# Con checked=False se asume que cada prefijo es un diccionario (los que faltan pasan a ser
+# EMPTY_MAPPING), igual que la extracción escrita a mano; con checked=True se comprueba el tipo
+# en cada paso, para payloads con formas inesperadas.
+def row_extractor_lines(fields, namespace, checked):
+    lines = []
+    values = {(): "data"}
+    containers = {(): "data"}
+
+    def value_of(steps):
+        if steps not in values:
+            kind, argument = steps[-1]
+            parent = container_of(steps[:-1]) if kind == "key" else value_of(steps[:-1])
+            variable = values[steps] = f"v{len(values)}"
+            if kind == "key" and checked:
+                lines.append(f"{variable} = {parent}.get({argument!r}) if {parent}.__class__ is dict else None")
+            elif kind == "key":
+                lines.append(f"{variable} = {parent}.get({argument!r})")
+            elif kind == "index":
+                lines.append(f"{variable} = {parent}[{argument}] if {parent}.__class__ is list and len({parent}) > {argument} else None")
+            else:
+                lines.append(f"{variable} = match_list_item({parent}, {argument[0]!r}, {argument[1]!r})")
+        return values[steps]
+
+    def container_of(steps):
+        if checked:
+            return value_of(steps)
+        if steps not in containers:
+            variable = value_of(steps)
+            containers[steps] = f"{variable}_map"
+            lines.append(f"{variable}_map = {variable} or EMPTY_MAPPING")
+        return containers[steps]
+
+    for index, field in enumerate(fields):
+        namespace[f"default_{index}"] = field.default
+        parsed_paths = [parse_field_path(path) for path in field.paths]
+        if not parsed_paths:
+            lines.append(f"f{index} = default_{index}")
+            continue
+        # Una sola ruta de claves sin transformación: exactamente 'padre.get(clave, por_defecto)'
+        steps, transform_name = parsed_paths[0]
+        if not checked and len(parsed_paths) == 1 and transform_name is None and steps[-1][0] == "key":
+            lines.append(f"f{index} = {container_of(steps[:-1])}.get({steps[-1][1]!r}, default_{index})")
+            continue
+
+        expressions = []
+        for path_index, (steps, transform_name) in enumerate(parsed_paths):
+            expression = value_of(steps)
+            if transform_name:
+                namespace[f"transform_{index}_{path_index}"] = ROW_TRANSFORMS[transform_name]
+                expression = f"apply_transform(transform_{index}_{path_index}, {expression})"
+            expressions.append(expression)
+        # Se prueba cada ruta en orden; la primera con valor (ni None ni "") gana
+        lines.append(f"f{index} = default_{index}")
+        for depth, expression in enumerate(expressions):
+            indent = "    " * depth
+            lines.append(f"{indent}value = {expression}")
+            lines.append(f"{indent}if value is not None and value != \"\":")
+            lines.append(f"{indent}    f{index} = value")
+            if depth < len(expressions) - 1:
+                lines.append(f"{indent}else:")
+    lines.append(f"return [{', '.join(f'f{index}' for index in range(len(fields)))}]")
+    return lines
+
+# Compila el mapeo completo UNA vez (al importar el módulo) a una función webhook -> fila, generando
+# el mismo código que se escribiría a mano. Si el payload trae un tipo inesperado a mitad de una
+# ruta (p. ej. 'guest' como texto), se repite la extracción con la versión que comprueba tipos.
+def compile_row_extractor(fields):
+    columns = [field.column for field in fields]
+    duplicated = {column for column in columns if columns.count(column) > 1}
+    if duplicated:
+        raise ValueError(f"Columnas repetidas en el mapeo de la hoja: {sorted(duplicated)}")
+
+    namespace = {"match_list_item": match_list_item, "apply_transform": apply_transform, "EMPTY_MAPPING": {}}
+    checked_lines = row_extractor_lines(fields, namespace, checked=True)
+    fast_lines = row_extractor_lines(fields, namespace, checked=False)
+    source = "\n".join(
+        ["def extract_row_checked(data):"] + [f"    {line}" for line in checked_lines]
+        + ["", "def extract_row(data):", "    try:"] + [f"        {line}" for line in fast_lines]
+        + ["    except (AttributeError, TypeError):", "        return extract_row_checked(data)"]
+    )
+    exec(compile(source, "<sheet_field_mapping>", "exec"), namespace)
+    extract_row = namespace["extract_row"]
+    extract_row.source = source # Para depurar el mapeo: print(extract_row_data.source)
+    return extract_row
+
+# Letra(s) A1 de la columna número 'column_number' (1 -> A, 26 -> Z, 27 -> AA, 703 -> AAA)
+def column_letter(column_number):
+    letters = ""
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+# Encabezados de la hoja, en orden (derivados del mapeo)
+field_names = [field.column for field in SHEET_FIELDS]
+LAST_COLUMN = column_letter(len(field_names))
+VOLATILE_COLUMN_INDEXES = frozenset(index for index, field in enumerate(SHEET_FIELDS) if field.volatile)
+extract_row_data = compile_row_extractor(SHEET_FIELDS)
+
+# Modo del servidor al arrancar con 'python app.py': 'sync' (Flask/WSGI) o 'async' (ASGI, ver app_async.py)
+SERVER_MODE = os.getenv("SERVER_MODE", "sync")
+
+# --- CONFIGURACIÓN DE LA COLA DE ESCRITURA DIFERIDA (WRITE-BEHIND) ---
+# En lugar de hacer una llamada a la API de Sheets por cada webhook, las filas se encolan
+# y se escriben en bloque cada SHEETS_FLUSH_INTERVAL_MS milisegundos o al llegar a
+# SHEETS_FLUSH_MAX_ROWS eventos: un único values.batchUpdate (actualizaciones) y un único append (nuevas).
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "True") == "True"
+SHEETS_FLUSH_INTERVAL_MS = int(os.getenv("SHEETS_FLUSH_INTERVAL_MS", 1000))
+SHEETS_FLUSH_MAX_ROWS = int(os.getenv("SHEETS_FLUSH_MAX_ROWS", 200))
+
+# --- CONFIGURACIÓN DEL MODO DE ESCRITURA: FILAS INDEXADAS O REGISTRO + INSTANTÁNEA ---
+# 'rows' (por defecto): una fila por reserva que se reescribe en su sitio (A{fila}:X{fila}) gracias
+#   a reservation_index.
+# 'log': cada evento se añade como una fila más a la pestaña '<pestaña>_log' (solo appends en bloque,
+#   sin índice ni lecturas) y un job de compactación reescribe cada cierto tiempo la pestaña de
+#   destino con la última versión de cada reserva en un único values().update de todo el rango.
+SHEETS_SINK_MODE = os.getenv("SHEETS_SINK_MODE", "rows")
+SHEETS_LOG_TAB_SUFFIX = os.getenv("SHEETS_LOG_TAB_SUFFIX", "_log")
+SHEETS_COMPACTION_INTERVAL_SECONDS = int(os.getenv("SHEETS_COMPACTION_INTERVAL_SECONDS", 300)) # 0: solo con compactar_log.py
+SHEETS_COMPACTION_PAGE_ROWS = int(os.getenv("SHEETS_COMPACTION_PAGE_ROWS", 20000)) # Filas del registro por cada values().get
+SHEETS_COMPACTION_LEASE_SECONDS = int(os.getenv("SHEETS_COMPACTION_LEASE_SECONDS", 600))
+SHEETS_LOG_TRIM_ROWS = int(os.getenv("SHEETS_LOG_TRIM_ROWS", 50000)) # Filas ya compactadas a partir de las que se borran del registro (0: nunca)
+SHEETS_COMPACTION_INDEX_CHUNK = 5000 # Reservas por cada SELECT ... IN y cada upsert del índice al compactar
+
+if SHEETS_SINK_MODE not in ("rows", "log"):
+    raise RuntimeError(f"SHEETS_SINK_MODE='{SHEETS_SINK_MODE}' no válido: usa 'rows' o 'log'.")
+
+# El registro lleva, tras las columnas de la hoja, la versión de Guesty del evento (event_timestamp):
+# la compactación se queda con la más reciente aunque los eventos se hayan añadido desordenados.
+LOG_VERSION_COLUMN = "lastUpdatedAt"
+log_field_names = field_names + [LOG_VERSION_COLUMN]
+LOG_LAST_COLUMN = column_letter(len(log_field_names))
+
+# --- CONFIGURACIÓN DEL OUTBOX PERSISTENTE ---
+# Cada webhook se guarda primero en la tabla 'webhook_outbox' y se responde 202; un hilo de fondo
+# lo entrega a Sheets con reintentos (backoff exponencial y cabecera Retry-After).
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", 2))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", 600))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 20)) # Después se marca como 'dead' y se deja para revisión manual
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", 120)) # Tiempo que un worker "reserva" las filas que está entregando
+# Mientras se entrega un bloque (esperas del limitador, reintentos con backoff, lecturas de anclas) el lease
+# de sus shards y de sus filas se prolonga cada OUTBOX_LEASE_RENEW_SECONDS, así no caduca a mitad de entrega
+OUTBOX_LEASE_RENEW_SECONDS = float(os.getenv("OUTBOX_LEASE_RENEW_SECONDS", OUTBOX_LEASE_SECONDS / 3))
+# Cada reservation_id cae siempre en el mismo shard (crc32 % OUTBOX_SHARDS) y cada shard lo drena
+# un solo worker a la vez en todo el clúster (lease en 'outbox_shard_lease'): los eventos de una
+# reserva se aplican en serie y reservas distintas avanzan en paralelo en hilos y procesos.
+# Cambia OUTBOX_SHARDS solo con el outbox vacío: las filas guardan el shard con el que se encolaron.
+OUTBOX_SHARDS = int(os.getenv("OUTBOX_SHARDS", 16))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 2)) # Hilos de drenado por proceso
+# Cada bloque se reparte en una cola por destino (ver group_outbox_by_target) y las colas se entregan
+# en paralelo, hasta SHEETS_TARGET_CONCURRENCY a la vez por proceso: una hoja lenta o sin cuota no frena a las demás.
+SHEETS_TARGET_CONCURRENCY = int(os.getenv("SHEETS_TARGET_CONCURRENCY", 4))
+
+# Tamaño máximo de la caché en memoria reservation_id -> entrada del índice (0 la desactiva) y segundos
+# tras los que una entrada se vuelve a leer de la DB por si otro proceso escribió la reserva (0: no caducan)
+RESERVATION_CACHE_SIZE = int(os.getenv("RESERVATION_CACHE_SIZE", 50000))
+RESERVATION_CACHE_TTL_SECONDS = float(os.getenv("RESERVATION_CACHE_TTL_SECONDS", 300))
+
+# --- CONFIGURACIÓN DE LA HUELLA DE FILA (ESCRITURAS SIN CAMBIOS) ---
+# El índice guarda un hash de lo último escrito en cada fila: si un evento trae la misma fila (sin
+# contar las columnas volátiles) no se llama a Sheets. Con SHEETS_STORE_ROW_DATA se guarda también
+# la fila, para escribir solo las columnas que cambian en como mucho SHEETS_PARTIAL_WRITE_MAX_RANGES
+# rangos; si hay más, se reescribe la fila completa. Supone que nadie edita esas filas a mano
+# (si se hace, reconstruir_indice.py borra las huellas y el siguiente evento reescribe la fila).
+SHEETS_SKIP_UNCHANGED_ROWS = os.getenv("SHEETS_SKIP_UNCHANGED_ROWS", "True") == "True"
+SHEETS_STORE_ROW_DATA = os.getenv("SHEETS_STORE_ROW_DATA", "True") == "True"
+SHEETS_PARTIAL_WRITE_MAX_RANGES = int(os.getenv("SHEETS_PARTIAL_WRITE_MAX_RANGES", 3)) # 0 desactiva la escritura parcial
+
+# --- CONFIGURACIÓN DE LAS ANCLAS DE FILA (DEVELOPER METADATA) ---
+# sheet_row_number deja de ser válido en cuanto alguien ordena la pestaña o borra filas. Con
+# SHEETS_ROW_ANCHORS cada fila añadida en modo 'rows' recibe un developer metadata de fila
+# (SHEETS_ROW_ANCHOR_KEY = reservation_id) que Sheets mueve con la fila y borra con ella. Las filas
+# ancladas que se reescriben completas usan values().batchUpdateByDataFilter buscando su ancla, no su
+# número, y la respuesta dice en qué fila estaban: el índice se corrige en la misma llamada. Las que
+# solo cambian en unos tramos buscan antes su fila con un developerMetadata().search por hoja (una
+# lectura) y escriben esos tramos por rango A1.
+# Sheets admite como máximo 30.000 caracteres de developer metadata por hoja y por pestaña, y cada ancla
+# ocupa len(SHEETS_ROW_ANCHOR_KEY) + len(reservation_id) (unos 40): solo caben unos cientos de filas
+# ancladas por hoja. SHEETS_ROW_ANCHOR_MAX_CHARS es el presupuesto por hoja que se reparten las anclas
+# (por debajo del límite, con margen para otros metadata y para workers que anclan a la vez); las filas
+# que no caben se escriben por número de fila, igual que sin anclas, y las cubre el verificador. Si
+# anclar falla, las anclas de esa hoja se pausan SHEETS_ROW_ANCHOR_RETRY_SECONDS en ese proceso.
+# Cada SHEETS_ROW_VERIFY_INTERVAL_SECONDS se comprueban SHEETS_ROW_VERIFY_SAMPLE filas al azar por
+# pestaña (un solo values().batchGet); si alguna no está donde dice el índice, se relocalizan todas de
+# una vez con developerMetadata().search. Las filas anteriores a las anclas se anclan al verificarlas
+# mientras quede presupuesto.
+SHEETS_ROW_ANCHORS = os.getenv("SHEETS_ROW_ANCHORS", "True") == "True"
+SHEETS_ROW_ANCHOR_KEY = os.getenv("SHEETS_ROW_ANCHOR_KEY", "reservation_id")
+SHEETS_ROW_ANCHOR_MAX_CHARS = int(os.getenv("SHEETS_ROW_ANCHOR_MAX_CHARS", 25000)) # Límite de Sheets: 30.000
+SHEETS_ROW_ANCHOR_RETRY_SECONDS = int(os.getenv("SHEETS_ROW_ANCHOR_RETRY_SECONDS", 3600))
+SHEETS_ROW_VERIFY_INTERVAL_SECONDS = int(os.getenv("SHEETS_ROW_VERIFY_INTERVAL_SECONDS", 900)) # 0: solo con verificar_filas.py
+SHEETS_ROW_VERIFY_SAMPLE = int(os.getenv("SHEETS_ROW_VERIFY_SAMPLE", 200))
+
+# --- CONFIGURACIÓN DE LA DEDUPLICACIÓN DE WEBHOOKS ---
+# Guesty reintenta las entregas: un meta.eventId (o messageId) ya visto se responde 200 sin tocar Sheets.
+# Los IDs se recuerdan en memoria y en la tabla 'processed_event' (compartida entre workers y reinicios).
+# Un evento cuyo registro del outbox acaba 'dead' se borra de la tabla para aceptar el reintento de Guesty;
+# la memoria de cada proceso lo recuerda solo DEDUP_MEMORY_TTL_SECONDS, mucho menos de lo que tarda un
+# registro en agotar OUTBOX_MAX_ATTEMPTS, así que a partir de ahí manda la tabla.
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", 3 * 24 * 3600))
+DEDUP_MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", 100000))
+DEDUP_MEMORY_TTL_SECONDS = int(os.getenv("DEDUP_MEMORY_TTL_SECONDS", 600))
+DEDUP_PRUNE_INTERVAL_SECONDS = int(os.getenv("DEDUP_PRUNE_INTERVAL_SECONDS", 3600))
+
+# --- MÉTRICAS ESTILO PROMETHEUS (/metrics) ---
+# Cada hilo escribe solo en su propia "celda" de contadores e histogramas, así que en el camino
+# caliente no hay locks (el único lock se toma una vez por hilo, al registrar su celda).
+# /metrics suma las celdas de todos los hilos. Con varios workers de gunicorn, cada proceso
+# expone sus propias métricas.
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class MetricsRegistry:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+        self._help = {}
+        self._collectors = []
+
+    def _cell(self):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = {"counters": {}, "histograms": {}}
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+        return cell
+
+    def describe(self, name, metric_type, help_text):
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        counters = self._cell()["counters"]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        histograms = self._cell()["histograms"]
+        key = (name, tuple(sorted(labels.items())))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(self._buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(self._buckets, seconds)] += 1
+        histogram[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # Función que devuelve una lista de (nombre, labels, valor) calculada en cada scrape (p. ej. la caché)
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        counters = {}
+        histograms = {}
+        with self._lock:
+            cells = list(self._cells)
+        for cell in cells:
+            for key, value in cell["counters"].copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, (bucket_counts, total) in cell["histograms"].copy().items():
+                merged = histograms.setdefault(key, [[0] * (len(self._buckets) + 1), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], bucket_counts)]
+                merged[1] += total
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                counters[(name, tuple(sorted(labels.items())))] = value
+
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        described = set()
+        def header(name):
+            if name not in described and name in self._help:
+                metric_type, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+            described.add(name)
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (bucket_counts, total) in sorted(histograms.items()):
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self._buckets + ("+Inf",), bucket_counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+# Valor de label en el formato de texto de Prometheus: barra invertida, comillas y saltos de línea escapados
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Temas de Guesty que se cuentan por nombre en webhook_events_total. El campo 'event' viene del payload:
+# cualquier otro valor se cuenta como "other" para que un emisor no pueda crear series sin límite.
+METRICS_EVENT_LABELS = frozenset({"reservation.new", "reservation.updated"})
+
+def event_label(webhook_event_type):
+    return webhook_event_type if webhook_event_type in METRICS_EVENT_LABELS else "other"
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+metrics.describe("webhook_request_duration_seconds", "histogram", "Latencia total de /webhook.")
+metrics.describe("webhook_stage_duration_seconds", "histogram", "Latencia por etapa del pipeline (parse, find_row, sheets_*, db_commit).")
+metrics.describe("webhook_events_total", "counter", "Webhooks recibidos por tipo de evento y resultado.")
+metrics.describe("sheets_http_errors_total", "counter", "Errores HttpError de la API de Google Sheets por código de estado.")
+metrics.describe("reservation_cache_hits_total", "counter", "Aciertos de la caché del índice de reservas.")
+metrics.describe("reservation_cache_misses_total", "counter", "Fallos de la caché del índice de reservas.")
+metrics.describe("reservation_cache_size", "gauge", "Entradas en la caché del índice de reservas.")
+metrics.describe("sheets_row_writes_total", "counter", "Filas existentes por tipo de escritura en Sheets (full/partial/skipped).")
+
+# Mide una llamada a la API de Sheets y cuenta los HttpError por código de estado
+@contextmanager
+def sheets_call(stage):
+    try:
+        with metrics.timer("webhook_stage_duration_seconds", stage=stage):
+            yield
+    except HttpError as error:
+        metrics.inc("sheets_http_errors_total", status=http_error_status(error))
+        raise
+
+def http_error_status(error):
+    return getattr(error, "status_code", None) or error.resp.status
+
+# --- LIMITADOR DE CUOTA DE GOOGLE SHEETS ---
+# Sheets limita las solicitudes por minuto (lectura y escritura por separado) y por usuario, y la
+# cuenta de servicio es un único usuario para todos los workers. Un token bucket por tipo de
+# llamada, guardado en un fichero local con flock, reparte ese presupuesto entre procesos e hilos.
+# El ritmo se adapta a los errores observados (AIMD): cada 429/503 lo reduce a la mitad y pausa
+# el bucket (respetando Retry-After); cada éxito lo sube poco a poco hasta el máximo configurado.
+SHEETS_READ_REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_READ_REQUESTS_PER_MINUTE", 60))
+SHEETS_WRITE_REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_WRITE_REQUESTS_PER_MINUTE", 60))
+SHEETS_RATE_LIMIT_MIN_PER_MINUTE = float(os.getenv("SHEETS_RATE_LIMIT_MIN_PER_MINUTE", 6))
+SHEETS_RATE_LIMIT_INCREASE_PER_MINUTE = float(os.getenv("SHEETS_RATE_LIMIT_INCREASE_PER_MINUTE", 1)) # Subida del ritmo por cada éxito
+SHEETS_RATE_LIMIT_BURST = float(os.getenv("SHEETS_RATE_LIMIT_BURST", 10)) # Llamadas seguidas permitidas con el bucket lleno
+SHEETS_RATE_LIMIT_STATE_FILE = os.getenv("SHEETS_RATE_LIMIT_STATE_FILE", os.path.join(tempfile.gettempdir(), "guesty_sheets_rate_limit.json"))
+SHEETS_CALL_MAX_ATTEMPTS = int(os.getenv("SHEETS_CALL_MAX_ATTEMPTS", 3)) # Intentos de cada llamada antes de devolver el error
+SHEETS_RETRY_BASE_SECONDS = float(os.getenv("SHEETS_RETRY_BASE_SECONDS", 1))
+SHEETS_RETRY_MAX_SECONDS = float(os.getenv("SHEETS_RETRY_MAX_SECONDS", 32))
+SHEETS_DIRECT_MAX_WAIT_SECONDS = float(os.getenv("SHEETS_DIRECT_MAX_WAIT_SECONDS", 5)) # Plazo total de cada solicitud HTTP con escritura directa (lease + llamadas a Sheets)
+SHEETS_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+SHEETS_THROTTLE_STATUSES = {429, 503} # Los que además reducen el ritmo
+
+class SheetsQuotaExceeded(Exception):
+    """El limitador no tiene turno libre dentro de la espera máxima permitida."""
 
 try:
-    google_credentials = os.getenv("GOOGLE_CREDENTIALS")
-    if google_credentials is None:
-        raise ValueError("La variable de entorno 'GOOGLE_CREDENTIALS' no está configurada.")
+    import fcntl
+except ImportError: # Windows: el estado se comparte solo entre los hilos de este proceso
+    fcntl = None
 
-    # Decodificar la cadena base64 de las credenciales de la cuenta de servicio
-    service_account_info = json.loads(base64.b64decode(google_credentials))
-    creds = Credentials.from_service_account_info(service_account_info)
-    
-    # Construir el servicio de Sheets
-    sheets_service = build("sheets", "v4", credentials=creds)
-    print("✅ Servicio de Google Sheets inicializado con éxito.")
+# Segundos de espera antes de reintentar: Retry-After si lo hay; si no, backoff exponencial con jitter
+def backoff_delay_seconds(attempts, error, base_seconds, max_seconds):
+    retry_after = None
+    if isinstance(error, HttpError) and error.resp is not None:
+        retry_after = error.resp.get("retry-after")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    delay = min(base_seconds * (2 ** max(attempts - 1, 0)), max_seconds)
+    return delay * random.uniform(0.5, 1.0)
+
+class SheetsRateLimiter:
+    """Token bucket compartido entre workers (fichero + flock) con ritmo adaptativo por tipo de llamada."""
+
+    def __init__(self, state_path, max_per_minute, min_per_minute, increase_per_minute, burst):
+        self._state_path = state_path
+        self._max_per_minute = max_per_minute # {"read": ..., "write": ...}
+        self._min_per_minute = min_per_minute
+        self._increase_per_minute = increase_per_minute
+        self._burst = burst
+        self._lock = threading.Lock()
+        self._memory_state = {}
+        self._waiting = {kind: 0 for kind in max_per_minute}
+        self._successes = {kind: 0 for kind in max_per_minute} # Éxitos aún no aplicados al ritmo compartido
+
+    @contextmanager
+    def _locked_state(self):
+        with self._lock:
+            if fcntl is None:
+                yield self._memory_state
+                return
+            try:
+                state_file = open(self._state_path, "a+")
+            except OSError as e:
+                logger.warning("No se pudo abrir el estado del limitador de Sheets; se usa solo memoria", extra=log_fields(path=self._state_path, error=str(e)))
+                yield self._memory_state
+                return
+            with state_file:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read() or "{}")
+                except ValueError:
+                    state = {}
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+
+    # Estado del bucket de 'kind' rellenado hasta 'now' (hora de reloj: se comparte entre procesos), con la
+    # subida del ritmo de los éxitos de este proceso desde la última vez. Se llama con self._lock tomado.
+    def _bucket(self, state, kind, now):
+        bucket = state.get(kind)
+        if bucket is None:
+            bucket = state[kind] = {"tokens": self._burst, "rate": self._max_per_minute[kind], "updated_at": now, "paused_until": 0.0}
+        elapsed = max(now - bucket["updated_at"], 0.0)
+        bucket["tokens"] = min(bucket["tokens"] + elapsed * min(bucket["rate"], self._max_per_minute[kind]) / 60.0, self._burst)
+        bucket["updated_at"] = now
+        bucket["rate"] = min(bucket["rate"] + self._successes[kind] * self._increase_per_minute, self._max_per_minute[kind])
+        self._successes[kind] = 0
+        return bucket
+
+    # Reserva una llamada y devuelve cuántos segundos hay que esperar antes de hacerla. El token se
+    # toma ya (el saldo puede quedar negativo), así la espera ocurre fuera del lock y en orden de llegada.
+    # Con 'max_wait', si la espera sería mayor no se reserva nada y se lanza SheetsQuotaExceeded.
+    def reserve(self, kind, max_wait=None):
+        now = time.time()
+        with self._locked_state() as state:
+            bucket = self._bucket(state, kind, now)
+            wait = max((1 - bucket["tokens"]) * 60.0 / bucket["rate"], bucket["paused_until"] - now, 0.0)
+            if max_wait is not None and wait > max_wait:
+                raise SheetsQuotaExceeded(f"Sin cuota de Google Sheets ({kind}) en los próximos {max_wait:.0f}s (espera estimada {wait:.1f}s).")
+            bucket["tokens"] -= 1
+        if wait > 0:
+            metrics.inc("sheets_rate_limit_wait_seconds_total", wait, kind=kind)
+        return wait
+
+    def acquire(self, kind, max_wait=None):
+        wait = self.reserve(kind, max_wait)
+        if wait > 0:
+            with self.waiting(kind):
+                time.sleep(wait)
+
+    # Cuenta a quien espera turno (cola de llamadas del proceso, expuesta en /metrics)
+    @contextmanager
+    def waiting(self, kind):
+        with self._lock:
+            self._waiting[kind] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._waiting[kind] -= 1
+
+    # Solo en memoria: la subida del ritmo se aplica al fichero en el próximo reserve, así cada llamada a
+    # Sheets toma el flock una sola vez
+    def on_success(self, kind):
+        with self._lock:
+            self._successes[kind] += 1
+
+    def on_throttled(self, kind, pause_seconds):
+        now = time.time()
+        with self._locked_state() as state:
+            bucket = self._bucket(state, kind, now)
+            bucket["rate"] = max(bucket["rate"] / 2.0, self._min_per_minute)
+            bucket["tokens"] = min(bucket["tokens"], 0.0)
+            bucket["paused_until"] = max(bucket["paused_until"], now + pause_seconds)
+            rate = bucket["rate"]
+        logger.warning("Cuota de Google Sheets agotada: ritmo reducido y bucket en pausa", extra=log_fields(kind=kind, rate_per_minute=round(rate, 1), pause_seconds=round(pause_seconds, 1)))
+
+    def stats(self):
+        now = time.time()
+        with self._locked_state() as state:
+            buckets = {kind: dict(self._bucket(state, kind, now)) for kind in self._max_per_minute}
+        with self._lock:
+            waiting = dict(self._waiting)
+        return {kind: {**bucket, "waiting": waiting[kind]} for kind, bucket in buckets.items()}
+
+sheets_rate_limiter = SheetsRateLimiter(
+    SHEETS_RATE_LIMIT_STATE_FILE,
+    {"read": SHEETS_READ_REQUESTS_PER_MINUTE, "write": SHEETS_WRITE_REQUESTS_PER_MINUTE},
+    SHEETS_RATE_LIMIT_MIN_PER_MINUTE,
+    SHEETS_RATE_LIMIT_INCREASE_PER_MINUTE,
+    SHEETS_RATE_LIMIT_BURST,
+)
+
+def sheets_rate_limit_metrics():
+    samples = []
+    for kind, bucket in sheets_rate_limiter.stats().items():
+        samples.append(("sheets_rate_limit_budget", {"kind": kind}, round(bucket["tokens"], 3)))
+        samples.append(("sheets_rate_limit_per_minute", {"kind": kind}, round(bucket["rate"], 3)))
+        samples.append(("sheets_rate_limit_waiting", {"kind": kind}, bucket["waiting"]))
+    return samples
 
-except Exception as e:
-    print(f"❌ ERROR CRÍTICO al inicializar el servicio de Google Sheets: {e}")
-    sheets_service = None # Asegurarse de que el servicio no esté disponible si falla la inicialización
+metrics.register_collector(sheets_rate_limit_metrics)
+metrics.describe("sheets_rate_limit_budget", "gauge", "Llamadas a Sheets disponibles ya en el token bucket (negativo: reservadas en espera).")
+metrics.describe("sheets_rate_limit_per_minute", "gauge", "Ritmo actual permitido por el limitador adaptativo de Sheets.")
+metrics.describe("sheets_rate_limit_waiting", "gauge", "Llamadas de este proceso esperando turno en el limitador de Sheets.")
+metrics.describe("sheets_rate_limit_wait_seconds_total", "counter", "Segundos de espera acumulados por el limitador de Sheets.")
+
+# Un error que indica sobrecarga o cuota: el limitador baja el ritmo y pausa el bucket
+def record_sheets_error(kind, error, attempts):
+    if isinstance(error, HttpError) and http_error_status(error) in SHEETS_THROTTLE_STATUSES:
+        sheets_rate_limiter.on_throttled(kind, backoff_delay_seconds(attempts, error, SHEETS_RETRY_BASE_SECONDS, SHEETS_RETRY_MAX_SECONDS))
+
+# ¿Se puede repetir la llamada? Un 429 nunca se aplicó; un 5xx puede haberse aplicado, así que
+# solo se repiten tras 5xx las llamadas idempotentes (update/batchUpdate/get, no append).
+def is_retryable_sheets_error(error, idempotent=True):
+    if not isinstance(error, HttpError):
+        return False
+    status = http_error_status(error)
+    return status == 429 or (idempotent and status in SHEETS_RETRYABLE_STATUSES)
+
+# --- PLAZO DE LA ESCRITURA DIRECTA ---
+# Una solicitud HTTP con escritura directa tiene un único plazo (SHEETS_DIRECT_MAX_WAIT_SECONDS) para todo:
+# el lease del shard y cada llamada a Sheets que haga (pestaña activa, encabezado, sheetId, append, anclas...).
+# Mientras está abierto, execute_sheets espera turno como mucho lo que queda y no reintenta: lo que no
+# cabe en el plazo pasa al outbox, que reintenta con backoff sin tener a nadie esperando.
+sheets_deadline_state = threading.local()
+
+@contextmanager
+def sheets_deadline(seconds):
+    sheets_deadline_state.at = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        sheets_deadline_state.at = None
+
+# Segundos que le quedan al plazo de este hilo (None si no hay plazo)
+def sheets_deadline_remaining():
+    deadline = getattr(sheets_deadline_state, "at", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+# Espera máxima por turno para la próxima llamada: 'max_wait' acotado por lo que queda del plazo
+def sheets_max_wait(kind, max_wait=None):
+    remaining = sheets_deadline_remaining()
+    if remaining is None:
+        return max_wait
+    if remaining <= 0:
+        raise SheetsQuotaExceeded(f"Plazo de la escritura directa agotado antes de la llamada a Google Sheets ({kind}).")
+    return remaining if max_wait is None else min(max_wait, remaining)
+
+# Ejecuta una solicitud de googleapiclient pasando por el limitador, con reintentos en 429/5xx (salvo
+# dentro de un plazo de escritura directa). 'max_wait' acota la espera por turno (SheetsQuotaExceeded si
+# no hay cuota a tiempo); con 'reserved' el primer intento ya tiene su turno pagado (ver reserve_row_anchor).
+def execute_sheets(sheets_request, stage, kind="write", idempotent=True, max_wait=None, reserved=False):
+    attempts = 0
+    while True:
+        attempts += 1
+        if attempts > 1 or not reserved:
+            sheets_rate_limiter.acquire(kind, sheets_max_wait(kind, max_wait))
+        try:
+            with sheets_call(stage):
+                result = sheets_request.execute()
+        except HttpError as error:
+            record_sheets_error(kind, error, attempts)
+            if attempts >= SHEETS_CALL_MAX_ATTEMPTS or not is_retryable_sheets_error(error, idempotent) or sheets_deadline_remaining() is not None:
+                raise
+            delay = backoff_delay_seconds(attempts, error, SHEETS_RETRY_BASE_SECONDS, SHEETS_RETRY_MAX_SECONDS)
+            logger.warning("Error reintentable de Google Sheets: se repite la llamada", extra=log_fields(stage=stage, status=http_error_status(error), attempt=attempts + 1, max_attempts=SHEETS_CALL_MAX_ATTEMPTS, delay_seconds=round(delay, 1)))
+            time.sleep(delay)
+            continue
+        sheets_rate_limiter.on_success(kind)
+        return result
+
+# --- CLIENTE DE GOOGLE SHEETS PEREZOSO CON TRANSPORTE POR HILO ---
+# Importar la pila de Google, cargar la clave de la cuenta de servicio y generar el recurso a partir del
+# documento de descubrimiento incluido en googleapiclient (sin descargarlo de la red) cuesta cientos de ms,
+# así que no se hace al importar el módulo sino una sola vez por proceso: en el primer uso o en el
+# calentamiento de fondo. El recurso lo comparten todos los hilos; httplib2 no es thread-safe, así que
+# cada solicitud sale por el transporte autorizado (con conexiones keep-alive) del hilo que la ejecuta.
+# Un hilo de fondo refresca el token antes de que caduque, así ninguna solicitud paga ese refresco.
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SHEETS_HTTP_TIMEOUT_SECONDS = float(os.getenv("SHEETS_HTTP_TIMEOUT_SECONDS", 30))
+SHEETS_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("SHEETS_TOKEN_REFRESH_MARGIN_SECONDS", 600))
+# Raíz de la API de Sheets; solo se cambia para apuntar a la API falsa de benchmark.py
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT", "https://sheets.googleapis.com/")
+
+class SheetsClient:
+    """Sustituto thread-safe y perezoso del objeto devuelto por build("sheets", "v4", ...)."""
+
+    def __init__(self, service_account_base64):
+        self._service_account_base64 = service_account_base64
+        self._credentials = None
+        self._spreadsheets = None
+        self._local = threading.local()
+        self._credentials_lock = threading.Lock()
+        self._build_lock = threading.Lock() # Distinto del de las credenciales: build_from_document lee self.credentials
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+
+    @property
+    def credentials(self):
+        if self._credentials is None:
+            with self._credentials_lock:
+                if self._credentials is None:
+                    from google.oauth2.service_account import Credentials
+                    # Decodificar la cadena base64 de las credenciales de la cuenta de servicio
+                    service_account_info = json.loads(base64.b64decode(self._service_account_base64))
+                    self._credentials = Credentials.from_service_account_info(service_account_info, scopes=SHEETS_SCOPES)
+        return self._credentials
+
+    # Igual que sheets_service.spreadsheets(): el recurso se construye una vez y lo comparten todos los hilos
+    def spreadsheets(self):
+        if self._spreadsheets is None:
+            with self._build_lock:
+                if self._spreadsheets is None:
+                    from googleapiclient import discovery_cache
+                    from googleapiclient.discovery import build_from_document
+                    discovery_doc = discovery_cache.get_static_doc("sheets", "v4")
+                    if discovery_doc is None:
+                        raise RuntimeError("No se encontró el documento de descubrimiento de Sheets v4 incluido en googleapiclient.")
+                    # http=self: las solicitudes del recurso compartido pasan por request() de abajo
+                    service = build_from_document(discovery_doc, http=self, client_options={"api_endpoint": SHEETS_API_ENDPOINT})
+                    self._spreadsheets = service.spreadsheets()
+        return self._spreadsheets
+
+    # Interfaz de httplib2.Http que usa HttpRequest.execute(): se delega en el transporte de este hilo
+    def request(self, *args, **kwargs):
+        return self._thread_http().request(*args, **kwargs)
+
+    def _thread_http(self):
+        authorized_http = getattr(self._local, "http", None)
+        if authorized_http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            authorized_http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT_SECONDS))
+            self._local.http = authorized_http
+            self.start_token_refresher()
+        return authorized_http
+
+    # Paga por adelantado todo lo perezoso (credenciales, importaciones, recurso y token) fuera de las solicitudes
+    def warm_up(self):
+        if not self.credentials.valid:
+            self.refresh_token()
+        self.spreadsheets()
+        self._thread_http()
+
+    def refresh_token(self):
+        import httplib2
+        from google_auth_httplib2 import Request as GoogleAuthRequest
+        with self._refresh_lock:
+            self.credentials.refresh(GoogleAuthRequest(httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT_SECONDS)))
+
+    # Segundos hasta que toca refrescar el token (0 si ya toca)
+    def _seconds_until_refresh(self):
+        expiry = self.credentials.expiry
+        if not self.credentials.token or expiry is None:
+            return 0
+        remaining = (expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+        return max(remaining - SHEETS_TOKEN_REFRESH_MARGIN_SECONDS, 0)
+
+    def _run_refresher(self):
+        while True:
+            wait = self._seconds_until_refresh()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.refresh_token()
+            except Exception as e:
+                logger.error("Error refrescando el token de Google Sheets", extra=log_fields(error=str(e)))
+                time.sleep(30)
+
+    def start_token_refresher(self):
+        # Igual que el drenador del outbox: se arranca de forma perezosa en cada worker, tras el fork
+        with self._refresh_lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(target=self._run_refresher, name="sheets-token-refresher", daemon=True)
+                self._refresher.start()
+
+# --- INICIALIZACIÓN GLOBAL DEL SERVICIO DE GOOGLE SHEETS ---
+# Una sola instancia por proceso. Aquí solo se comprueba que haya credenciales: se decodifican y el
+# cliente se construye en su primer uso o en el calentamiento (ver ARRANQUE RÁPIDO).
+sheets_service = None
+google_credentials = os.getenv("GOOGLE_CREDENTIALS")
+
+if google_credentials is None:
+    logger.error("ERROR CRÍTICO al inicializar el servicio de Google Sheets: la variable de entorno 'GOOGLE_CREDENTIALS' no está configurada")
+else:
+    sheets_service = SheetsClient(google_credentials)
 
 # --- CONFIGURACIÓN Y MODELO DE LA BASE DE DATOS SQL (PostgreSQL) ---
 # Obtener la URL de conexión a la base de datos de las variables de entorno de Render
@@ -68,19 +1026,219 @@ Base = declarative_base()
 class ReservationIndex(Base):
     __tablename__ = 'reservation_index' # Nombre de la tabla en tu DB PostgreSQL
     id = Column(Integer, primary_key=True, autoincrement=True) # ID interno de la tabla, autoincremental
-    reservation_id = Column(String, unique=True, nullable=False, index=True) # ID de Guesty, debe ser único y se indexa para búsquedas rápidas
+    reservation_id = Column(String, nullable=False, index=True) # ID de Guesty, se indexa para búsquedas rápidas
+    target = Column(String, nullable=False) # target_key() de la hoja y pestaña donde está la fila
     sheet_row_number = Column(Integer, nullable=False) # Número de fila correspondiente en tu Google Sheet
+    last_event_at = Column(DateTime, nullable=True) # Marca de tiempo de Guesty de la última versión escrita en Sheets
+    row_hash = Column(String, nullable=True) # row_fingerprint() de lo último escrito en la fila
+    row_data = Column(Text, nullable=True) # JSON de lo último escrito (solo con SHEETS_STORE_ROW_DATA)
+    sheet_id = Column(Integer, nullable=True) # sheetId de la pestaña si la fila tiene ancla (developer metadata); None = sin anclar
+
+    # Cada reserva es única dentro de su destino (la clave del upsert)
+    __table_args__ = (Index("ix_reservation_index_target_reservation_id", "target", "reservation_id", unique=True),)
+
+    def __repr__(self):
+        return f"<ReservationIndex(target='{self.target}', reservation_id='{self.reservation_id}', sheet_row_number={self.sheet_row_number})>"
+
+# Espejo local de la hoja: la última fila escrita de cada reserva, para leerla sin llamar a Sheets (/reservations)
+class ReservationMirror(Base):
+    __tablename__ = 'reservation_mirror'
+    reservation_id = Column(String, primary_key=True)
+    target = Column(String, nullable=False) # target_key() de la pestaña donde está la fila
+    listing_id = Column(String, nullable=False, default="")
+    check_in = Column(String, nullable=False, default="") # Columna checkIn tal cual: ISO 8601, se ordena como texto
+    status = Column(String, nullable=False, default="")
+    last_event_at = Column(DateTime, nullable=True) # Versión de Guesty de la fila (las más antiguas no la pisan)
+    row_data = Column(Text, nullable=False) # JSON de la fila completa, en el orden de 'field_names'
+    updated_at = Column(DateTime, nullable=False)
+
+    # Paginación por (check_in, reservation_id), sola o tras el filtro de igualdad de anuncio o estado
+    __table_args__ = (
+        Index("ix_reservation_mirror_check_in", "check_in", "reservation_id"),
+        Index("ix_reservation_mirror_listing_check_in", "listing_id", "check_in", "reservation_id"),
+        Index("ix_reservation_mirror_status_check_in", "status", "check_in", "reservation_id"),
+    )
+
+    def __repr__(self):
+        return f"<ReservationMirror(reservation_id='{self.reservation_id}', listing_id='{self.listing_id}', check_in='{self.check_in}', status='{self.status}')>"
+
+# Pestañas en las que se añaden reservas nuevas, con su ocupación (para el rollover por tamaño)
+class SheetTab(Base):
+    __tablename__ = 'sheet_tab'
+    target = Column(String, primary_key=True) # target_key() de la pestaña concreta
+    route = Column(String, nullable=False, index=True) # target_key() del destino base de la regla
+    sequence = Column(Integer, nullable=False) # 1 = pestaña base, 2 = '<pestaña>_2', ...
+    row_count = Column(Integer, nullable=False) # Última fila ocupada conocida (1 = solo el encabezado)
+
+    def __repr__(self):
+        return f"<SheetTab(target='{self.target}', sequence={self.sequence}, row_count={self.row_count})>"
+
+# Reservas de un append que falló después de enviarse (5xx o sin respuesta): pudo aplicarse o no. Antes
+# de volver a añadirlas se buscan en la pestaña (resolve_appends_in_doubt) para no duplicar la fila.
+class SheetAppendInDoubt(Base):
+    __tablename__ = 'sheet_append_in_doubt'
+    target = Column(String, primary_key=True) # target_key() de la pestaña del append fallido
+    reservation_id = Column(String, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<SheetAppendInDoubt(target='{self.target}', reservation_id='{self.reservation_id}')>"
+
+# Instantáneas del modo 'log': pestaña de estado actual que se reconstruye desde su '<pestaña>_log'
+class SheetSnapshot(Base):
+    __tablename__ = 'sheet_snapshot'
+    target = Column(String, primary_key=True) # target_key() de la pestaña de estado actual
+    log_version = Column(Integer, nullable=False, default=0) # Sube con cada append al registro
+    compacted_version = Column(Integer, nullable=False, default=0) # log_version leída en la última compactación
+    row_count = Column(Integer, nullable=False, default=0) # Reservas (filas de datos) de la pestaña de estado actual
+    compacted_at = Column(DateTime, nullable=True)
+    locked_until = Column(DateTime, nullable=True) # Lease del worker que la está compactando
+    compacted_log_row = Column(Integer, nullable=True) # Última fila del registro ya compactada (None: nunca, se reconstruye entera)
+
+    def __repr__(self):
+        return f"<SheetSnapshot(target='{self.target}', log_version={self.log_version}, compacted_version={self.compacted_version})>"
+
+# Outbox persistente de webhooks pendientes de escribir en Google Sheets
+class WebhookOutbox(Base):
+    __tablename__ = 'webhook_outbox'
+    id = Column(Integer, primary_key=True, autoincrement=True) # El orden de llegada se respeta por este ID
+    reservation_id = Column(String, nullable=False, index=True)
+    shard = Column(Integer, nullable=False, index=True) # outbox_shard(reservation_id)
+    payload = Column(Text, nullable=False) # JSON crudo del webhook de Guesty
+    status = Column(String, nullable=False, default="pending") # 'pending' o 'dead'
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, index=True)
+    locked_until = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<WebhookOutbox(id={self.id}, reservation_id='{self.reservation_id}', status='{self.status}', attempts={self.attempts})>"
+
+# Lease de cada shard del outbox: solo su 'owner' entrega eventos de ese shard hasta 'locked_until'
+class OutboxShardLease(Base):
+    __tablename__ = 'outbox_shard_lease'
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String, nullable=True) # host:pid:worker que lo tiene tomado
+    locked_until = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<OutboxShardLease(shard={self.shard}, owner='{self.owner}', locked_until={self.locked_until})>"
+
+# IDs de eventos de Guesty ya aceptados (deduplicación de reintentos)
+class ProcessedEvent(Base):
+    __tablename__ = 'processed_event'
+    event_id = Column(String, primary_key=True) # meta.eventId (o meta.messageId si no viene eventId)
+    reservation_id = Column(String, nullable=True)
+    received_at = Column(DateTime, nullable=False, index=True) # Para purgar los que superan DEDUP_TTL_SECONDS
 
     def __repr__(self):
-        return f"<ReservationIndex(reservation_id='{self.reservation_id}', sheet_row_number={self.sheet_row_number})>"
+        return f"<ProcessedEvent(event_id='{self.event_id}', reservation_id='{self.reservation_id}')>"
 
-# Crear el motor de la base de datos
-engine = create_engine(DATABASE_URL)
+# --- POOL DE CONEXIONES DE LA DB ---
+# Cada proceso usa a la vez como mucho una conexión por hilo de solicitudes (DB_REQUEST_THREADS, p. ej. el
+# --threads de gunicorn), por hilo del drenador del outbox y por hilo de destinos, más la del calentamiento:
+# el pool se dimensiona para eso. En el servidor hay (DB_POOL_SIZE + DB_MAX_OVERFLOW) × procesos
+# conexiones como máximo, que deben caber en max_connections de PostgreSQL.
+DB_REQUEST_THREADS = int(os.getenv("DB_REQUEST_THREADS", 4))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", DB_REQUEST_THREADS + OUTBOX_WORKERS + SHEETS_TARGET_CONCURRENCY + 1))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 4))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", 10)) # Espera máxima por una conexión libre
+# Render cierra las conexiones inactivas: se reciclan antes de ese plazo y se comprueban (SELECT 1) al
+# sacarlas del pool. El ping es un viaje más a la DB por solicitud; con DB_POOL_PRE_PING=False se ahorra
+# y queda solo el reciclado, que basta si DB_POOL_RECYCLE_SECONDS es menor que el cierre por inactividad.
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", 300))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "True") == "True"
+
+# El motor de la base de datos (SQLite, solo en local, se queda con su pool por defecto) se crea con el
+# primer uso y no al importar: así importar app.py (app_async.py, los scripts, las pruebas) no abre un
+# pool, y cada worker de gunicorn crea el suyo tras el fork.
+_engine = None
+_autocommit_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine, _autocommit_engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if DATABASE_URL.startswith("sqlite"):
+                    new_engine = create_engine(DATABASE_URL, pool_pre_ping=DB_POOL_PRE_PING)
+                else:
+                    new_engine = create_engine(
+                        DATABASE_URL,
+                        pool_size=DB_POOL_SIZE,
+                        max_overflow=DB_MAX_OVERFLOW,
+                        pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+                        pool_recycle=DB_POOL_RECYCLE_SECONDS,
+                        pool_pre_ping=DB_POOL_PRE_PING,
+                    )
+                instrument_db_pool(new_engine.pool, "sync")
+                # Mismo pool, pero cada sentencia se confirma sola: una lectura o un upsert sueltos son un único
+                # viaje a la DB (sin BEGIN ni COMMIT) y no dejan una transacción abierta mientras se espera a Sheets.
+                _autocommit_engine = new_engine.execution_options(isolation_level="AUTOCOMMIT")
+                _engine = new_engine
+    return _engine
+
+def get_autocommit_engine():
+    get_engine()
+    return _autocommit_engine
+
+# Ocupación del pool en cada scrape; 'engine' distingue el motor síncrono del asíncrono (app_async.py)
+def db_pool_metrics(pool, engine_label):
+    if not isinstance(pool, QueuePool):
+        return []
+    labels = {"engine": engine_label}
+    return [
+        ("db_pool_size", labels, pool.size()),
+        ("db_pool_checked_out", labels, pool.checkedout()),
+        ("db_pool_idle", labels, pool.checkedin()),
+        ("db_pool_overflow", labels, max(pool.overflow(), 0)),
+    ]
+
+# Conexiones abiertas y descartadas (p. ej. cerradas por el servidor y detectadas por el ping o al usarlas)
+def instrument_db_pool(pool, engine_label):
+    event.listen(pool, "connect", lambda *args: metrics.inc("db_pool_connections_opened_total", engine=engine_label))
+    event.listen(pool, "invalidate", lambda *args: metrics.inc("db_pool_connections_invalidated_total", engine=engine_label))
+    metrics.register_collector(lambda: db_pool_metrics(pool, engine_label))
+
+metrics.describe("db_pool_size", "gauge", "Conexiones permanentes del pool de la DB.")
+metrics.describe("db_pool_checked_out", "gauge", "Conexiones del pool de la DB en uso ahora mismo.")
+metrics.describe("db_pool_idle", "gauge", "Conexiones del pool de la DB abiertas y libres.")
+metrics.describe("db_pool_overflow", "gauge", "Conexiones abiertas por encima de DB_POOL_SIZE (hasta DB_MAX_OVERFLOW).")
+metrics.describe("db_pool_connections_opened_total", "counter", "Conexiones nuevas abiertas por el pool de la DB.")
+metrics.describe("db_pool_connections_invalidated_total", "counter", "Conexiones del pool descartadas por estar cerradas o rotas.")
 
 # --- Gestión de Sesiones de SQLAlchemy (Mejora para estabilidad de memoria) ---
+# Las sesiones piden el motor al conectarse (no al crearse), así que no obligan a crearlo al importar.
+class EngineSession(SqlAlchemySession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return get_engine()
+
 # Usa scoped_session. Esto asegura que cada "hilo" de trabajo (cada solicitud HTTP)
 # obtenga su propia sesión de base de datos y que se gestione de forma segura.
-Session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+Session = scoped_session(sessionmaker(class_=EngineSession, autocommit=False, autoflush=False))
+
+# Sesiones del drenador del outbox: los registros reclamados se siguen usando tras el commit del reclamo
+# (payload, reservation_id, attempts), así que no se expiran al confirmar para no releerlos uno a uno.
+OutboxSession = sessionmaker(class_=EngineSession, autocommit=False, autoflush=False, expire_on_commit=False)
+
+# Conexión para una sentencia suelta de los helpers del índice y del outbox: en autocommit si la sesión
+# del hilo no tiene una transacción abierta; si la tiene, dentro de ella y con commit (como antes), para
+# que un hilo no ocupe nunca dos conexiones del pool a la vez.
+@contextmanager
+def db_connection():
+    session = Session()
+    if not session.in_transaction():
+        with get_autocommit_engine().connect() as connection:
+            yield connection
+        return
+    try:
+        yield session.connection()
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
 
 # --- Cierre de Sesiones de SQLAlchemy (Mejora para estabilidad de memoria) ---
 # Este decorador de Flask asegura que la sesión de la base de datos se elimine
@@ -88,98 +1246,708 @@ Session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=en
 @app.teardown_appcontext
 def remove_db_session(exception=None):
     Session.remove()
-    # print("INFO: SQLAlchemy Session removed for this request.") # Descomentar para depuración si es necesario
+    # logger.debug("INFO: SQLAlchemy Session removed for this request.") # Descomentar para depuración si es necesario
 
 # --- Funciones Auxiliares para la Base de Datos ---
 
+SCHEMA_LOCK_KEY = 720264101 # pg_advisory_lock que serializa create_db_tables entre procesos
+
+# Con varios workers de gunicorn cada proceso asegura las tablas al arrancar: en PostgreSQL lo hacen de
+# uno en uno (el resto ya encuentra las tablas y columnas creadas); SQLite es solo para un proceso local.
+@contextmanager
+def schema_lock():
+    engine = get_engine()
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            connection.commit()
+
 # Función para asegurar que la tabla 'reservation_index' exista en la DB
-# Esta función DEBE llamarse una sola vez al inicio de la aplicación.
+# Se llama una vez por proceso al arrancar (ver start_process_services).
 def create_db_tables():
     try:
-        Base.metadata.create_all(engine)
-        print("✅ Tabla 'reservation_index' asegurada en la base de datos.")
+        with schema_lock():
+            Base.metadata.create_all(get_engine())
+            add_missing_columns()
+            migrate_reservation_index_targets()
+            ensure_outbox_shards()
+        logger.info("Tablas de la base de datos aseguradas", extra=log_fields(tables=sorted(Base.metadata.tables)))
     except Exception as e:
-        print(f"❌ Error al intentar crear/verificar tabla de la DB: {e}. Esto podría causar problemas.")
+        logger.error("Error al crear/verificar las tablas de la DB", extra=log_fields(error=str(e)))
 
-# Busca un reservation_id en la base de datos y devuelve su número de fila en Sheets
-def find_reservation_row_in_db(reservation_id):
-    # Ya no necesitas 'session = Session()' y 'session.close()', scoped_session lo maneja.
+# create_all no modifica tablas que ya existen: las columnas nuevas (siempre opcionales) de los
+# modelos se añaden aquí con ALTER TABLE ... ADD COLUMN.
+def add_missing_columns():
+    engine = get_engine()
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+                    for index in table.indexes:
+                        if column.name in index.columns:
+                            index.create(connection, checkfirst=True)
+                    logger.info("Columna añadida a la base de datos", extra=log_fields(table=table.name, column=column.name))
+
+# Antes el índice era único por reservation_id y todo iba a SPREADSHEET_ID / RANGE_NAME: las filas
+# sin destino se asignan al destino por defecto y el índice único pasa a ser (target, reservation_id).
+def migrate_reservation_index_targets():
+    with get_engine().begin() as connection:
+        assigned = connection.execute(
+            update(ReservationIndex).where(ReservationIndex.target == None).values(target=target_key(DEFAULT_SHEET_TARGET))
+        ).rowcount
+        if assigned:
+            logger.info("Reservas del índice asignadas al destino por defecto", extra=log_fields(reservations=assigned, target=target_key(DEFAULT_SHEET_TARGET)))
+        for index in inspect(connection).get_indexes(ReservationIndex.__tablename__):
+            if index["unique"] and index["column_names"] == ["reservation_id"]:
+                connection.execute(text(f"DROP INDEX {index['name']}"))
+                logger.info("Índice único sustituido por (target, reservation_id)", extra=log_fields(index=index["name"]))
+        for index in ReservationIndex.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+# Crea las filas de lease de los shards y asigna shard a las filas del outbox encoladas antes de existir la columna
+def ensure_outbox_shards():
+    session = Session()
     try:
-        record = Session().query(ReservationIndex).filter_by(reservation_id=str(reservation_id)).first()
-        if record:
-            return record.sheet_row_number
-        return None
+        unassigned = session.query(WebhookOutbox).filter(WebhookOutbox.shard == None).all()
+        for record in unassigned:
+            record.shard = outbox_shard(record.reservation_id)
+        known_shards = set(range(OUTBOX_SHARDS))
+        known_shards.update(shard for (shard,) in session.query(distinct(WebhookOutbox.shard)))
+        stmt = dialect_insert(OutboxShardLease.__table__).values([{"shard": shard} for shard in sorted(known_shards)])
+        session.execute(stmt.on_conflict_do_nothing(index_elements=["shard"]))
+        session.commit()
+        if unassigned:
+            logger.info("Shard asignado a webhooks pendientes del outbox", extra=log_fields(events=len(unassigned)))
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+# --- Caché LRU en memoria del índice de reservas ---
+# Una entrada del índice (IndexEntry) tiene la ubicación de la fila (número de fila, destino y sheetId del
+# ancla), la marca de tiempo de Guesty de lo último escrito (eventos atrasados) y la huella de la fila
+# escrita (row_hash y, si se guarda, row_data en JSON). La caché guarda la entrada completa: se llena al
+# escribir en el índice (write-through) y al arrancar con un único SELECT, y los caminos calientes
+# (update_google_sheets y flush_sheets_batch) solo van a la DB si la reserva no está en caché.
+# Otro proceso puede escribir la misma reserva (los shards cambian de dueño, reconstruir_indice.py borra
+# huellas), así que cada entrada caduca a los RESERVATION_CACHE_TTL_SECONDS y se vuelve a leer de la DB;
+# ante cualquier error al escribir el índice se invalida.
+IndexEntry = namedtuple("IndexEntry", ["sheet_row_number", "last_event_at", "row_hash", "row_data", "target", "sheet_id"])
+
+# Columnas de 'reservation_index' que se leen para construir (reservation_id, IndexEntry)
+INDEX_ENTRY_COLUMNS = (
+    ReservationIndex.reservation_id, ReservationIndex.sheet_row_number, ReservationIndex.last_event_at,
+    ReservationIndex.row_hash, ReservationIndex.row_data, ReservationIndex.target, ReservationIndex.sheet_id,
+)
+
+class ReservationRowCache:
+    def __init__(self, max_size, ttl_seconds=0):
+        self._max_size = max_size
+        self._ttl = ttl_seconds
+        self._entries = OrderedDict() # reservation_id -> (instante de carga, IndexEntry)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, loaded_at):
+        return self._ttl <= 0 or time.monotonic() - loaded_at < self._ttl
+
+    # La entrada vigente o None (si no está o ha caducado, que cuenta como fallo)
+    def get(self, reservation_id):
+        with self._lock:
+            cached = self._entries.get(reservation_id)
+            if cached is None or not self._fresh(cached[0]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(reservation_id)
+            self.hits += 1
+            return cached[1]
+
+    # La entrada aunque haya caducado, sin contar acierto ni fallo: su destino sirve para elegir pestaña
+    def peek(self, reservation_id):
+        with self._lock:
+            cached = self._entries.get(reservation_id)
+            return cached[1] if cached is not None else None
+
+    def put(self, reservation_id, entry):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[reservation_id] = (time.monotonic(), entry)
+            self._entries.move_to_end(reservation_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    # Cambia algunos campos de la entrada en caché si es del mismo destino (sin renovar su caducidad);
+    # si no lo es o no está, la descarta para que se relea de la DB
+    def update(self, reservation_id, **fields):
+        with self._lock:
+            cached = self._entries.get(reservation_id)
+            if cached is None or cached[1].target != fields.get("target", cached[1].target):
+                self._entries.pop(reservation_id, None)
+                return
+            self._entries[reservation_id] = (cached[0], cached[1]._replace(**fields))
+
+    # Carga desde la DB sin pisar lo que ya se haya escrito por write-through mientras tanto.
+    # Las entradas precargadas quedan como las menos recientes (primeras en ser desalojadas).
+    def warm(self, reservation_id, entry):
+        if self._max_size <= 0:
+            return False
+        with self._lock:
+            if reservation_id in self._entries or len(self._entries) >= self._max_size:
+                return False
+            self._entries[reservation_id] = (time.monotonic(), entry)
+            self._entries.move_to_end(reservation_id, last=False)
+            return True
+
+    def invalidate(self, reservation_id):
+        with self._lock:
+            self._entries.pop(reservation_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self._max_size, "hits": self.hits, "misses": self.misses}
+
+reservation_row_cache = ReservationRowCache(RESERVATION_CACHE_SIZE, RESERVATION_CACHE_TTL_SECONDS)
+
+def reservation_cache_metrics():
+    stats = reservation_row_cache.stats()
+    return [
+        ("reservation_cache_hits_total", {}, stats["hits"]),
+        ("reservation_cache_misses_total", {}, stats["misses"]),
+        ("reservation_cache_size", {}, stats["size"]),
+    ]
+
+metrics.register_collector(reservation_cache_metrics)
+
+# Precarga la caché con un único SELECT de INDEX_ENTRY_COLUMNS de todo el índice
+def warm_reservation_cache():
+    if RESERVATION_CACHE_SIZE <= 0:
+        return
+    try:
+        query = (
+            Session().query(*INDEX_ENTRY_COLUMNS)
+            .order_by(ReservationIndex.id.desc()) # Las reservas más recientes son las que más se actualizan
+            .limit(RESERVATION_CACHE_SIZE)
+            .yield_per(5000)
+        )
+        loaded = 0
+        for reservation_id, *entry_fields in query:
+            if reservation_row_cache.warm(reservation_id, IndexEntry(*entry_fields)):
+                loaded += 1
+        logger.info("Caché del índice precargada", extra=log_fields(reservations=loaded))
     except Exception as e:
-        print(f"❌ Error buscando en la DB el ID '{reservation_id}': {e}")
+        Session().rollback()
+        logger.error("Error precargando la caché del índice", extra=log_fields(error=str(e)))
+
+# Todas las entradas del índice de un bloque de reservas, en orden de indexación
+def index_entries_select(reservation_ids):
+    return (
+        select(*INDEX_ENTRY_COLUMNS).where(ReservationIndex.reservation_id.in_([str(reservation_id) for reservation_id in reservation_ids]))
+        .order_by(ReservationIndex.id)
+    )
+
+# {reservation_id: IndexEntry} a partir de las filas de index_entries_select. Si una reserva está en varias
+# pestañas gana la del destino que tenía en caché y, sin él, la última indexada. Lo leído entra en la caché.
+def index_entries_from_rows(rows):
+    candidates = {}
+    for found_id, *entry_fields in rows:
+        candidates.setdefault(found_id, []).append(IndexEntry(*entry_fields))
+    known_entries = {}
+    for reservation_id, entries in candidates.items():
+        cached = reservation_row_cache.peek(reservation_id)
+        pinned = [entry for entry in entries if cached is not None and entry.target == cached.target]
+        known_entries[reservation_id] = (pinned or entries)[-1]
+        reservation_row_cache.put(reservation_id, known_entries[reservation_id])
+    return known_entries
+
+# Reparte un bloque de reservas entre las que están en caché ({reservation_id: IndexEntry}) y las que hay
+# que buscar en la DB
+def cached_index_entries(reservation_ids):
+    known_entries, missing = {}, []
+    for reservation_id in dict.fromkeys(str(reservation_id) for reservation_id in reservation_ids):
+        entry = reservation_row_cache.get(reservation_id)
+        if entry is None:
+            missing.append(reservation_id)
+        else:
+            known_entries[reservation_id] = entry
+    return known_entries, missing
+
+# IndexEntry de un reservation_id (o None): de la caché o, si no está, del índice de la DB
+@metrics.timer("webhook_stage_duration_seconds", stage="find_row")
+def find_reservation_in_db(reservation_id):
+    entry = reservation_row_cache.get(str(reservation_id))
+    if entry is not None:
+        return entry
+    try:
+        with db_connection() as connection:
+            rows = connection.execute(index_entries_select([reservation_id])).all()
+        return index_entries_from_rows(rows).get(str(reservation_id))
+    except Exception as e:
+        logger.error("Error buscando la reserva en el índice de la DB", extra=log_fields(reservation_id=reservation_id, error=str(e)))
         return None
 
-# Añade un nuevo registro de reserva (ID de Guesty y número de fila de Sheets) a la DB
-def add_reservation_to_db(reservation_id, sheet_row_number):
+# Igual para un bloque de reservas: las que no están en caché se leen con un único SELECT ... IN (...).
+# Devuelve {reservation_id: IndexEntry} solo con las indexadas.
+def find_reservations_in_db(reservation_ids):
+    known_entries, missing = cached_index_entries(reservation_ids)
+    if missing:
+        with db_connection() as connection:
+            rows = connection.execute(index_entries_select(missing)).all()
+        known_entries.update(index_entries_from_rows(rows))
+    return known_entries
+
+# Número de fila en Sheets de un reservation_id (de la caché o de la DB)
+def find_reservation_row_in_db(reservation_id):
+    entry = find_reservation_in_db(reservation_id)
+    return entry.sheet_row_number if entry else None
+
+# Añade (o, si ya estaba en ese destino, actualiza) una reserva del índice con un único
+# INSERT ... ON CONFLICT ... RETURNING en autocommit, con la huella de 'row_data' si se conoce lo que
+# se acaba de escribir en la fila. La caché se llena con lo que devuelve la DB.
+def add_reservation_to_db(reservation_id, sheet_row_number, last_event_at=None, row_data=None, target=DEFAULT_SHEET_TARGET, sheet_id=None):
     try:
-        new_record = ReservationIndex(reservation_id=str(reservation_id), sheet_row_number=sheet_row_number)
-        Session().add(new_record)
-        Session().commit() # Importante hacer commit en la misma sesión
-        print(f"✅ Reserva {reservation_id} (fila {sheet_row_number}) añadida al índice de la base de datos.")
+        fingerprint = row_fingerprint_columns(row_data) if row_data is not None else {"row_hash": None, "row_data": None}
+        row = {
+            "target": target_key(target), "reservation_id": str(reservation_id), "sheet_row_number": sheet_row_number,
+            "last_event_at": last_event_at, **fingerprint, "sheet_id": sheet_id,
+        }
+        with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+            with db_connection() as connection:
+                found_id, *entry_fields = connection.execute(
+                    reservation_index_upsert_stmt([row]).returning(*INDEX_ENTRY_COLUMNS)
+                ).one()
+        reservation_row_cache.put(found_id, IndexEntry(*entry_fields))
+        logger.info("Reserva añadida al índice de la DB", extra=log_fields(reservation_id=reservation_id, row=sheet_row_number))
     except Exception as e:
-        Session().rollback() # Si hay un error, deshace la transacción
-        print(f"❌ Error añadiendo reserva a la DB '{reservation_id}': {e}")
+        reservation_row_cache.invalidate(str(reservation_id)) # La DB manda: se relee en la próxima búsqueda
+        logger.error("Error añadiendo la reserva al índice de la DB", extra=log_fields(reservation_id=reservation_id, error=str(e)))
 
-# Actualiza el número de fila de una reserva existente en la DB
+# Actualiza el número de fila de una reserva existente en la DB (su entrada más reciente) con un
+# único UPDATE ... RETURNING
 def update_reservation_in_db(reservation_id, new_sheet_row_number):
     try:
-        record = Session().query(ReservationIndex).filter_by(reservation_id=str(reservation_id)).first()
+        latest_id = (
+            select(func.max(ReservationIndex.id)).where(ReservationIndex.reservation_id == str(reservation_id)).scalar_subquery()
+        )
+        with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+            with db_connection() as connection:
+                record = connection.execute(
+                    update(ReservationIndex).where(ReservationIndex.id == latest_id)
+                    .values(sheet_row_number=new_sheet_row_number).returning(*INDEX_ENTRY_COLUMNS)
+                ).first()
         if record:
-            record.sheet_row_number = new_sheet_row_number
-            Session().commit() # Importante hacer commit en la misma sesión
-            print(f"✅ Reserva {reservation_id} actualizada en la base de datos a fila {new_sheet_row_number}.")
+            found_id, *entry_fields = record
+            reservation_row_cache.put(found_id, IndexEntry(*entry_fields))
+            logger.info("Fila de la reserva actualizada en el índice de la DB", extra=log_fields(reservation_id=reservation_id, row=new_sheet_row_number))
         else:
-            print(f"⚠️ Reserva {reservation_id} no encontrada en DB para actualizar, añadiendo en su lugar.")
-            add_reservation_to_db(reservation_id, new_sheet_row_number)
+            logger.warning("Reserva no encontrada en el índice para actualizar: se añade", extra=log_fields(reservation_id=reservation_id))
+            add_reservation_to_db(reservation_id, new_sheet_row_number) # En el destino por defecto
     except Exception as e:
+        reservation_row_cache.invalidate(str(reservation_id))
+        logger.error("Error actualizando la reserva en el índice de la DB", extra=log_fields(reservation_id=reservation_id, error=str(e)))
+
+# INSERT ... ON CONFLICT del dialecto en uso (PostgreSQL en Render, SQLite en local)
+def dialect_insert(table):
+    dialect_name = get_engine().dialect.name
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upsert no soportado para el dialecto '{dialect_name}'.")
+    return insert(table)
+
+# Sentencia INSERT ... ON CONFLICT para muchas filas del índice. 'rows' es una lista de dicts
+# con 'target', 'reservation_id', 'sheet_row_number' y opcionalmente 'last_event_at', 'row_hash',
+# 'row_data' y 'sheet_id' (las mismas claves en todas), sin (target, reservation_id) repetidos; en conflicto solo
+# se actualizan las columnas presentes.
+def reservation_index_upsert_stmt(rows):
+    stmt = dialect_insert(ReservationIndex.__table__).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=["target", "reservation_id"],
+        set_={column: stmt.excluded[column] for column in rows[0] if column not in ("target", "reservation_id")}
+    )
+
+# Mantiene la caché en línea con lo que se acaba de escribir en el índice: una fila con todas las columnas
+# es la entrada completa; con solo algunas (p. ej. la ubicación) se cambian esas en la entrada en caché
+def cache_index_rows(rows):
+    for row in rows:
+        fields = {field: row[field] for field in IndexEntry._fields if field in row}
+        if len(fields) == len(IndexEntry._fields):
+            reservation_row_cache.put(row["reservation_id"], IndexEntry(**fields))
+        else:
+            reservation_row_cache.update(row["reservation_id"], **fields)
+
+# Inserta o actualiza muchas filas del índice con una sola sentencia INSERT ... ON CONFLICT
+def upsert_reservation_index(rows):
+    if not rows:
+        return
+    try:
+        Session().execute(reservation_index_upsert_stmt(rows))
+        with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+            Session().commit()
+    except Exception:
         Session().rollback()
-        print(f"❌ Error actualizando reserva en la DB '{reservation_id}': {e}")
+        for row in rows:
+            reservation_row_cache.invalidate(row["reservation_id"])
+        raise
+    cache_index_rows(rows)
 
 # --- Función para asegurar la fila de encabezado en Google Sheets ---
-# Esta función se llama UNA SOLA VEZ al inicio de la aplicación.
+# Esta función se llama UNA SOLA VEZ al inicio de la aplicación (para el destino por defecto, o para
+# su pestaña de registro en modo 'log': la de estado actual la escribe entera la compactación).
 def ensure_header_row_exists_global():
+    if SHEETS_SINK_MODE == "log":
+        ensure_log_tab(DEFAULT_SHEET_TARGET)
+    else:
+        ensure_header_row(DEFAULT_SHEET_TARGET)
+
+def ensure_header_row(target, header=None):
+    header = header or field_names
     if sheets_service is None:
-        print("🚫 Servicio de Google Sheets no inicializado. No se puede verificar/añadir encabezado.")
+        logger.error("Servicio de Google Sheets no inicializado: no se puede verificar el encabezado")
         raise RuntimeError("Servicio de Google Sheets no disponible.")
 
     sheet_instance = sheets_service.spreadsheets()
 
     try:
         # Lee solo la primera fila para verificar el encabezado
-        result = sheet_instance.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{RANGE_NAME}!A1:{chr(64 + len(field_names))}1" # Lee el rango exacto del encabezado
-        ).execute()
+        result = execute_sheets(sheet_instance.values().get(
+            spreadsheetId=target.spreadsheet_id,
+            range=a1_range(target.tab, f"A1:{column_letter(len(header))}1") # Lee el rango exacto del encabezado
+        ), "sheets_header", kind="read")
         values = result.get("values", [])
 
-        if not values or values[0] != field_names:
-            print("Header row missing or incorrect. Adding/Updating header.")
-            body = {"values": [field_names]}
-            sheet_instance.values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{RANGE_NAME}!A1",
+        if not values or values[0] != header:
+            logger.info("Encabezado ausente o incorrecto: se escribe", extra=log_fields(tab=target.tab))
+            body = {"values": [header]}
+            execute_sheets(sheet_instance.values().update(
+                spreadsheetId=target.spreadsheet_id,
+                range=a1_range(target.tab, "A1"),
                 valueInputOption="RAW",
                 body=body
-            ).execute()
-            print("✅ Header row ensured in Google Sheets")
+            ), "sheets_header")
+            logger.info("Encabezado escrito en Google Sheets", extra=log_fields(tab=target.tab))
         else:
-            print("✅ Header row already exists and is correct in Google Sheets")
+            logger.info("Encabezado ya correcto en Google Sheets", extra=log_fields(tab=target.tab))
 
     except HttpError as error:
-        print(f"❌ An error occurred with Google Sheets API during header check: {error}")
+        logger.error("Error de la API de Google Sheets comprobando el encabezado", extra=log_fields(status=http_error_status(error), error=str(error)))
         raise
     except Exception as e:
-        print(f"❌ Error ensuring header row exists: {str(e)}")
+        logger.error("Error asegurando el encabezado", extra=log_fields(error=str(e)))
         raise
 
+# --- PESTAÑAS DE DESTINO Y ROLLOVER ---
+
+# Crea la pestaña si aún no existe en la hoja y se asegura de que tenga el encabezado
+def ensure_sheet_tab(target, header=None):
+    sheet_instance = sheets_service.spreadsheets()
+    result = execute_sheets(sheet_instance.get(
+        spreadsheetId=target.spreadsheet_id,
+        fields="sheets.properties.title"
+    ), "sheets_tabs", kind="read")
+    titles = {sheet.get("properties", {}).get("title") for sheet in result.get("sheets", [])}
+    if target.tab not in titles:
+        try:
+            execute_sheets(sheet_instance.batchUpdate(
+                spreadsheetId=target.spreadsheet_id,
+                body={"requests": [{"addSheet": {"properties": {"title": target.tab}}}]}
+            ), "sheets_tabs")
+            logger.info("Pestaña creada", extra=log_fields(spreadsheet_id=target.spreadsheet_id, tab=target.tab))
+        except HttpError as error:
+            if http_error_status(error) != 400: # 400: otro worker la acaba de crear
+                raise
+    ensure_header_row(target, header)
+
+# Pestaña concreta en la que se añaden ahora las reservas nuevas de 'route' (su pestaña base o la
+# última creada por rollover). Cuando la actual llega a SHEETS_TAB_MAX_ROWS filas crea la siguiente.
+def active_append_target(route):
+    session = Session()
+    route_key = target_key(route)
+    while True:
+        current = session.query(SheetTab).filter_by(route=route_key).order_by(SheetTab.sequence.desc()).first()
+        if current and (SHEETS_TAB_MAX_ROWS <= 0 or current.row_count < SHEETS_TAB_MAX_ROWS):
+            return parse_target_key(current.target)
+        sequence = current.sequence + 1 if current else 1
+        target = rollover_target(route, sequence)
+        ensure_sheet_tab(target)
+        # Una pestaña que ya existía (p. ej. la de siempre, antes del enrutado) parte de las filas ya indexadas
+        row_count = session.query(func.max(ReservationIndex.sheet_row_number)).filter(
+            ReservationIndex.target == target_key(target)
+        ).scalar() or 1
+        session.execute(dialect_insert(SheetTab.__table__).values(
+            target=target_key(target), route=route_key, sequence=sequence, row_count=row_count
+        ).on_conflict_do_nothing(index_elements=["target"]))
+        session.commit()
+        if current:
+            logger.info("Rollover de pestaña: las reservas nuevas van a la siguiente", extra=log_fields(target=current.target, rows=current.row_count, tab=target.tab))
+
+# Sentencia que apunta la última fila ocupada de una pestaña tras un append
+def sheet_tab_rows_stmt(target, last_row):
+    return (
+        update(SheetTab)
+        .where(SheetTab.target == target_key(target), SheetTab.row_count < last_row)
+        .values(row_count=last_row)
+    )
+
+def record_appended_rows(target, last_row):
+    try:
+        with db_connection() as connection:
+            connection.execute(sheet_tab_rows_stmt(target, last_row))
+    except Exception as e:
+        logger.error("Error guardando la ocupación de la pestaña", extra=log_fields(tab=target.tab, error=str(e)))
+
+# --- Extracción de la fila de datos desde el webhook de Guesty ---
+# Devuelve la fila en el ORDEN DEFINIDO por 'SHEET_FIELDS'. Se comparte entre la escritura
+# directa (update_google_sheets) y la cola de escritura diferida.
+def build_row_data(data):
+    return extract_row_data(data)
+
+# --- HUELLA DE FILA: SE OMITEN LAS ESCRITURAS QUE NO CAMBIAN NADA ---
+
+def row_data_json(row_data):
+    return json.dumps(row_data, ensure_ascii=False, default=str, separators=(",", ":"))
+
+# Hash de las columnas no volátiles de la fila: lo que de verdad cambió en la reserva
+def row_fingerprint(row_data):
+    material = [value for index, value in enumerate(row_data) if index not in VOLATILE_COLUMN_INDEXES]
+    return hashlib.blake2b(row_data_json(material).encode(), digest_size=16).hexdigest()
+
+# Columnas 'row_hash' y 'row_data' del índice para una fila recién escrita en Sheets
+def row_fingerprint_columns(row_data):
+    return {"row_hash": row_fingerprint(row_data), "row_data": row_data_json(row_data) if SHEETS_STORE_ROW_DATA else None}
+
+# Rangos de values().batchUpdate para llevar la fila de 'index_entry' (en su pestaña) a 'row_data',
+# comparando con lo último escrito, y el tipo de escritura ('skipped', 'partial' o 'full'). Si se conoce
+# la fila anterior solo se escriben los tramos de columnas contiguas que cambian (más las volátiles, para
+# que event/eventId digan qué evento hizo el cambio); sin huella o con demasiados tramos, la fila completa.
+def row_update_ranges(index_entry, row_data):
+    row_number, tab = index_entry.sheet_row_number, parse_target_key(index_entry.target).tab
+    full_row = [{"range": a1_range(tab, f"A{row_number}:{LAST_COLUMN}{row_number}"), "values": [row_data]}]
+    if not SHEETS_SKIP_UNCHANGED_ROWS or not index_entry.row_hash:
+        return full_row, "full"
+    if index_entry.row_hash == row_fingerprint(row_data):
+        return [], "skipped"
+    if SHEETS_PARTIAL_WRITE_MAX_RANGES <= 0 or not index_entry.row_data:
+        return full_row, "full"
+    previous = json_loads(index_entry.row_data)
+    current = json_loads(row_data_json(row_data)) # Misma normalización que lo guardado
+    if len(previous) != len(current):
+        return full_row, "full" # Cambió el mapeo de columnas desde la última escritura
+
+    runs = []
+    for index in sorted(VOLATILE_COLUMN_INDEXES.union(i for i, value in enumerate(current) if value != previous[i])):
+        if runs and runs[-1][1] == index - 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+    if len(runs) > SHEETS_PARTIAL_WRITE_MAX_RANGES:
+        return full_row, "full"
+    return [
+        {"range": a1_range(tab, f"{column_letter(start + 1)}{row_number}:{column_letter(end + 1)}{row_number}"), "values": [row_data[start:end + 1]]}
+        for start, end in runs
+    ], "partial"
+
+# Fila del índice tras procesar un evento de una reserva ya indexada, o None si no hay nada que guardar.
+# Si no se escribió en Sheets se conserva la huella anterior y solo avanza la marca de tiempo.
+def updated_index_row(reservation_id, index_entry, row_data, last_event_at, written):
+    last_event_at = last_event_at or index_entry.last_event_at
+    if not written and last_event_at == index_entry.last_event_at:
+        return None
+    fingerprint = row_fingerprint_columns(row_data) if written else {"row_hash": index_entry.row_hash, "row_data": index_entry.row_data}
+    return {
+        "target": index_entry.target, "reservation_id": str(reservation_id), "sheet_row_number": index_entry.sheet_row_number,
+        "last_event_at": last_event_at, **fingerprint, "sheet_id": index_entry.sheet_id,
+    }
+
+# Extrae el número de la primera fila de un rango como 'test!A10:X12' (respuesta de values().append)
+def parse_updated_range_start_row(updated_range):
+    return int(updated_range.rsplit('!', 1)[1].split(':')[0].strip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+
+# --- ESPEJO LOCAL DE LA HOJA: LECTURAS SIN LLAMAR A SHEETS (/reservations) ---
+# Cada escritura en Sheets (directa, write-behind o modo 'log') deja también la fila completa en
+# 'reservation_mirror', así las herramientas internas consultan la DB en lugar de la API de Sheets.
+# Las reservas que no se han vuelto a escribir desde que existe la tabla se cargan reproduciendo el
+# historial con reproducir_historial.py.
+RESERVATIONS_PAGE_SIZE = int(os.getenv("RESERVATIONS_PAGE_SIZE", 100))
+RESERVATIONS_PAGE_MAX_SIZE = int(os.getenv("RESERVATIONS_PAGE_MAX_SIZE", 1000))
+# /reservations exige 'Authorization: Bearer <RESERVATIONS_API_TOKEN>'. Sin token configurado la ruta
+# responde 401 a todo: el espejo no queda expuesto por olvidar la variable.
+RESERVATIONS_API_TOKEN = os.getenv("RESERVATIONS_API_TOKEN", "")
+# Columnas con datos personales del huésped: solo se devuelven con includePii=true
+RESERVATIONS_PII_COLUMNS = frozenset(
+    column.strip() for column in os.getenv("RESERVATIONS_PII_COLUMNS", "guestFirstName,guestLastName,guest_email,guest_phone").split(",") if column.strip()
+)
+
+# Columnas filtrables del espejo -> posición de la columna de la hoja de la que salen
+MIRROR_FILTER_COLUMNS = {
+    "listing_id": field_names.index("listingId"),
+    "check_in": field_names.index("checkIn"),
+    "status": field_names.index("reservationStatus"),
+}
+
+metrics.describe("reservation_mirror_rows_total", "counter", "Filas escritas en el espejo local de la hoja (reservation_mirror).")
+
+# Fila de 'reservation_mirror' para la fila de la hoja 'row_data' de una reserva en 'target' (SheetTarget o su clave)
+def reservation_mirror_row(reservation_id, row_data, last_event_at, target):
+    return {
+        "reservation_id": str(reservation_id),
+        "target": target if isinstance(target, str) else target_key(target),
+        **{column: str(row_data[index]) for column, index in MIRROR_FILTER_COLUMNS.items()},
+        "last_event_at": last_event_at,
+        "row_data": json_dumps(row_data, default=str),
+        "updated_at": utcnow(),
+    }
+
+# INSERT ... ON CONFLICT para muchas filas del espejo (sin reservation_id repetidos). Una versión de
+# Guesty más antigua que la guardada no la pisa; sin marca de tiempo manda el orden de escritura.
+def reservation_mirror_upsert_stmt(rows):
+    stmt = dialect_insert(ReservationMirror.__table__).values(rows)
+    stored_at = ReservationMirror.__table__.c.last_event_at
+    return stmt.on_conflict_do_update(
+        index_elements=["reservation_id"],
+        set_={column: stmt.excluded[column] for column in rows[0] if column != "reservation_id"},
+        where=or_(stored_at == None, stmt.excluded.last_event_at == None, stmt.excluded.last_event_at >= stored_at),
+    )
+
+# Filas del espejo tras entregar un bloque en modo 'rows': las reservas que ya estaban en la hoja (con o
+# sin cambios) y las recién añadidas, con la versión de este bloque. Las de un batchUpdate que falló
+# quedan fuera hasta que se reintente el bloque.
+def sheets_batch_mirror_rows(pending, known_entries, updates, index_rows):
+    written = {row["reservation_id"] for row in index_rows}
+    failed = {row["reservation_id"] for batch in updates.values() for row in batch["index_rows"]} - written
+    targets = {reservation_id: entry.target for reservation_id, entry in known_entries.items()}
+    targets.update((row["reservation_id"], row["target"]) for row in index_rows)
+    return [
+        reservation_mirror_row(reservation_id, pending[reservation_id]["row_data"], pending[reservation_id]["last_event_at"], target)
+        for reservation_id, target in targets.items() if reservation_id in pending and reservation_id not in failed
+    ]
+
+# Filas del espejo de un bloque en modo 'log': la versión más reciente de cada reserva en su pestaña de estado actual
+def log_batch_mirror_rows(events):
+    return [
+        reservation_mirror_row(reservation_id, entry["row_data"], entry["last_event_at"], entry["route"])
+        for reservation_id, entry in coalesce_events(events).items()
+    ]
+
+# Guarda filas en el espejo. Un fallo no afecta a lo ya escrito en Sheets: la reserva se corrige en su siguiente evento.
+def mirror_reservations(rows):
+    if not rows:
+        return
+    try:
+        with db_connection() as connection:
+            connection.execute(reservation_mirror_upsert_stmt(rows))
+        metrics.inc("reservation_mirror_rows_total", len(rows))
+    except Exception as e:
+        logger.error("Error guardando reservas en el espejo local de la hoja", extra=log_fields(reservations=len(rows), error=str(e)))
+
+# Cursor opaco de /reservations: la clave (check_in, reservation_id) de la última reserva de la página
+def encode_reservations_cursor(check_in, reservation_id):
+    return base64.urlsafe_b64encode(json_dumps([check_in, reservation_id]).encode("utf-8")).decode("ascii")
+
+def decode_reservations_cursor(cursor):
+    try:
+        check_in, reservation_id = json_loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("cursor no válido") from None
+    return str(check_in), str(reservation_id)
+
+# Cabecera Authorization de una solicitud a /reservations contra RESERVATIONS_API_TOKEN (comparación en tiempo constante)
+def reservations_authorized(authorization):
+    scheme, _, token = (authorization or "").partition(" ")
+    if not RESERVATIONS_API_TOKEN or scheme.lower() != "bearer":
+        return False
+    return hmac.compare_digest(token.strip().encode("utf-8"), RESERVATIONS_API_TOKEN.encode("utf-8"))
+
+# Parámetros de /reservations (request.args de Flask o query_params de Starlette): listingId,
+# checkInFrom (incluido), checkInTo (excluido), status (uno o varios separados por comas), limit y
+# cursor (el 'next_cursor' de la página anterior). ValueError si alguno no es válido. includePii=true
+# (aparte, ver reservations_include_pii) añade las columnas de RESERVATIONS_PII_COLUMNS.
+def parse_reservations_query(args):
+    limit = int(args.get("limit") or RESERVATIONS_PAGE_SIZE)
+    if not 1 <= limit <= RESERVATIONS_PAGE_MAX_SIZE:
+        raise ValueError(f"'limit' debe estar entre 1 y {RESERVATIONS_PAGE_MAX_SIZE}")
+    return {
+        "listing_id": args.get("listingId") or None,
+        "check_in_from": args.get("checkInFrom") or None,
+        "check_in_to": args.get("checkInTo") or None,
+        "statuses": [status.strip() for status in (args.get("status") or "").split(",") if status.strip()],
+        "cursor": decode_reservations_cursor(args["cursor"]) if args.get("cursor") else None,
+        "limit": limit,
+    }
+
+def reservations_include_pii(args):
+    value = (args.get("includePii") or "false").lower()
+    if value not in ("true", "false", "1", "0"):
+        raise ValueError("'includePii' debe ser true o false")
+    return value in ("true", "1")
+
+# SELECT de una página del espejo en orden (check_in, reservation_id), con paginación por clave (keyset):
+# cada página empieza justo después del cursor usando el índice, sin OFFSET. Se pide una fila de más
+# para saber si hay página siguiente.
+def reservations_page_select(listing_id=None, check_in_from=None, check_in_to=None, statuses=(), cursor=None, limit=RESERVATIONS_PAGE_SIZE):
+    columns = ReservationMirror.__table__.c
+    stmt = select(columns.reservation_id, columns.check_in, columns.target, columns.row_data)
+    if listing_id:
+        stmt = stmt.where(columns.listing_id == listing_id)
+    if statuses:
+        stmt = stmt.where(columns.status.in_(statuses))
+    if check_in_from:
+        stmt = stmt.where(columns.check_in >= check_in_from)
+    if check_in_to:
+        stmt = stmt.where(columns.check_in < check_in_to)
+    if cursor:
+        stmt = stmt.where(tuple_(columns.check_in, columns.reservation_id) > tuple_(*cursor))
+    return stmt.order_by(columns.check_in, columns.reservation_id).limit(limit + 1)
+
+# Respuesta de /reservations: cada reserva como {columna de la hoja: valor} (sin las columnas personales
+# salvo con 'include_pii') y el cursor de la siguiente página
+def reservations_page(rows, limit, include_pii=False):
+    page = rows[:limit]
+    excluded = frozenset() if include_pii else RESERVATIONS_PII_COLUMNS
+    return {
+        "reservations": [
+            {**{column: value for column, value in zip(field_names, json_loads(row.row_data)) if column not in excluded}, "sheetTarget": row.target}
+            for row in page
+        ],
+        "next_cursor": encode_reservations_cursor(page[-1].check_in, page[-1].reservation_id) if len(rows) > limit else None,
+    }
+
 # --- Función principal para actualizar Google Sheets (AHORA USANDO LA DB) ---
+# Sin cuota, con Sheets caído o con el shard ocupado, el evento de la escritura directa no se pierde ni se
+# pide a Guesty que lo reintente: pasa al outbox, que lo entregará con backoff. None si no se pudo encolar.
+def enqueue_direct_fallback(data, reason):
+    try:
+        if not enqueue_webhook(data, webhook_event_key(data)):
+            return {"message": f"Evento {webhook_event_key(data)} ya procesado"}, 200 # Reentrega ya encolada por otra solicitud
+        logger.warning("Escritura directa pasada al outbox", extra=log_fields(reason=reason, reservation_id=data.get("reservation", {}).get("_id")))
+        return {"message": "Google Sheets saturado: webhook encolado para reintento"}, 202
+    except Exception as e:
+        Session().rollback()
+        logger.error("Error encolando en el outbox la escritura directa", extra=log_fields(reason=reason, error=str(e)))
+        return None
+
 def update_google_sheets(data):
     if sheets_service == None :
-        print("🚫 Servicio de Google Sheets no inicializado. No se puede actualizar.")
+        logger.error("Servicio de Google Sheets no inicializado: no se puede actualizar")
         return {"message": "Server error: Google Sheets service not ready"}, 500
 
     sheet_instance = sheets_service.spreadsheets()
@@ -189,139 +1957,2014 @@ def update_google_sheets(data):
         reservation_data = data.get("reservation", {})
 
         if not reservation_data:
-            print("Reservation data is missing in the request")
+            logger.warning("Reservation data is missing in the request")
             return {"message": "Reservation data is missing"}, 400
 
         reservation_id = reservation_data.get("_id")
         if not reservation_id:
-            print("Reservation ID is missing in the reservation data")
+            logger.warning("Reservation ID is missing in the reservation data")
             return {"message": "Reservation ID is missing"}, 400
 
-        # --- Extracción de datos detallada desde el webhook de Guesty ---
-        event = data.get("event", "")
-        meta = data.get("meta", {})
-        eventId = meta.get("eventId", "")
-        messageId = meta.get("messageId", "")
-        # --- CAMBIO CLAVE 2: Extraer 'conversationId' del webhook data (nivel superior) ---
-        conversation_id = reservation_data.get("conversationId", "") # Extraer conversationId
-
-        account_id = reservation_data.get("accountId", "")
-        guest_id = reservation_data.get("guestId", "")
-        listing_id = reservation_data.get("listingId", "")
-        check_in = reservation_data.get("checkIn", "")
-        check_out = reservation_data.get("checkOut", "")
-        number_of_guests = reservation_data.get("guestsCount", 0)
-        platform = reservation_data.get("integration", {}).get("platform", "")
-        status = reservation_data.get("status", "")
-
-        guest_data = reservation_data.get("guest", {})
-        guest_first_name = guest_data.get("firstName", "")
-        guest_last_name = guest_data.get("lastName") or (guest_data.get("fullName", "").split()[-1] if guest_data.get("fullName") else "")
-
-        money_data = reservation_data.get("money", {})
-        total_amount = money_data.get("subTotalPrice", 0)
-        cleaning_fee = money_data.get("fareCleaning", 0)
-        service_fee = money_data.get("hostServiceFee", 0)
-        security_deposit = 0
-
-        listing_data = reservation_data.get("listing", {})
-        listing_name = listing_data.get("nickname", "") or listing_data.get("name", "")
-        listing_city = listing_data.get("address", {}).get("city", "")
-
-        guest_email = guest_data.get("emails", [""])[0] if guest_data.get("emails") else ""
-        guest_phone = guest_data.get("phones", [""])[0] if guest_data.get("phones") else ""
-
-        nights = reservation_data.get("nightsCount", 0)
-
-        # --- CAMBIO CLAVE 3: Incluir 'conversation_id' en la fila de datos en la misma posición ---
-        # Preparar la fila de datos en el ORDEN DEFINIDO por 'field_names'
-        row_data = [
-            event, eventId, messageId, reservation_id, account_id, guest_id, listing_id,
-            conversation_id, # <-- AÑADIDO AQUÍ, correspondiendo a la nueva columna H
-            check_in, check_out, number_of_guests, platform, status, guest_first_name,
-            guest_last_name, total_amount, cleaning_fee, service_fee, security_deposit,
-            listing_name, listing_city, guest_email, guest_phone, nights
-        ]
+        if SHEETS_SINK_MODE == "log":
+            flush_log_batch([data])
+            return {"message": f"Reserva {reservation_id} añadida al registro"}, 200
+
+        row_data = build_row_data(data)
 
         # --- Lógica de BÚSQUEDA en la Base de Datos AUXILIAR (¡RÁPIDA!) ---
-        row_index_to_update = find_reservation_row_in_db(reservation_id)
+        index_entry = find_reservation_in_db(reservation_id)
+        if index_entry is None and webhook_topic == "reservation.new":
+            index_entry = resolve_appends_in_doubt([reservation_id]).get(str(reservation_id))
+        row_index_to_update = index_entry.sheet_row_number if index_entry else None
+
+        if index_entry and is_stale_event(event_timestamp(data), index_entry.last_event_at):
+            logger.info("Evento atrasado ignorado: ya se escribió una versión más reciente", extra=log_fields(reservation_id=reservation_id))
+            return {"message": f"Evento atrasado para la reserva {reservation_id}, ignorado."}, 200
 
         # --- Lógica CONDICIONAL de acción basada en si se encontró y el 'topic' del webhook ---
         if row_index_to_update:
-            range_to_update = f"{RANGE_NAME}!A{row_index_to_update}:{chr(64 + len(field_names))}{row_index_to_update}"
-            update_body = {"values": [row_data]}
-            sheet_instance.values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=range_to_update,
-                valueInputOption="RAW",
-                body=update_body
-            ).execute()
-            print(f"✅ Updated row {row_index_to_update} with reservation ID {reservation_id} in Google Sheets")
+            target = parse_target_key(index_entry.target)
+            known_entries = {str(reservation_id): index_entry}
+            deleted_rows = locate_anchored_rows(known_entries, {str(reservation_id): row_data})
+            if deleted_rows:
+                forget_deleted_rows(deleted_rows)
+                return {"message": f"La fila de la reserva {reservation_id} se borró de la hoja: no se vuelve a escribir."}, 200
+            index_entry = known_entries[str(reservation_id)]
+            row_index_to_update = index_entry.sheet_row_number
+            value_ranges, write_mode = row_write_data(reservation_id, index_entry, row_data)
+            metrics.inc("sheets_row_writes_total", mode=write_mode)
+            index_row = updated_index_row(reservation_id, index_entry, row_data, event_timestamp(data), written=bool(value_ranges))
+            if SHEETS_ROW_ANCHORS and value_ranges:
+                result = execute_sheets(sheet_instance.values().batchUpdateByDataFilter(
+                    spreadsheetId=target.spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": value_ranges}
+                ), "sheets_update")
+                written_rows, missing_rows = reconcile_anchored_rows([index_row], value_ranges, result)
+                found_rows, deleted_rows = confirm_deleted_rows(missing_rows)
+                if deleted_rows:
+                    forget_deleted_rows(deleted_rows)
+                    return {"message": f"La fila de la reserva {reservation_id} se borró de la hoja: no se vuelve a escribir."}, 200
+                if found_rows:
+                    execute_sheets(sheet_instance.values().batchUpdate(
+                        spreadsheetId=target.spreadsheet_id,
+                        body={"valueInputOption": "RAW", "data": rewrite_found_rows_ranges(found_rows, {index_row["reservation_id"]: row_data})}
+                    ), "sheets_update")
+                logger.info("Fila actualizada en Google Sheets", extra=log_fields(reservation_id=reservation_id, row=index_row["sheet_row_number"], mode="full"))
+            elif write_mode == "full":
+                range_to_update = value_ranges[0]["range"]
+                update_body = {"values": [row_data]}
+                execute_sheets(sheet_instance.values().update(
+                    spreadsheetId=target.spreadsheet_id,
+                    range=range_to_update,
+                    valueInputOption="RAW",
+                    body=update_body
+                ), "sheets_update")
+                logger.info("Fila actualizada en Google Sheets", extra=log_fields(reservation_id=reservation_id, row=row_index_to_update, mode="full"))
+            elif write_mode == "partial":
+                execute_sheets(sheet_instance.values().batchUpdate(
+                    spreadsheetId=target.spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": value_ranges}
+                ), "sheets_update")
+                logger.info("Fila actualizada en Google Sheets", extra=log_fields(reservation_id=reservation_id, row=row_index_to_update, mode="partial", ranges=len(value_ranges)))
+            else:
+                logger.info("Reserva sin cambios respecto a su fila: no se escribe en Google Sheets", extra=log_fields(reservation_id=reservation_id, row=row_index_to_update))
+            if index_row:
+                upsert_reservation_index([index_row])
+            mirror_reservations([reservation_mirror_row(reservation_id, row_data, event_timestamp(data), index_entry.target)])
 
         else:
             if webhook_topic == "reservation.new":
+                target = active_append_target(route_event(data))
                 body = {"values": [row_data]}
-                append_result = sheet_instance.values().append(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=RANGE_NAME,
-                    valueInputOption="RAW",
-                    body=body
-                ).execute()
+                reserved = reserve_row_anchor(target, [reservation_id])
+                try:
+                    append_result = execute_sheets(sheet_instance.values().append(
+                        spreadsheetId=target.spreadsheet_id,
+                        range=a1_range(target.tab),
+                        valueInputOption="RAW",
+                        body=body
+                    ), "sheets_append", idempotent=False)
+                except Exception as error:
+                    if append_maybe_applied(error):
+                        record_appends_in_doubt(target, [reservation_id], error) # El outbox lo comprobará antes de repetirlo
+                    raise
                 
                 updated_range = append_result.get('updates', {}).get('updatedRange', '')
                 if updated_range:
                     try:
-                        sheet_row_number_appended = int(updated_range.split('!')[1].split(':')[0].strip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
-                        add_reservation_to_db(reservation_id, sheet_row_number_appended)
-                        print(f"✅ Appended new row with reservation ID {reservation_id} to Google Sheets (row {sheet_row_number_appended}) AND added to DB index.")
+                        sheet_row_number_appended = parse_updated_range_start_row(updated_range)
+                        anchor = {"reservation_id": str(reservation_id), "sheet_row_number": sheet_row_number_appended, "sheet_id": None}
+                        anchor_index_rows(target, [anchor], reserved=reserved)
+                        add_reservation_to_db(reservation_id, sheet_row_number_appended, event_timestamp(data), row_data, target, anchor["sheet_id"])
+                        record_appended_rows(target, sheet_row_number_appended)
+                        mirror_reservations([reservation_mirror_row(reservation_id, row_data, event_timestamp(data), target)])
+                        logger.info("Fila añadida en Google Sheets e indexada en la DB", extra=log_fields(reservation_id=reservation_id, row=sheet_row_number_appended))
                     except (ValueError, IndexError) as e:
-                        print(f"❌ Error al parsear el número de fila de updatedRange '{updated_range}': {e}. No se pudo indexar en la DB.")
-                        print(f"✅ Appended new row with reservation ID {reservation_id} to Google Sheets (DB index update failed).")
+                        reservation_row_cache.invalidate(str(reservation_id))
+                        logger.error("Número de fila de updatedRange no válido: la reserva no se indexa en la DB", extra=log_fields(reservation_id=reservation_id, updated_range=updated_range, error=str(e)))
+                        logger.info("Fila añadida en Google Sheets sin indexar en la DB", extra=log_fields(reservation_id=reservation_id))
                 else:
-                    print(f"✅ Appended new row with reservation ID {reservation_id} to Google Sheets, but could not determine new row number for DB index. Manual sync might be needed later.")
+                    logger.info("Fila añadida en Google Sheets sin número de fila para el índice: puede hacer falta reconstruir_indice.py", extra=log_fields(reservation_id=reservation_id))
 
             elif webhook_topic == "reservation.updated":
-                print(f"⚠️ Received 'reservation.updated' for ID {reservation_id} which was not found in DB/Sheets. Ignoring to prevent duplicates of old reservations.")
+                logger.warning("'reservation.updated' de una reserva que no está en el índice: se ignora para no duplicar reservas antiguas", extra=log_fields(reservation_id=reservation_id))
                 return {"message": f"Reserva {reservation_id} (updated) no encontrada en la hoja, ignorada para evitar duplicados."}, 200
 
             else:
-                print(f"ℹ️ Received webhook with unexpected topic '{webhook_topic}' for ID {reservation_id}. Ignoring.")
+                logger.info("Webhook con un tipo de evento inesperado: se ignora", extra=log_fields(event=webhook_topic, reservation_id=reservation_id))
                 return {"message": f"Webhook topic '{webhook_topic}' for ID {reservation_id} ignored."}, 200
 
         return {"message": f"Reserva {reservation_id} procesada exitosamente"}, 200
 
-    except HttpError as error:
-        print(f"❌ An error occurred during Google Sheets update: {error}")
+    except (HttpError, SheetsQuotaExceeded) as error:
+        if isinstance(error, SheetsQuotaExceeded) or http_error_status(error) in SHEETS_RETRYABLE_STATUSES:
+            fallback = enqueue_direct_fallback(data, f"Google Sheets no disponible ({error})")
+            if fallback:
+                return fallback
+        logger.error("Error de la API de Google Sheets al actualizar la reserva", extra=log_fields(reservation_id=reservation_id, status=http_error_status(error) if isinstance(error, HttpError) else None, error=str(error)))
         return {"message": f"Error de la API de Google Sheets: {error}"}, 500
     except Exception as e:
-        print(f"❌ Error al actualizar Google Sheets: {str(e)}")
+        logger.error("Error al actualizar Google Sheets", extra=log_fields(error=str(e)))
         return {"message": f"Fallo al actualizar Google Sheets: {str(e)}"}, 500
 
+# --- COLA DE ESCRITURA DIFERIDA (WRITE-BEHIND) HACIA GOOGLE SHEETS ---
+
+# Marca de tiempo de Guesty de la versión de la reserva que trae el webhook (UTC sin zona horaria),
+# o None si el payload no la incluye.
+def event_timestamp(data):
+    reservation_data = data.get("reservation") or {}
+    value = reservation_data.get("lastUpdatedAt") or reservation_data.get("updatedAt")
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+# Un evento es atrasado si trae una versión estrictamente anterior a la última escrita
+def is_stale_event(incoming_at, last_written_at):
+    return incoming_at is not None and last_written_at is not None and incoming_at < last_written_at
+
+# Colapsa los eventos de una ventana de escritura: por cada reservation_id se queda solo la
+# fila más reciente (por marca de tiempo de Guesty, o por orden de llegada si no la hay) con su
+# destino (route_event), y se recuerda si alguno de los eventos fue 'reservation.new' (para poder
+# hacer append si la reserva aún no está indexada).
+def coalesce_events(events):
+    pending = {}
+    for data in events:
+        reservation_id = str(data["reservation"]["_id"])
+        entry = pending.setdefault(reservation_id, {"is_new": False, "last_event_at": None})
+        entry["is_new"] = entry["is_new"] or data.get("event") == "reservation.new"
+        incoming_at = event_timestamp(data)
+        if "row_data" in entry and is_stale_event(incoming_at, entry["last_event_at"]):
+            continue
+        entry["row_data"] = build_row_data(data)
+        entry["route"] = route_event(data)
+        entry["last_event_at"] = incoming_at or entry["last_event_at"]
+    return pending
+
+# Decide qué hacer con cada reserva de la ventana, sin hacer I/O: 'known_entries' es el
+# diccionario reservation_id -> IndexEntry de las ya indexadas. Devuelve:
+#   - updates: spreadsheet_id -> {"ranges": rangos para values().batchUpdate, o para
+#     values().batchUpdateByDataFilter con SHEETS_ROW_ANCHORS (solo de las filas que cambian, ver
+#     row_write_data), "index_rows": filas del índice a guardar si esa llamada va bien}
+#   - appends: destino base (SheetTarget) -> lista (reservation_id, entry) de reservas nuevas
+#   - index_rows: filas del índice sin escritura en Sheets (solo avanza la marca de tiempo)
+# Lo comparten el modo síncrono y el ASGI.
+def plan_sheets_batch(pending, known_entries):
+    updates = {}
+    appends = {}
+    index_rows = []
+
+    for reservation_id, entry in pending.items():
+        index_entry = known_entries.get(reservation_id)
+        if index_entry:
+            if is_stale_event(entry["last_event_at"], index_entry.last_event_at):
+                logger.info("Evento atrasado ignorado: ya se escribió una versión más reciente", extra=log_fields(reservation_id=reservation_id))
+                continue
+            value_ranges, write_mode = row_write_data(reservation_id, index_entry, entry["row_data"])
+            metrics.inc("sheets_row_writes_total", mode=write_mode)
+            index_row = updated_index_row(reservation_id, index_entry, entry["row_data"], entry["last_event_at"], written=bool(value_ranges))
+            if value_ranges:
+                batch = updates.setdefault(parse_target_key(index_entry.target).spreadsheet_id, {"ranges": [], "index_rows": []})
+                batch["ranges"].extend(value_ranges)
+                batch["index_rows"].append(index_row)
+            elif index_row:
+                index_rows.append(index_row)
+        elif entry["is_new"]:
+            appends.setdefault(entry["route"], []).append((reservation_id, entry))
+        else:
+            logger.warning("'reservation.updated' de una reserva que no está en el índice: se ignora para no duplicar reservas antiguas", extra=log_fields(reservation_id=reservation_id))
+
+    return updates, appends, index_rows
+
+# Filas del índice de las reservas añadidas a 'target' con un append de varias filas (consecutivas desde la primera)
+def appended_rows_index(appends, updated_range, target):
+    try:
+        first_row = parse_updated_range_start_row(updated_range)
+    except (ValueError, IndexError) as e:
+        for reservation_id, _ in appends:
+            reservation_row_cache.invalidate(reservation_id)
+        logger.error("Número de fila de updatedRange no válido: reservas añadidas a Sheets sin indexar en la DB", extra=log_fields(reservations=len(appends), updated_range=updated_range, error=str(e)))
+        return []
+    return [
+        {
+            "target": target_key(target), "reservation_id": reservation_id, "sheet_row_number": first_row + offset,
+            "last_event_at": entry["last_event_at"], **row_fingerprint_columns(entry["row_data"]), "sheet_id": None, # Ver anchor_index_rows
+        }
+        for offset, (reservation_id, entry) in enumerate(appends)
+    ]
+
+# --- APPENDS DUDOSOS: UN APPEND NO SE REPITE A CIEGAS ---
+metrics.describe("sheets_appends_in_doubt_total", "counter", "Reservas de appends fallidos tras enviarse, por resultado (recorded, found o missing).")
+
+# ¿Pudo aplicarse un append que falló? Un 429 o un 4xx no llegaron a escribir; un 5xx o una respuesta
+# perdida (timeout, conexión cortada) sí pudieron. SheetsQuotaExceeded salta antes de enviar nada.
+def append_maybe_applied(error):
+    if isinstance(error, SheetsQuotaExceeded):
+        return False
+    if isinstance(error, HttpError):
+        return http_error_status(error) >= 500
+    return True
+
+# Sentencia que apunta las reservas de un append dudoso en 'target'
+def appends_in_doubt_stmt(target, reservation_ids):
+    now = utcnow()
+    return dialect_insert(SheetAppendInDoubt.__table__).values([
+        {"target": target_key(target), "reservation_id": str(reservation_id), "created_at": now} for reservation_id in reservation_ids
+    ]).on_conflict_do_nothing(index_elements=["target", "reservation_id"])
+
+def record_appends_in_doubt(target, reservation_ids, error):
+    logger.warning("Append fallido tras enviarse: se comprobará en la hoja antes de repetirlo", extra=log_fields(tab=target.tab, reservations=len(reservation_ids), error=str(error)))
+    metrics.inc("sheets_appends_in_doubt_total", len(reservation_ids), result="recorded")
+    try:
+        with db_connection() as connection:
+            connection.execute(appends_in_doubt_stmt(target, reservation_ids))
+    except Exception as e:
+        logger.error("Error apuntando un append dudoso", extra=log_fields(tab=target.tab, reservations=len(reservation_ids), error=str(e)))
+
+# Antes de añadir reservas nuevas: las que quedaron en un append dudoso se buscan en la columna de
+# reservation_id de su pestaña (una lectura por pestaña). Las que sí están se indexan en su fila y se
+# devuelven como {reservation_id: IndexEntry} para actualizarlas en lugar de añadirlas otra vez.
+def resolve_appends_in_doubt(reservation_ids):
+    reservation_ids = [str(reservation_id) for reservation_id in reservation_ids]
+    if not reservation_ids:
+        return {}
+    with db_connection() as connection:
+        doubts = connection.execute(
+            select(SheetAppendInDoubt.target, SheetAppendInDoubt.reservation_id).where(SheetAppendInDoubt.reservation_id.in_(reservation_ids))
+        ).all()
+    if not doubts:
+        return {}
+    reservation_ids_by_target = {}
+    for key, reservation_id in doubts:
+        reservation_ids_by_target.setdefault(key, []).append(reservation_id)
+
+    found = []
+    for key, doubtful_ids in reservation_ids_by_target.items():
+        positions = reservation_positions(read_reservation_id_column(parse_target_key(key)))
+        found.extend(
+            {"target": key, "reservation_id": reservation_id, "sheet_row_number": positions[reservation_id],
+             "last_event_at": None, "row_hash": None, "row_data": None, "sheet_id": None} # Sin huella: se reescribe entera
+            for reservation_id in doubtful_ids if reservation_id in positions
+        )
+    upsert_reservation_index(found)
+    with db_connection() as connection:
+        connection.execute(delete(SheetAppendInDoubt).where(SheetAppendInDoubt.reservation_id.in_([reservation_id for _, reservation_id in doubts])))
+    metrics.inc("sheets_appends_in_doubt_total", len(found), result="found")
+    metrics.inc("sheets_appends_in_doubt_total", len(doubts) - len(found), result="missing")
+    if found:
+        logger.info("Reservas de appends dudosos ya en la hoja: se actualizan en su fila", extra=log_fields(reservations=len(found)))
+    return {
+        row["reservation_id"]: IndexEntry(row["sheet_row_number"], None, None, None, row["target"], None)
+        for row in found
+    }
+
+# Las reservas cuya fila se borró de la hoja salen del bloque: no se vuelven a escribir ni a añadir
+def drop_deleted_rows(pending, known_entries, rows):
+    for row in rows:
+        pending.pop(row["reservation_id"], None)
+        known_entries.pop(row["reservation_id"], None)
+
+# Reservas nuevas de un bloque (sin entrada en el índice) que podrían estar en un append dudoso
+def append_candidates(pending, known_entries):
+    return [reservation_id for reservation_id, entry in pending.items() if entry["is_new"] and reservation_id not in known_entries]
+
+# Escribe un bloque de eventos en Google Sheets con, como máximo, un values().batchUpdate por hoja
+# con todas las filas existentes y un values().append por pestaña de destino con todas las nuevas.
+def flush_sheets_batch(events):
+    if sheets_service is None:
+        raise RuntimeError("Servicio de Google Sheets no disponible.")
+
+    pending = coalesce_events(events)
+    known_entries = find_reservations_in_db(pending)
+    known_entries.update(resolve_appends_in_doubt(append_candidates(pending, known_entries)))
+    row_data_by_id = {reservation_id: entry["row_data"] for reservation_id, entry in pending.items()}
+    deleted_rows = locate_anchored_rows(known_entries, row_data_by_id)
+    forget_deleted_rows(deleted_rows)
+    drop_deleted_rows(pending, known_entries, deleted_rows)
+    updates, appends, index_rows = plan_sheets_batch(pending, known_entries)
+
+    sheet_instance = sheets_service.spreadsheets()
+
+    try:
+        for spreadsheet_id, batch in updates.items():
+            if SHEETS_ROW_ANCHORS:
+                result = execute_sheets(sheet_instance.values().batchUpdateByDataFilter(
+                    spreadsheetId=spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": batch["ranges"]}
+                ), "sheets_batch_update")
+                written_rows, missing_rows = reconcile_anchored_rows(batch["index_rows"], batch["ranges"], result)
+                found_rows, deleted_rows = confirm_deleted_rows(missing_rows)
+                forget_deleted_rows(deleted_rows)
+                if found_rows:
+                    execute_sheets(sheet_instance.values().batchUpdate(
+                        spreadsheetId=spreadsheet_id,
+                        body={"valueInputOption": "RAW", "data": rewrite_found_rows_ranges(found_rows, row_data_by_id)}
+                    ), "sheets_batch_update")
+                    written_rows.extend(found_rows)
+            else:
+                execute_sheets(sheet_instance.values().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": batch["ranges"]}
+                ), "sheets_batch_update")
+                written_rows = batch["index_rows"]
+            index_rows.extend(written_rows)
+            logger.info("Batch update escrito en Google Sheets", extra=log_fields(spreadsheet_id=spreadsheet_id, ranges=len(batch["ranges"]), events=len(events)))
+
+        for route, route_appends in appends.items():
+            target = active_append_target(route)
+            reserved = reserve_row_anchor(target, [reservation_id for reservation_id, _ in route_appends])
+            try:
+                append_result = execute_sheets(sheet_instance.values().append(
+                    spreadsheetId=target.spreadsheet_id,
+                    range=a1_range(target.tab),
+                    valueInputOption="RAW",
+                    body={"values": [entry["row_data"] for _, entry in route_appends]}
+                ), "sheets_append", idempotent=False)
+            except Exception as error:
+                if append_maybe_applied(error):
+                    record_appends_in_doubt(target, [reservation_id for reservation_id, _ in route_appends], error)
+                raise
+
+            new_rows = appended_rows_index(route_appends, append_result.get('updates', {}).get('updatedRange', ''), target)
+            anchor_index_rows(target, new_rows, reserved=reserved)
+            index_rows.extend(new_rows)
+            if new_rows:
+                record_appended_rows(target, new_rows[-1]["sheet_row_number"])
+                logger.info("Filas nuevas añadidas en Google Sheets", extra=log_fields(tab=target.tab, rows=len(new_rows), first_row=new_rows[0]["sheet_row_number"], last_row=new_rows[-1]["sheet_row_number"]))
+    finally:
+        # Un único INSERT ... ON CONFLICT con lo que sí se escribió, aunque una llamada posterior
+        # haya fallado: al reintentar el bloque esas reservas ya están indexadas y no se duplican.
+        try:
+            upsert_reservation_index(index_rows)
+        except Exception as e:
+            logger.error("Error actualizando reservas en el índice de la DB", extra=log_fields(reservations=len(index_rows), error=str(e)))
+        mirror_reservations(sheets_batch_mirror_rows(pending, known_entries, updates, index_rows))
+
+# --- MODO 'log': REGISTRO DE EVENTOS SOLO DE APPENDS + INSTANTÁNEA COMPACTADA ---
+
+metrics.describe("sheets_log_rows_total", "counter", "Eventos añadidos a las pestañas de registro (SHEETS_SINK_MODE=log).")
+metrics.describe("sheets_compactions_total", "counter", "Compactaciones de registro a pestaña de estado actual por resultado.")
+metrics.describe("sheets_log_trimmed_rows_total", "counter", "Filas ya compactadas borradas de las pestañas de registro.")
+
+# Pestaña de registro de un destino: '<pestaña>_log' en la misma hoja
+def log_target(target):
+    return SheetTarget(target.spreadsheet_id, f"{target.tab}{SHEETS_LOG_TAB_SUFFIX}")
+
+# Fila del registro de un evento: la fila de la hoja más su versión de Guesty (vacía si no viene)
+def log_row(data):
+    version = event_timestamp(data)
+    return build_row_data(data) + [version.isoformat(timespec="microseconds") if version else ""]
+
+# Agrupa los eventos por destino (route_event) en orden de llegada, sin coalescer: cada evento es una fila
+def plan_log_batch(events):
+    rows_by_target = {}
+    for data in events:
+        rows_by_target.setdefault(route_event(data), []).append(log_row(data))
+    return rows_by_target
+
+ensured_log_tabs = set()
+
+# Crea la pestaña de registro de 'target' (con su encabezado) la primera vez que este proceso la usa
+def ensure_log_tab(target):
+    log = log_target(target)
+    if log not in ensured_log_tabs:
+        ensure_sheet_tab(log, log_field_names)
+        ensured_log_tabs.add(log)
+    return log
+
+# Sentencia que apunta un append más al registro de 'target' (su instantánea queda pendiente de compactar)
+def sheet_snapshot_dirty_stmt(target):
+    stmt = dialect_insert(SheetSnapshot.__table__).values(target=target_key(target), log_version=1, compacted_version=0, row_count=0)
+    return stmt.on_conflict_do_update(index_elements=["target"], set_={"log_version": SheetSnapshot.log_version + 1})
+
+def mark_snapshot_dirty(target):
+    try:
+        Session().execute(sheet_snapshot_dirty_stmt(target))
+        Session().commit()
+    except Exception as e:
+        Session().rollback()
+        logger.error("Error marcando la instantánea como pendiente de compactar", extra=log_fields(tab=target.tab, error=str(e)))
+
+# Escribe un bloque de eventos en modo 'log': un values().append por pestaña de registro con todos
+# sus eventos, sin consultar el índice. Si el bloque falla a medias, al reintentarlo se repiten filas
+# ya añadidas: no importa, la compactación se queda con una sola versión por reserva.
+def flush_log_batch(events):
+    if sheets_service is None:
+        raise RuntimeError("Servicio de Google Sheets no disponible.")
+
+    sheet_instance = sheets_service.spreadsheets()
+    for target, rows in plan_log_batch(events).items():
+        log = ensure_log_tab(target)
+        execute_sheets(sheet_instance.values().append(
+            spreadsheetId=log.spreadsheet_id,
+            range=a1_range(log.tab),
+            valueInputOption="RAW",
+            body={"values": rows}
+        ), "sheets_log_append", idempotent=False)
+        metrics.inc("sheets_log_rows_total", len(rows))
+        mark_snapshot_dirty(target)
+        logger.info("Eventos añadidos al registro", extra=log_fields(tab=log.tab, rows=len(rows), events=len(events)))
+    mirror_reservations(log_batch_mirror_rows(events))
+
+# Propiedades (sheetId, gridProperties) de cada pestaña de una hoja, por título
+def sheet_properties_by_title(sheet_instance, spreadsheet_id, stage="sheets_compaction"):
+    result = execute_sheets(sheet_instance.get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties(sheetId,title,gridProperties(rowCount,columnCount))"
+    ), stage, kind="read")
+    return {sheet["properties"]["title"]: sheet["properties"] for sheet in result.get("sheets", [])}
+
+# Lee el registro por páginas desde 'start_row' y devuelve (reservation_id -> última fila, última fila
+# leída del registro), en el orden en que cada reserva apareció por primera vez (así no cambian de fila
+# entre compactaciones). Gana la versión mayor; a igual versión, o sin versión, la añadida más tarde.
+def read_log_latest_rows(sheet_instance, log, row_count, start_row=2):
+    width = len(log_field_names)
+    reservation_column = field_names.index("reservation_id")
+    latest = {}
+    last_row = start_row - 1
+    while start_row <= row_count:
+        end_row = min(start_row + SHEETS_COMPACTION_PAGE_ROWS - 1, row_count)
+        result = execute_sheets(sheet_instance.values().get(
+            spreadsheetId=log.spreadsheet_id,
+            range=a1_range(log.tab, f"A{start_row}:{LOG_LAST_COLUMN}{end_row}"),
+            valueRenderOption="UNFORMATTED_VALUE" # Los números vuelven como números, no como texto
+        ), "sheets_compaction", kind="read")
+        rows = result.get("values", [])
+        last_row = start_row + len(rows) - 1 if rows else last_row
+        for row in rows:
+            row = (list(row) + [""] * width)[:width] # Sheets omite las celdas vacías del final
+            reservation_id = str(row[reservation_column]).strip()
+            if not reservation_id:
+                continue
+            current = latest.get(reservation_id)
+            if current and row[-1] and current[-1] and str(row[-1]) < str(current[-1]):
+                continue
+            latest[reservation_id] = row
+        if len(rows) < end_row - start_row + 1:
+            break # Fin del registro: el resto de la cuadrícula está vacío
+        start_row = end_row + 1
+    return latest, last_row
+
+# Versión de Guesty de una fila del registro como marca de tiempo del índice (None si no tiene)
+def log_row_version(row):
+    try:
+        return datetime.fromisoformat(str(row[-1])) if row[-1] else None
+    except ValueError:
+        return None
+
+# Fila del índice de la pestaña de estado actual para una reserva compactada en 'row_number'
+def snapshot_index_row(key, reservation_id, row_number, row):
+    return {
+        "target": key, "reservation_id": reservation_id, "sheet_row_number": row_number,
+        "last_event_at": log_row_version(row), **row_fingerprint_columns(row[:len(field_names)]), "sheet_id": None,
+    }
+
+# Amplía la cuadrícula de la pestaña de estado actual (o la crea) para que quepan 'row_count' filas:
+# values().update y values().batchUpdate no la amplían (append sí)
+def ensure_snapshot_grid(sheet_instance, target, properties, row_count):
+    if target.tab not in properties:
+        grid_requests = [{"addSheet": {"properties": {"title": target.tab, "gridProperties": {"rowCount": row_count, "columnCount": len(field_names)}}}}]
+    else:
+        missing_rows = row_count - properties[target.tab]["gridProperties"]["rowCount"]
+        grid_requests = [{"appendDimension": {"sheetId": properties[target.tab]["sheetId"], "dimension": "ROWS", "length": missing_rows}}] if missing_rows > 0 else []
+    if grid_requests:
+        execute_sheets(sheet_instance.batchUpdate(
+            spreadsheetId=target.spreadsheet_id,
+            body={"requests": grid_requests}
+        ), "sheets_compaction")
+
+# Primera compactación (o instantánea anterior a la marca de agua): reescribe la pestaña de estado actual
+# entera desde todo el registro con un único values().update (encabezado incluido), vaciando las filas
+# sobrantes de la versión anterior, e indexa la fila de cada reserva. Devuelve (reservas, filas del índice).
+def rebuild_snapshot(sheet_instance, target, properties, latest, previous_rows):
+    rows = [row[:len(field_names)] for row in latest.values()]
+    values = [field_names] + rows + [[""] * len(field_names)] * max(previous_rows - len(rows), 0)
+    ensure_snapshot_grid(sheet_instance, target, properties, len(values))
+    execute_sheets(sheet_instance.values().update(
+        spreadsheetId=target.spreadsheet_id,
+        range=a1_range(target.tab, f"A1:{LAST_COLUMN}{len(values)}"),
+        valueInputOption="RAW",
+        body={"values": values}
+    ), "sheets_compaction")
+    key = target_key(target)
+    with db_connection() as connection:
+        connection.execute(delete(ReservationIndex).where(ReservationIndex.target == key)) # Posiciones de la versión anterior
+    return len(rows), [snapshot_index_row(key, reservation_id, row_number, row) for row_number, (reservation_id, row) in enumerate(latest.items(), start=2)]
+
+# Compactación incremental: solo las reservas con filas nuevas en el registro. Las ya compactadas se
+# reescriben en su fila (salvo si no cambiaron o traen una versión anterior) y las nuevas van detrás de
+# la última, todo en un único values().batchUpdate. Devuelve (reservas, filas del índice a guardar).
+def merge_into_snapshot(sheet_instance, target, properties, latest, previous_rows):
+    key = target_key(target)
+    known, reservation_ids = {}, list(latest)
+    with db_connection() as connection:
+        for chunk_start in range(0, len(reservation_ids), SHEETS_COMPACTION_INDEX_CHUNK):
+            chunk = reservation_ids[chunk_start:chunk_start + SHEETS_COMPACTION_INDEX_CHUNK]
+            known.update((reservation_id, (row_number, last_event_at, row_hash)) for reservation_id, row_number, last_event_at, row_hash in connection.execute(
+                select(ReservationIndex.reservation_id, ReservationIndex.sheet_row_number, ReservationIndex.last_event_at, ReservationIndex.row_hash)
+                .where(ReservationIndex.target == key, ReservationIndex.reservation_id.in_(chunk))
+            ))
+
+    ranges, index_rows, next_row = [], [], previous_rows + 2
+    for reservation_id, row in latest.items():
+        if reservation_id in known:
+            row_number, last_event_at, row_hash = known[reservation_id]
+            version = log_row_version(row)
+            if (version is not None and last_event_at is not None and version < last_event_at) or row_hash == row_fingerprint(row[:len(field_names)]):
+                continue
+        else:
+            row_number, next_row = next_row, next_row + 1
+        ranges.append({"range": a1_range(target.tab, f"A{row_number}:{LAST_COLUMN}{row_number}"), "values": [row[:len(field_names)]]})
+        index_rows.append(snapshot_index_row(key, reservation_id, row_number, row))
+    if ranges:
+        ensure_snapshot_grid(sheet_instance, target, properties, next_row - 1)
+        execute_sheets(sheet_instance.values().batchUpdate(
+            spreadsheetId=target.spreadsheet_id,
+            body={"valueInputOption": "RAW", "data": ranges}
+        ), "sheets_compaction")
+    return next_row - 2, index_rows
+
+# Borra del registro las filas ya compactadas (2..last_row) cuando pasan de SHEETS_LOG_TRIM_ROWS: la
+# pestaña de estado actual, el índice y el espejo ya tienen su contenido. Los appends que lleguen mientras
+# tanto van al final y solo suben de fila. La marca de agua vuelve al encabezado antes de borrar: si el
+# borrado falla, la próxima compactación relee esas filas y el resultado es el mismo.
+def trim_compacted_log(sheet_instance, target, log, properties, last_row):
+    if SHEETS_LOG_TRIM_ROWS <= 0 or last_row - 1 < SHEETS_LOG_TRIM_ROWS:
+        return
+    try:
+        with db_connection() as connection:
+            connection.execute(update(SheetSnapshot).where(SheetSnapshot.target == target_key(target)).values(compacted_log_row=1))
+        execute_sheets(sheet_instance.batchUpdate(
+            spreadsheetId=log.spreadsheet_id,
+            body={"requests": [{"deleteDimension": {"range": {"sheetId": properties[log.tab]["sheetId"], "dimension": "ROWS", "startIndex": 1, "endIndex": last_row}}}]}
+        ), "sheets_compaction")
+    except Exception as e:
+        logger.warning("No se pudieron borrar las filas ya compactadas del registro: se releerán en la próxima compactación", extra=log_fields(tab=log.tab, error=str(e)))
+        return
+    metrics.inc("sheets_log_trimmed_rows_total", last_row - 1)
+    logger.info("Filas ya compactadas borradas del registro", extra=log_fields(tab=log.tab, rows=last_row - 1))
+
+# Lleva la pestaña de estado actual de 'target' al día con su registro. Solo se leen las filas añadidas
+# al registro desde la última compactación (compacted_log_row, la marca de agua), y las ya compactadas se
+# borran del registro cada SHEETS_LOG_TRIM_ROWS filas; la primera vez se reconstruye entera.
+def compact_log(target):
+    if sheets_service is None:
+        raise RuntimeError("Servicio de Google Sheets no disponible.")
+
+    started = time.monotonic()
+    sheet_instance = sheets_service.spreadsheets()
+    session = Session()
+    snapshot = session.get(SheetSnapshot, target_key(target))
+    version = snapshot.log_version if snapshot else 0 # Lo añadido después de leerla queda para la próxima
+    previous_rows = snapshot.row_count if snapshot else 0
+    watermark = snapshot.compacted_log_row if snapshot else None
+    session.commit()
+
+    log = log_target(target)
+    properties = sheet_properties_by_title(sheet_instance, target.spreadsheet_id)
+    if log.tab not in properties:
+        raise RuntimeError(f"No se encontró la pestaña de registro '{log.tab}' en la hoja {target.spreadsheet_id}.")
+    log_rows = properties[log.tab]["gridProperties"]["rowCount"]
+    latest, last_row = read_log_latest_rows(sheet_instance, log, log_rows, start_row=(watermark or 1) + 1)
+
+    if watermark is None:
+        row_count, index_rows = rebuild_snapshot(sheet_instance, target, properties, latest, previous_rows)
+    else:
+        row_count, index_rows = merge_into_snapshot(sheet_instance, target, properties, latest, previous_rows)
+    for chunk_start in range(0, len(index_rows), SHEETS_COMPACTION_INDEX_CHUNK):
+        upsert_reservation_index(index_rows[chunk_start:chunk_start + SHEETS_COMPACTION_INDEX_CHUNK])
+
+    session.execute(
+        update(SheetSnapshot)
+        .where(SheetSnapshot.target == target_key(target))
+        .values(compacted_version=version, row_count=row_count, compacted_at=utcnow(), compacted_log_row=last_row)
+    )
+    session.commit()
+    trim_compacted_log(sheet_instance, target, log, properties, last_row)
+    session.execute(update(SheetSnapshot).where(SheetSnapshot.target == target_key(target)).values(locked_until=None))
+    session.commit()
+    logger.info("Compactación del registro completada", extra=log_fields(tab=log.tab, snapshot_tab=target.tab, updated_reservations=len(latest), reservations=row_count, duration_seconds=round(time.monotonic() - started, 1)))
+    return row_count
+
+# Toma el lease de compactación de una instantánea si está libre (o caducado)
+def claim_snapshot_stmt(key, now):
+    return (
+        update(SheetSnapshot)
+        .where(SheetSnapshot.target == key)
+        .where((SheetSnapshot.locked_until == None) | (SheetSnapshot.locked_until < now))
+        .values(locked_until=now + timedelta(seconds=SHEETS_COMPACTION_LEASE_SECONDS))
+    )
+
+# Compacta las instantáneas con appends nuevos desde la última compactación, o las de 'targets'
+# aunque no los tengan (force). Devuelve cuántas se compactaron.
+def compact_log_tabs(targets=None, force=False):
+    session = Session()
+    if targets:
+        keys = [target_key(target) for target in targets]
+        session.execute(dialect_insert(SheetSnapshot.__table__).values([
+            {"target": key, "log_version": 0, "compacted_version": 0, "row_count": 0} for key in keys
+        ]).on_conflict_do_nothing(index_elements=["target"]))
+        session.commit()
+    query = select(SheetSnapshot.target)
+    if targets:
+        query = query.where(SheetSnapshot.target.in_(keys))
+    if not force:
+        query = query.where(SheetSnapshot.log_version > SheetSnapshot.compacted_version)
+    compacted = 0
+    for key in session.scalars(query).all():
+        claimed = session.execute(claim_snapshot_stmt(key, utcnow())).rowcount
+        session.commit()
+        if not claimed:
+            continue # Otro worker la está compactando
+        try:
+            compact_log(parse_target_key(key))
+            compacted += 1
+            metrics.inc("sheets_compactions_total", result="ok")
+        except Exception as e:
+            session.rollback()
+            metrics.inc("sheets_compactions_total", result="error")
+            logger.error("Error compactando el registro", extra=log_fields(target=key, error=str(e)))
+            session.execute(update(SheetSnapshot).where(SheetSnapshot.target == key).values(locked_until=None))
+            session.commit()
+    return compacted
+
+# Pasada programada (cada SHEETS_COMPACTION_INTERVAL_SECONDS) desde el drenador del outbox
+def run_log_compaction():
+    try:
+        compact_log_tabs()
+    except Exception as e:
+        Session().rollback()
+        logger.error("Error en la compactación de los registros", extra=log_fields(error=str(e)))
+    finally:
+        Session.remove()
+
+# --- ANCLAS DE FILA (DEVELOPER METADATA) Y VERIFICADOR DEL ÍNDICE ---
+
+metrics.describe("sheets_row_anchors_total", "counter", "Filas ancladas con developer metadata, por origen (append o verify).")
+metrics.describe("sheets_row_anchors_skipped_total", "counter", "Filas que se quedan sin ancla, por motivo (budget, paused o error).")
+metrics.describe("sheets_row_relocations_total", "counter", "Filas del índice corregidas porque su fila se movió en la hoja, por origen (write o verify).")
+metrics.describe("sheets_row_deletions_total", "counter", "Reservas quitadas del índice porque su fila se borró de la hoja.")
+metrics.describe("sheets_row_verifications_total", "counter", "Pestañas verificadas por resultado (ok, drift o error).")
+
+RESERVATION_ID_COLUMN = column_letter(field_names.index("reservation_id") + 1) # 'D'
+SHEETS_ROW_ANCHOR_CHUNK = 5000 # Filas por cada batchUpdate de anclas y cada upsert del índice al relocalizar
+
+sheet_ids = {} # target_key() -> sheetId de la pestaña (no cambia mientras exista)
+row_anchor_pauses = {} # spreadsheet_id -> time.monotonic() hasta el que no se intenta anclar (tras un fallo)
+
+# sheetId de la pestaña de 'target' (las anclas se sitúan por sheetId, no por título), en caché por proceso
+def sheet_id_for(target):
+    key = target_key(target)
+    if key not in sheet_ids:
+        properties = sheet_properties_by_title(sheets_service.spreadsheets(), target.spreadsheet_id, stage="sheets_anchor")
+        for title, tab_properties in properties.items():
+            sheet_ids[target_key(SheetTarget(target.spreadsheet_id, title))] = tab_properties["sheetId"]
+        if key not in sheet_ids:
+            raise RuntimeError(f"No se encontró la pestaña '{target.tab}' en la hoja {target.spreadsheet_id}.")
+    return sheet_ids[key]
+
+# developerMetadataLookup de las anclas de una pestaña, o solo la de 'reservation_id'
+def row_anchor_lookup(sheet_id, reservation_id=None):
+    lookup = {
+        "metadataKey": SHEETS_ROW_ANCHOR_KEY,
+        "locationType": "ROW",
+        "metadataLocation": {"sheetId": sheet_id},
+        "locationMatchingStrategy": "INTERSECTING_LOCATION",
+    }
+    if reservation_id is not None:
+        lookup["metadataValue"] = str(reservation_id)
+    return lookup
+
+# Peticiones de spreadsheets().batchUpdate que anclan cada (reservation_id, número de fila) a su fila
+def row_anchor_requests(sheet_id, rows):
+    return [
+        {"createDeveloperMetadata": {"developerMetadata": {
+            "metadataKey": SHEETS_ROW_ANCHOR_KEY,
+            "metadataValue": str(reservation_id),
+            "location": {"dimensionRange": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": row_number - 1, "endIndex": row_number}},
+            "visibility": "DOCUMENT",
+        }}}
+        for reservation_id, row_number in rows
+    ]
+
+# Peticiones que borran las anclas de unas reservas (una ancla que quedó en la fila de otra reserva)
+def row_unanchor_requests(sheet_id, reservation_ids):
+    return [
+        {"deleteDeveloperMetadata": {"dataFilter": {"developerMetadataLookup": row_anchor_lookup(sheet_id, reservation_id)}}}
+        for reservation_id in reservation_ids
+    ]
+
+# Caracteres de developer metadata que ocupan ya las anclas de una hoja, según el índice (las filas con sheet_id)
+def row_anchor_chars_used(spreadsheet_id):
+    with db_connection() as connection:
+        anchored, id_chars = connection.execute(
+            select(func.count(), func.coalesce(func.sum(func.length(ReservationIndex.reservation_id)), 0))
+            .where(ReservationIndex.sheet_id != None, ReservationIndex.target.startswith(f"{spreadsheet_id}/", autoescape=True))
+        ).one()
+    return anchored * len(SHEETS_ROW_ANCHOR_KEY) + id_chars
+
+# Cuántas de 'reservation_ids' (las primeras) caben aún en SHEETS_ROW_ANCHOR_MAX_CHARS en la hoja de
+# 'target'; 0 si las anclas de esa hoja están en pausa tras un fallo
+def row_anchor_capacity(target, reservation_ids):
+    if not SHEETS_ROW_ANCHORS or not reservation_ids or time.monotonic() < row_anchor_pauses.get(target.spreadsheet_id, 0):
+        return 0
+    free = SHEETS_ROW_ANCHOR_MAX_CHARS - row_anchor_chars_used(target.spreadsheet_id)
+    capacity = 0
+    for reservation_id in reservation_ids:
+        free -= len(SHEETS_ROW_ANCHOR_KEY) + len(str(reservation_id))
+        if free < 0:
+            break
+        capacity += 1
+    return capacity
+
+# Antes de un append: paga ya el turno de la llamada que anclará las filas nuevas, así el ancla sale justo
+# después del append en lugar de esperar cuota entre ambas. Si alguien ordena la hoja en ese intervalo las
+# anclas caen en filas de otras reservas (el verificador las rehace), así que conviene que sea corto.
+# Sin presupuesto de anclas en la hoja no se paga nada: esas filas no se anclarán.
+def reserve_row_anchor(target, reservation_ids, max_wait=None):
+    if not row_anchor_capacity(target, reservation_ids):
+        return False
+    sheets_rate_limiter.acquire("write", sheets_max_wait("write", max_wait))
+    return True
+
+# Ancla en una sola llamada filas del índice de 'target' (dicts con 'reservation_id' y 'sheet_row_number')
+# y les pone 'sheet_id'; con 'stale' borra antes las anclas viejas de esas reservas. Solo se anclan las
+# que caben en el presupuesto de la hoja (ver row_anchor_capacity). Si falla (por ejemplo, por el límite
+# de tamaño de Sheets) quedan sin anclar, se siguen escribiendo por número de fila y las anclas de esa
+# hoja se pausan SHEETS_ROW_ANCHOR_RETRY_SECONDS: el verificador no las reintenta en cada pasada.
+def anchor_index_rows(target, index_rows, source="append", stale=(), reserved=False):
+    if not SHEETS_ROW_ANCHORS or not (index_rows or stale):
+        return
+    if time.monotonic() < row_anchor_pauses.get(target.spreadsheet_id, 0):
+        metrics.inc("sheets_row_anchors_skipped_total", len(index_rows), reason="paused")
+        return
+    capacity = row_anchor_capacity(target, [row["reservation_id"] for row in index_rows])
+    if capacity < len(index_rows):
+        metrics.inc("sheets_row_anchors_skipped_total", len(index_rows) - capacity, reason="budget")
+        if capacity: # Solo al agotarse, no en cada escritura posterior
+            logger.info("Presupuesto de anclas agotado: las filas nuevas se escriben por número de fila", extra=log_fields(spreadsheet_id=target.spreadsheet_id, tab=target.tab))
+        index_rows = index_rows[:capacity]
+        if not (index_rows or stale):
+            return
+    try:
+        sheet_id = sheet_id_for(target)
+        execute_sheets(sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=target.spreadsheet_id,
+            body={"requests": row_unanchor_requests(sheet_id, stale)
+                  + row_anchor_requests(sheet_id, [(row["reservation_id"], row["sheet_row_number"]) for row in index_rows])}
+        ), "sheets_anchor", reserved=reserved)
+    except Exception as e:
+        row_anchor_pauses[target.spreadsheet_id] = time.monotonic() + SHEETS_ROW_ANCHOR_RETRY_SECONDS
+        metrics.inc("sheets_row_anchors_skipped_total", len(index_rows), reason="error")
+        logger.warning("No se pudieron anclar las filas: se escriben por número de fila y las anclas de la hoja quedan en pausa", extra=log_fields(tab=target.tab, rows=len(index_rows), pause_seconds=SHEETS_ROW_ANCHOR_RETRY_SECONDS, error=str(e)))
+        return
+    for row in index_rows:
+        row["sheet_id"] = sheet_id
+    metrics.inc("sheets_row_anchors_total", len(index_rows), source=source)
+
+# Rangos de row_update_ranges como DataFilterValueRange de values().batchUpdateByDataFilter (con
+# SHEETS_ROW_ANCHORS). Una fila anclada que se reescribe completa se busca por su ancla: un filtro de
+# metadata selecciona la fila entera y no admite empezar en otra columna. Las escrituras por tramos (de
+# filas ancladas ya localizadas con locate_anchored_rows) y las filas sin anclar van por su rango A1.
+def row_write_data(reservation_id, index_entry, row_data):
+    value_ranges, write_mode = row_update_ranges(index_entry, row_data)
+    if not SHEETS_ROW_ANCHORS or not value_ranges:
+        return value_ranges, write_mode
+    if index_entry.sheet_id is not None and write_mode == "full":
+        lookup = row_anchor_lookup(index_entry.sheet_id, reservation_id)
+        return [{"dataFilter": {"developerMetadataLookup": lookup}, "majorDimension": "ROWS", "values": [row_data]}], "full"
+    return [{"dataFilter": {"a1Range": value_range["range"]}, "majorDimension": "ROWS", "values": value_range["values"]} for value_range in value_ranges], write_mode
+
+# Reservas ancladas de 'known_entries' que se van a escribir por tramos, por hoja: {spreadsheet_id:
+# {reservation_id: IndexEntry}}. 'row_data_by_id' es la fila nueva de cada reserva. Sin I/O.
+def anchored_partial_writes(known_entries, row_data_by_id):
+    partial = {}
+    for reservation_id, row_data in row_data_by_id.items():
+        index_entry = known_entries.get(reservation_id)
+        if index_entry is None or index_entry.sheet_id is None or row_update_ranges(index_entry, row_data)[1] != "partial":
+            continue
+        partial.setdefault(parse_target_key(index_entry.target).spreadsheet_id, {})[reservation_id] = index_entry
+    return partial
+
+# dataFilters de developerMetadata().search que buscan el ancla de cada una de 'entries'
+def row_anchor_filters(entries):
+    return [{"developerMetadataLookup": row_anchor_lookup(index_entry.sheet_id, reservation_id)} for reservation_id, index_entry in entries.items()]
+
+# Fila actual de cada ancla de una respuesta de developerMetadata().search: {(sheetId, reservation_id): fila}
+def row_anchor_matches(result):
+    anchors = {}
+    for match in result.get("matchedDeveloperMetadata", []):
+        metadata = match.get("developerMetadata", {})
+        dimension_range = metadata.get("location", {}).get("dimensionRange", {})
+        anchors.setdefault((dimension_range.get("sheetId"), metadata.get("metadataValue")), dimension_range.get("startIndex", 0) + 1)
+    return anchors
+
+# Lleva cada una de 'entries' a la fila en la que se encontró su ancla. Devuelve ({reservation_id:
+# IndexEntry} con la fila al día, filas del índice cuya ancla no apareció, para confirm_deleted_rows).
+def apply_row_anchor_matches(entries, anchors):
+    located, missing = {}, []
+    for reservation_id, index_entry in entries.items():
+        row_number = anchors.get((index_entry.sheet_id, reservation_id))
+        if row_number is None:
+            missing.append({"target": index_entry.target, "reservation_id": reservation_id, "sheet_row_number": index_entry.sheet_row_number, "sheet_id": index_entry.sheet_id})
+            continue
+        if row_number != index_entry.sheet_row_number:
+            metrics.inc("sheets_row_relocations_total", source="write")
+            logger.info("Fila de la reserva movida en la hoja: índice corregido", extra=log_fields(reservation_id=reservation_id, from_row=index_entry.sheet_row_number, row=row_number))
+        located[reservation_id] = index_entry._replace(sheet_row_number=row_number)
+    return located, missing
+
+# Entradas de las filas de confirm_deleted_rows que siguen en la hoja: en su fila actual y sin ancla
+def unanchored_entries(known_entries, rows):
+    return {row["reservation_id"]: known_entries[row["reservation_id"]]._replace(sheet_row_number=row["sheet_row_number"], sheet_id=None) for row in rows}
+
+# Antes de escribir por tramos filas ancladas (un rango A1 no sigue a la fila si alguien ordenó la
+# pestaña) se busca su fila actual: un developerMetadata().search por hoja. Actualiza 'known_entries' y
+# devuelve las filas del índice que ya no están en la hoja (confirmado leyendo la columna de reservation_id).
+def locate_anchored_rows(known_entries, row_data_by_id):
+    deleted = []
+    for spreadsheet_id, entries in anchored_partial_writes(known_entries, row_data_by_id).items():
+        result = execute_sheets(sheets_service.spreadsheets().developerMetadata().search(
+            spreadsheetId=spreadsheet_id, body={"dataFilters": row_anchor_filters(entries)}
+        ), "sheets_anchor", kind="read")
+        located, missing = apply_row_anchor_matches(entries, row_anchor_matches(result))
+        known_entries.update(located)
+        found, gone = confirm_deleted_rows(missing)
+        known_entries.update(unanchored_entries(known_entries, found))
+        deleted.extend(gone)
+    return deleted
+
+# Tras un values().batchUpdateByDataFilter con los rangos 'ranges', cada fila de 'index_rows' escrita por
+# su ancla pasa a la fila en la que Sheets la encontró: si alguien ordenó la pestaña o borró filas, el
+# índice se corrige aquí mismo. Devuelve (filas del índice a guardar, filas cuya ancla no apareció: pasar
+# por confirm_deleted_rows antes de darlas por borradas).
+def reconcile_anchored_rows(index_rows, ranges, response):
+    looked_up = {
+        value_range["dataFilter"]["developerMetadataLookup"]["metadataValue"]
+        for value_range in ranges if "developerMetadataLookup" in value_range["dataFilter"]
+    }
+    found = {}
+    for result in response.get("responses", []):
+        lookup = (result.get("dataFilter") or {}).get("developerMetadataLookup") or {}
+        if lookup.get("metadataValue") and result.get("updatedRange"):
+            found[lookup["metadataValue"]] = parse_updated_range_start_row(result["updatedRange"])
+    kept, deleted = [], []
+    for row in index_rows:
+        if row["reservation_id"] not in looked_up:
+            kept.append(row)
+        elif row["reservation_id"] in found:
+            if found[row["reservation_id"]] != row["sheet_row_number"]:
+                metrics.inc("sheets_row_relocations_total", source="write")
+                logger.info("Fila de la reserva movida en la hoja: índice corregido", extra=log_fields(reservation_id=row["reservation_id"], from_row=row["sheet_row_number"], row=found[row["reservation_id"]]))
+                row["sheet_row_number"] = found[row["reservation_id"]]
+            kept.append(row)
+        else:
+            deleted.append(row)
+    return kept, deleted
+
+# Número de fila de cada reserva en una columna de read_reservation_id_column; si está repetida, la
+# primera (como reconstruir_indice.py)
+def reservation_positions(column):
+    positions = {}
+    for row_number, reservation_id in sorted(column.items()):
+        positions.setdefault(reservation_id, row_number)
+    return positions
+
+# Una fila anclada cuya ancla no aparece no se da por borrada sin más: puede haberse perdido solo el
+# ancla. Se busca la reserva en la columna de reservation_id de su pestaña (una lectura por pestaña).
+# Devuelve (filas que siguen en la hoja, ya en su fila actual y sin ancla, filas que de verdad no están).
+def confirm_deleted_rows(rows):
+    rows_by_target = {}
+    for row in rows:
+        rows_by_target.setdefault(row["target"], []).append(row)
+    found, deleted = [], []
+    for key, target_rows in rows_by_target.items():
+        positions = reservation_positions(read_reservation_id_column(parse_target_key(key)))
+        for row in target_rows:
+            if row["reservation_id"] not in positions:
+                deleted.append(row)
+                continue
+            logger.warning("La reserva sigue en la hoja pero su ancla no apareció: se escribe por número de fila", extra=log_fields(reservation_id=row["reservation_id"], target=key, row=positions[row["reservation_id"]]))
+            row.update(sheet_row_number=positions[row["reservation_id"]], sheet_id=None)
+            found.append(row)
+    return found, deleted
+
+# Rangos A1 de values().batchUpdate que reescriben completas, en su fila actual, las filas de
+# confirm_deleted_rows que seguían en la hoja. 'row_data_by_id' es la fila nueva de cada reserva.
+def rewrite_found_rows_ranges(rows, row_data_by_id):
+    return [
+        {"range": a1_range(parse_target_key(row["target"]).tab, f"A{row['sheet_row_number']}:{LAST_COLUMN}{row['sheet_row_number']}"), "values": [row_data_by_id[row["reservation_id"]]]}
+        for row in rows
+    ]
+
+# Sentencias que quitan del índice y del espejo las reservas cuya fila se borró de la hoja
+def forget_deleted_rows_stmts(rows):
+    reservation_ids_by_target = {}
+    for row in rows:
+        reservation_ids_by_target.setdefault(row["target"], []).append(row["reservation_id"])
+    stmts = [
+        delete(ReservationIndex).where(ReservationIndex.target == key, ReservationIndex.reservation_id.in_(reservation_ids))
+        for key, reservation_ids in reservation_ids_by_target.items()
+    ]
+    stmts.append(delete(ReservationMirror).where(ReservationMirror.reservation_id.in_([row["reservation_id"] for row in rows])))
+    return stmts
+
+# Sus eventos siguientes se tratan como los de una reserva desconocida: no se vuelve a añadir una fila borrada a mano
+def log_deleted_rows(rows):
+    for row in rows:
+        reservation_row_cache.invalidate(row["reservation_id"])
+        logger.warning("La fila de la reserva se borró de la hoja: se quita del índice", extra=log_fields(reservation_id=row["reservation_id"], target=row["target"]))
+    metrics.inc("sheets_row_deletions_total", len(rows))
+
+def forget_deleted_rows(rows):
+    if not rows:
+        return
+    log_deleted_rows(rows)
+    try:
+        with db_connection() as connection:
+            for stmt in forget_deleted_rows_stmts(rows):
+                connection.execute(stmt)
+    except Exception as e:
+        logger.error("Error quitando del índice reservas borradas de la hoja", extra=log_fields(reservations=len(rows), error=str(e)))
+
+# Fila actual de cada ancla de la pestaña de 'target' con un único developerMetadata().search
+def search_row_anchors(target):
+    result = execute_sheets(sheets_service.spreadsheets().developerMetadata().search(
+        spreadsheetId=target.spreadsheet_id,
+        body={"dataFilters": [{"developerMetadataLookup": row_anchor_lookup(sheet_id_for(target))}]}
+    ), "sheets_verify", kind="read")
+    return {reservation_id: row_number for (_, reservation_id), row_number in row_anchor_matches(result).items()}
+
+# Columna de reservation_id completa de la pestaña (una sola lectura): número de fila -> ID
+def read_reservation_id_column(target):
+    result = execute_sheets(sheets_service.spreadsheets().values().get(
+        spreadsheetId=target.spreadsheet_id,
+        range=a1_range(target.tab, f"{RESERVATION_ID_COLUMN}2:{RESERVATION_ID_COLUMN}"),
+        majorDimension="COLUMNS"
+    ), "sheets_verify", kind="read")
+    columns = result.get("values", [])
+    return {row_number: str(value).strip() for row_number, value in enumerate(columns[0] if columns else [], start=2)}
+
+# Celdas de reservation_id de unas pocas filas sueltas con un único values().batchGet
+def read_reservation_id_cells(target, row_numbers):
+    result = execute_sheets(sheets_service.spreadsheets().values().batchGet(
+        spreadsheetId=target.spreadsheet_id,
+        ranges=[a1_range(target.tab, f"{RESERVATION_ID_COLUMN}{row_number}") for row_number in row_numbers]
+    ), "sheets_verify", kind="read")
+    cells = {}
+    for row_number, value_range in zip(row_numbers, result.get("valueRanges", [])): # Mismo orden que 'ranges'
+        values = value_range.get("values") or [[]]
+        cells[row_number] = str(values[0][0]).strip() if values[0] else ""
+    return cells
+
+# Relocaliza todas las filas del índice de 'target' con una lectura de la columna de reservation_id y, si
+# hay filas ancladas, un search_row_anchors. Un ancla vale si su fila tiene esa reserva; si no (se ordenó
+# la hoja entre un append y su ancla, o un orden que no movió las anclas) se vuelve a anclar donde esté
+# la reserva, igual que las filas sin ancla. Las que no aparecen se quitan del índice. Las correcciones se
+# guardan en bloques con INSERT ... ON CONFLICT.
+def relocate_index_rows(target, column=None):
+    key = target_key(target)
+    with db_connection() as connection:
+        entries = connection.execute(
+            select(ReservationIndex.reservation_id, ReservationIndex.sheet_row_number, ReservationIndex.sheet_id)
+            .where(ReservationIndex.target == key)
+        ).all()
+    anchors = search_row_anchors(target) if any(sheet_id is not None for _, _, sheet_id in entries) else {}
+    column = column or read_reservation_id_column(target)
+    positions = reservation_positions(column)
+
+    moved, unanchored, deleted, stale = [], [], [], []
+    relocated = 0
+    for reservation_id, row_number, sheet_id in entries:
+        anchor_row = anchors.get(reservation_id)
+        if sheet_id is not None and anchor_row is not None and column.get(anchor_row) == reservation_id:
+            current_row = anchor_row
+        else:
+            if reservation_id in anchors:
+                stale.append(reservation_id)
+            current_row = positions.get(reservation_id)
+            sheet_id = None
+        if current_row is None:
+            deleted.append({"target": key, "reservation_id": reservation_id})
+            continue
+        relocated += current_row != row_number
+        if sheet_id is None:
+            unanchored.append({"target": key, "reservation_id": reservation_id, "sheet_row_number": current_row, "sheet_id": None})
+        elif current_row != row_number:
+            moved.append({"target": key, "reservation_id": reservation_id, "sheet_row_number": current_row, "sheet_id": sheet_id})
+
+    for start in range(0, max(len(unanchored), len(stale)), SHEETS_ROW_ANCHOR_CHUNK):
+        anchor_index_rows(target, unanchored[start:start + SHEETS_ROW_ANCHOR_CHUNK], source="verify", stale=stale[start:start + SHEETS_ROW_ANCHOR_CHUNK])
+    rows = moved + unanchored
+    for start in range(0, len(rows), SHEETS_ROW_ANCHOR_CHUNK):
+        upsert_reservation_index(rows[start:start + SHEETS_ROW_ANCHOR_CHUNK])
+    forget_deleted_rows(deleted)
+    anchored = sum(row["sheet_id"] is not None for row in unanchored)
+    metrics.inc("sheets_row_relocations_total", relocated, source="verify")
+    logger.info("Pestaña relocalizada", extra=log_fields(tab=target.tab, relocated=relocated, anchored=anchored, stale_anchors=len(stale), deleted=len(deleted)))
+    return {"relocated": relocated, "anchored": anchored, "deleted": len(deleted)}
+
+# Comprueba una muestra al azar de filas del índice de 'target' (todas con sample_size=0) contra su celda
+# de reservation_id. Si alguna no coincide relocaliza la pestaña entera; si no, ancla las verificadas que
+# aún no tenían ancla y caben en el presupuesto de anclas de la hoja. Devuelve un resumen.
+def verify_index_rows(target, sample_size=SHEETS_ROW_VERIFY_SAMPLE):
+    key = target_key(target)
+    query = select(ReservationIndex.reservation_id, ReservationIndex.sheet_row_number, ReservationIndex.sheet_id).where(ReservationIndex.target == key)
+    with db_connection() as connection:
+        sample = connection.execute(query.order_by(func.random()).limit(sample_size) if sample_size > 0 else query).all()
+    summary = {"target": key, "sampled": len(sample), "mismatched": 0, "relocated": 0, "anchored": 0, "deleted": 0}
+    if not sample:
+        return summary
+
+    # Todas las filas: una lectura de la columna entera en lugar de miles de rangos sueltos
+    cells = read_reservation_id_column(target) if sample_size <= 0 else read_reservation_id_cells(target, [row_number for _, row_number, _ in sample])
+    summary["mismatched"] = sum(cells.get(row_number) != reservation_id for reservation_id, row_number, _ in sample)
+    if summary["mismatched"]:
+        metrics.inc("sheets_row_verifications_total", result="drift")
+        logger.warning("Filas verificadas fuera de su sitio en el índice: se relocaliza la pestaña", extra=log_fields(tab=target.tab, mismatched=summary["mismatched"], sampled=len(sample)))
+        summary.update(relocate_index_rows(target, column=cells if sample_size <= 0 else None))
+        return summary
+
+    metrics.inc("sheets_row_verifications_total", result="ok")
+    verified = [
+        {"target": key, "reservation_id": reservation_id, "sheet_row_number": row_number, "sheet_id": None}
+        for reservation_id, row_number, sheet_id in sample if sheet_id is None
+    ]
+    for start in range(0, len(verified), SHEETS_ROW_ANCHOR_CHUNK):
+        anchor_index_rows(target, verified[start:start + SHEETS_ROW_ANCHOR_CHUNK], source="verify")
+    verified = [row for row in verified if row["sheet_id"] is not None]
+    for start in range(0, len(verified), SHEETS_ROW_ANCHOR_CHUNK):
+        upsert_reservation_index(verified[start:start + SHEETS_ROW_ANCHOR_CHUNK])
+    summary["anchored"] = len(verified)
+    return summary
+
+# Verifica las pestañas de 'targets' o, sin ellas, todas las que tienen reservas en el índice
+def verify_index_tabs(targets=None, sample_size=SHEETS_ROW_VERIFY_SAMPLE):
+    if sheets_service is None:
+        raise RuntimeError("Servicio de Google Sheets no disponible.")
+    if not targets:
+        with db_connection() as connection:
+            targets = [parse_target_key(key) for key in connection.execute(select(distinct(ReservationIndex.target))).scalars()]
+    summaries = []
+    for target in targets:
+        try:
+            summaries.append(verify_index_rows(target, sample_size))
+        except Exception as e:
+            Session().rollback()
+            metrics.inc("sheets_row_verifications_total", result="error")
+            logger.error("Error verificando las filas de la pestaña", extra=log_fields(target=target_key(target), error=str(e)))
+    return summaries
+
+# Pasada programada (cada SHEETS_ROW_VERIFY_INTERVAL_SECONDS) desde el drenador del outbox
+def run_row_verification():
+    try:
+        verify_index_tabs()
+    except Exception as e:
+        Session().rollback()
+        logger.error("Error en la verificación de filas del índice", extra=log_fields(error=str(e)))
+
+# --- OUTBOX PERSISTENTE: encolado y entrega con reintentos ---
+
+# Fecha/hora UTC sin zona horaria (así se guarda en las columnas DateTime del outbox)
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# --- DEDUPLICACIÓN DE WEBHOOKS (meta.eventId / messageId) ---
+
+# Clave de idempotencia del webhook, o None si Guesty no envía ninguna
+def webhook_event_key(data):
+    meta = data.get("meta") or {}
+    return meta.get("eventId") or meta.get("messageId") or None
+
+class RecentEventIds:
+    """IDs de eventos vistos recientemente, acotados en tamaño y con caducidad (TTL)."""
+
+    def __init__(self, max_size, ttl_seconds):
+        self._max_size = max_size
+        self._ttl = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, event_key):
+        with self._lock:
+            expires_at = self._entries.get(event_key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[event_key]
+                return False
+            return True
+
+    def add(self, event_key):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[event_key] = time.monotonic() + self._ttl
+            self._entries.move_to_end(event_key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, event_key):
+        with self._lock:
+            self._entries.pop(event_key, None)
+
+recent_event_ids = RecentEventIds(DEDUP_MEMORY_SIZE, min(DEDUP_MEMORY_TTL_SECONDS, DEDUP_TTL_SECONDS))
+
+def processed_event_values(event_key, data):
+    return {
+        "event_id": str(event_key),
+        "reservation_id": str((data.get("reservation") or {}).get("_id") or ""),
+        "received_at": utcnow(),
+    }
+
+def new_processed_event(event_key, data):
+    return ProcessedEvent(**processed_event_values(event_key, data))
+
+# Comprobación para el modo síncrono (sin outbox): memoria y, si no está, la tabla processed_event
+def is_duplicate_event(event_key):
+    if recent_event_ids.seen(event_key):
+        return True
+    try:
+        with db_connection() as connection:
+            found = connection.execute(
+                select(ProcessedEvent.event_id).where(ProcessedEvent.event_id == str(event_key))
+            ).first()
+        if found is not None:
+            recent_event_ids.add(event_key)
+            return True
+    except Exception as e:
+        logger.error("Error consultando la tabla de eventos procesados", extra=log_fields(event_key=event_key, error=str(e)))
+    return False
+
+# Recuerda un evento ya aplicado en el modo síncrono (si otro worker se adelantó, no pasa nada)
+def remember_processed_event(event_key, data):
+    try:
+        with db_connection() as connection:
+            connection.execute(
+                dialect_insert(ProcessedEvent.__table__).values(processed_event_values(event_key, data))
+                .on_conflict_do_nothing(index_elements=["event_id"])
+            )
+    except Exception as e:
+        logger.error("Error guardando el evento procesado", extra=log_fields(event_key=event_key, error=str(e)))
+    recent_event_ids.add(event_key)
+
+# Borra de processed_event los IDs más viejos que DEDUP_TTL_SECONDS
+def prune_processed_events():
+    try:
+        cutoff = utcnow() - timedelta(seconds=DEDUP_TTL_SECONDS)
+        deleted = Session().query(ProcessedEvent).filter(ProcessedEvent.received_at < cutoff).delete(synchronize_session=False)
+        Session().commit()
+        if deleted:
+            logger.info("Eventos procesados antiguos eliminados de la tabla de deduplicación", extra=log_fields(events=deleted))
+    except Exception as e:
+        Session().rollback()
+        logger.error("Error purgando la tabla de eventos procesados", extra=log_fields(error=str(e)))
+
+# Shard fijo de una reserva (crc32 es estable entre procesos, a diferencia de hash())
+def outbox_shard(reservation_id):
+    return zlib.crc32(str(reservation_id).encode("utf-8")) % OUTBOX_SHARDS
+
+# Nueva fila del outbox para un webhook ya validado
+def outbox_record_values(data):
+    now = utcnow()
+    return {
+        "reservation_id": str(data["reservation"]["_id"]),
+        "shard": outbox_shard(data["reservation"]["_id"]),
+        "payload": json_dumps(data),
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+
+def new_outbox_record(data):
+    return WebhookOutbox(**outbox_record_values(data))
+
+# Una sola sentencia (PostgreSQL) que registra el ID del evento y encola el webhook, de forma atómica:
+#   WITH inserted_event AS (INSERT INTO processed_event ... ON CONFLICT DO NOTHING RETURNING event_id)
+#   INSERT INTO webhook_outbox ... SELECT ... FROM inserted_event RETURNING id
+# Si el ID ya existía (reintento de Guesty) no se inserta nada y no devuelve filas.
+def enqueue_webhook_stmt(data, event_key=None):
+    values = outbox_record_values(data)
+    outbox_insert = insert(WebhookOutbox.__table__)
+    if not event_key:
+        return outbox_insert.values(values).returning(WebhookOutbox.id)
+    inserted_event = (
+        dialect_insert(ProcessedEvent.__table__).values(processed_event_values(event_key, data))
+        .on_conflict_do_nothing(index_elements=["event_id"])
+        .returning(ProcessedEvent.event_id)
+        .cte("inserted_event")
+    )
+    outbox_row = select(*[
+        literal(value, WebhookOutbox.__table__.c[column].type).label(column) for column, value in values.items()
+    ]).select_from(inserted_event)
+    return outbox_insert.from_select(list(values), outbox_row).returning(WebhookOutbox.id)
+
+# Guarda el webhook en el outbox. Es lo único que se hace dentro de la solicitud HTTP: en PostgreSQL,
+# un único viaje a la DB (enqueue_webhook_stmt en autocommit). En SQLite (solo local), que no admite
+# INSERT dentro de un WITH, el ID del evento va en la misma transacción y un repetido da IntegrityError.
+# Devuelve False si el evento ya estaba registrado (reintento de Guesty entregado a otro worker).
+def enqueue_webhook(data, event_key=None):
+    with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+        if get_engine().dialect.name == "postgresql":
+            with db_connection() as connection:
+                queued = connection.execute(enqueue_webhook_stmt(data, event_key)).first() is not None
+        else:
+            try:
+                if event_key:
+                    Session().add(new_processed_event(event_key, data))
+                Session().add(new_outbox_record(data))
+                Session().commit()
+                queued = True
+            except IntegrityError:
+                Session().rollback()
+                queued = False
+    if event_key:
+        recent_event_ids.add(event_key)
+    if queued:
+        outbox_drainer.start()
+    return queued
+
+# --- INGESTA EN BLOQUE (/webhook/batch y reproducir_historial.py) ---
+# Para cargar el histórico de una cuenta nueva o recuperarse de una caída: muchos payloads de Guesty de
+# una vez, encolados en el outbox con unos pocos INSERT de varias filas. El drenador los entrega como
+# cualquier otro evento, SHEETS_FLUSH_MAX_ROWS por bloque: misma extracción (SHEET_FIELDS), un único
+# SELECT ... IN (...) del índice por bloque y un batchUpdate por hoja más un append por pestaña.
+WEBHOOK_BATCH_MAX_EVENTS = int(os.getenv("WEBHOOK_BATCH_MAX_EVENTS", 10000)) # Por solicitud a /webhook/batch
+WEBHOOK_BATCH_MAX_BYTES = int(os.getenv("WEBHOOK_BATCH_MAX_BYTES", 64 * 1024 * 1024)) # Cuerpo máximo de /webhook/batch (413 si lo supera)
+WEBHOOK_BATCH_READ_CHUNK_BYTES = 1024 * 1024
+WEBHOOK_BATCH_CHUNK_SIZE = int(os.getenv("WEBHOOK_BATCH_CHUNK_SIZE", 1000)) # Filas por INSERT de varias filas
+
+metrics.describe("webhook_batch_events_total", "counter", "Eventos recibidos por /webhook/batch o reproducir_historial.py por resultado.")
+
+# Un elemento del bloque puede ser un webhook completo ({"event", "reservation", "meta"}) o solo la
+# reserva tal como la devuelve la API de Guesty: esta se trata como 'reservation.new' (se añade si no
+# está en la hoja y se actualiza si ya está).
+def normalize_batch_event(item):
+    if isinstance(item, dict) and "reservation" not in item and item.get("_id"):
+        return {"event": "reservation.new", "reservation": item}
+    return item
+
+# Resultado de la validación de un evento del bloque: 'accepted', 'ignored' (tipo de evento que no se procesa) o 'rejected'
+def batch_event_status(data):
+    if not isinstance(data, dict) or not isinstance(data.get("reservation"), dict):
+        return "rejected"
+    if data.get("event") not in ["reservation.new", "reservation.updated"]:
+        return "ignored"
+    return "accepted" if data["reservation"].get("_id") else "rejected"
+
+# Objetos de un NDJSON (una línea JSON por evento); las líneas que no son JSON válido dan None
+def iter_ndjson(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json_loads(line)
+        except ValueError as e:
+            logger.warning("Línea del NDJSON descartada", extra=log_fields(line=line_number, error=str(e)))
+            yield None
+
+# Cuerpo de una solicitud leído por trozos hasta 'max_bytes': None si lo supera (también sin Content-Length,
+# con transferencia chunked), así un cliente no hace cargar en memoria un cuerpo sin límite
+def read_limited_body(stream, max_bytes):
+    chunks, size = [], 0
+    while True:
+        chunk = stream.read(min(WEBHOOK_BATCH_READ_CHUNK_BYTES, max_bytes + 1 - size))
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+
+# Cuerpo de /webhook/batch: NDJSON (application/x-ndjson), una lista JSON o un objeto con la lista en
+# 'events' o 'results' (la forma de las respuestas paginadas de la API de Guesty)
+def parse_batch_body(body, mimetype):
+    if mimetype in ("application/x-ndjson", "application/jsonl"):
+        return list(iter_ndjson(body.splitlines()))
+    payload = json_loads(body)
+    if isinstance(payload, dict):
+        payload = payload.get("events", payload.get("results"))
+    if not isinstance(payload, list):
+        raise ValueError("se esperaba una lista de eventos, un objeto con 'events' o 'results', o NDJSON")
+    return payload
+
+# Encola en una sola transacción un bloque de webhooks ya validados. Los IDs de evento van en
+# INSERT ... ON CONFLICT DO NOTHING RETURNING: los que no vuelven ya estaban registrados (reintentos
+# o eventos ya procesados) y no se encolan. Devuelve (encolados, duplicados).
+def enqueue_webhooks(events):
+    keyed_events = []
+    batch_keys = set()
+    for data in events:
+        event_key = webhook_event_key(data)
+        event_key = str(event_key) if event_key else None
+        if event_key and (event_key in batch_keys or recent_event_ids.seen(event_key)):
+            continue
+        if event_key:
+            batch_keys.add(event_key)
+        keyed_events.append((event_key, data))
+
+    session = Session()
+    queued = []
+    try:
+        for start in range(0, len(keyed_events), WEBHOOK_BATCH_CHUNK_SIZE):
+            chunk = keyed_events[start:start + WEBHOOK_BATCH_CHUNK_SIZE]
+            event_rows = [processed_event_values(event_key, data) for event_key, data in chunk if event_key]
+            new_keys = set()
+            if event_rows:
+                new_keys = set(session.scalars(
+                    dialect_insert(ProcessedEvent.__table__).values(event_rows)
+                    .on_conflict_do_nothing(index_elements=["event_id"])
+                    .returning(ProcessedEvent.event_id)
+                ))
+            chunk_queued = [data for event_key, data in chunk if event_key is None or event_key in new_keys]
+            if chunk_queued:
+                session.execute(insert(WebhookOutbox.__table__), [outbox_record_values(data) for data in chunk_queued])
+            queued.extend(chunk_queued)
+        with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    for event_key in batch_keys:
+        recent_event_ids.add(event_key)
+    return len(queued), len(events) - len(queued)
+
+# Valida y encola un bloque de payloads (ver normalize_batch_event) y devuelve cuántos hubo de cada tipo
+def ingest_batch(items):
+    summary = {"received": 0, "queued": 0, "duplicate": 0, "ignored": 0, "rejected": 0}
+    accepted = []
+    for item in items:
+        summary["received"] += 1
+        data = normalize_batch_event(item)
+        status = batch_event_status(data)
+        if status == "accepted":
+            accepted.append(data)
+        else:
+            summary[status] += 1
+    if accepted:
+        summary["queued"], summary["duplicate"] = enqueue_webhooks(accepted)
+    for result in ("queued", "duplicate", "ignored", "rejected"):
+        if summary[result]:
+            metrics.inc("webhook_batch_events_total", summary[result], result=result)
+    return summary
+
+# Segundos a esperar antes del siguiente intento: respeta Retry-After si Google lo envía,
+# si no, backoff exponencial con jitter.
+def retry_delay_seconds(attempts, error=None):
+    return backoff_delay_seconds(attempts, error, OUTBOX_RETRY_BASE_SECONDS, OUTBOX_RETRY_MAX_SECONDS)
+
+# Shards con algún evento listo para entregar
+def pending_shards_select(now):
+    return (
+        select(distinct(WebhookOutbox.shard))
+        .where(WebhookOutbox.status == "pending")
+        .where(WebhookOutbox.next_attempt_at <= now)
+        .where((WebhookOutbox.locked_until == None) | (WebhookOutbox.locked_until < now))
+    )
+
+# Toma los shards libres (o caducados, o ya propios) de la lista; RETURNING dice cuáles se consiguieron
+def acquire_shard_leases_stmt(shards, owner, now):
+    return (
+        update(OutboxShardLease)
+        .where(OutboxShardLease.shard.in_(shards))
+        .where((OutboxShardLease.locked_until == None) | (OutboxShardLease.locked_until < now) | (OutboxShardLease.owner == owner))
+        .values(owner=owner, locked_until=now + timedelta(seconds=OUTBOX_LEASE_SECONDS))
+        .returning(OutboxShardLease.shard)
+    )
+
+def release_shard_leases_stmt(shards, owner):
+    return (
+        update(OutboxShardLease)
+        .where(OutboxShardLease.shard.in_(shards))
+        .where(OutboxShardLease.owner == owner)
+        .values(owner=None, locked_until=None)
+    )
+
+# Prolonga OUTBOX_LEASE_SECONDS desde 'now' el lease de los shards que siguen siendo de 'owner' (devuelve
+# cuáles) y el de las filas del outbox que se están entregando
+def renew_outbox_leases_stmts(shards, owner, record_ids, now):
+    locked_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+    return (
+        update(OutboxShardLease)
+        .where(OutboxShardLease.shard.in_(shards))
+        .where(OutboxShardLease.owner == owner)
+        .values(locked_until=locked_until)
+        .returning(OutboxShardLease.shard),
+        update(WebhookOutbox).where(WebhookOutbox.id.in_(record_ids)).values(locked_until=locked_until),
+    )
+
+# Un shard que ya no es nuestro lo puede estar drenando otro worker: se avisa para revisar OUTBOX_LEASE_*
+def report_lost_shard_leases(shards, renewed_shards):
+    lost = sorted(set(shards) - set(renewed_shards))
+    if lost:
+        metrics.inc("outbox_shard_leases_lost_total", len(lost))
+        logger.warning("Lease de shards del outbox perdido a mitad de entrega", extra=log_fields(shards=lost))
+
+metrics.describe("outbox_shard_leases_lost_total", "counter", "Shards del outbox cuyo lease caducó o pasó a otro worker a mitad de una entrega.")
+
+def renew_outbox_leases(shards, owner, record_ids):
+    shard_stmt, records_stmt = renew_outbox_leases_stmts(shards, owner, record_ids, utcnow())
+    with db_connection() as connection:
+        renewed_shards = connection.execute(shard_stmt).scalars().all()
+        connection.execute(records_stmt)
+    report_lost_shard_leases(shards, renewed_shards)
+
+# Renueva los leases en un hilo aparte mientras dura el bloque 'with' (la entrega a Sheets). Se detiene
+# antes de borrar o marcar las filas, para no competir con esa transacción por los mismos registros.
+@contextmanager
+def outbox_lease_heartbeat(shards, owner, record_ids):
+    stop = threading.Event()
+
+    def renew_until_stopped():
+        try:
+            while not stop.wait(OUTBOX_LEASE_RENEW_SECONDS):
+                try:
+                    renew_outbox_leases(shards, owner, record_ids)
+                except Exception as e:
+                    logger.error("Error renovando el lease de los shards del outbox", extra=log_fields(shards=shards, error=str(e)))
+        finally:
+            Session.remove()
+
+    thread = threading.Thread(target=renew_until_stopped, name="outbox-lease-renewal", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+# Elige qué shards intentar tomar: un reparto aleatorio de los pendientes entre los workers,
+# para que todos avancen y ninguno acapare todos los shards (con un solo worker, todos).
+def shards_to_claim(pending_shards):
+    pending_shards = list(pending_shards)
+    random.shuffle(pending_shards)
+    share = -(-len(pending_shards) // max(OUTBOX_WORKERS, 1))
+    return pending_shards[:share]
+
+# SELECT del siguiente bloque de filas pendientes a reservar (lease). En PostgreSQL,
+# FOR UPDATE SKIP LOCKED evita que dos workers tomen las mismas filas.
+def claimable_outbox_select(now, limit, shards=None):
+    # Reservas con un evento esperando reintento: sus eventos posteriores también esperan,
+    # para no escribir en Sheets un estado más nuevo que luego sería pisado por uno más viejo.
+    backing_off = (
+        select(WebhookOutbox.reservation_id)
+        .where(WebhookOutbox.status == "pending")
+        .where(WebhookOutbox.next_attempt_at > now)
+    )
+    stmt = (
+        select(WebhookOutbox)
+        .where(WebhookOutbox.status == "pending")
+        .where(WebhookOutbox.next_attempt_at <= now)
+        .where((WebhookOutbox.locked_until == None) | (WebhookOutbox.locked_until < now))
+        .where(~WebhookOutbox.reservation_id.in_(backing_off))
+    )
+    if shards is not None:
+        stmt = stmt.where(WebhookOutbox.shard.in_(shards))
+    return stmt.order_by(WebhookOutbox.id).limit(limit).with_for_update(skip_locked=True)
+
+# Programa el reintento (o marca como 'dead') las filas de un bloque que no se pudo entregar
+def mark_outbox_failure(records, error):
+    for record in records:
+        record.attempts += 1
+        record.last_error = str(error)[:2000]
+        record.locked_until = None
+        if record.attempts >= OUTBOX_MAX_ATTEMPTS:
+            record.status = "dead"
+        else:
+            record.next_attempt_at = utcnow() + timedelta(seconds=retry_delay_seconds(record.attempts, error))
+    logger.error("Error al escribir el bloque en Google Sheets: reintento programado", extra=log_fields(
+        events=len(records),
+        status=error.resp.status if isinstance(error, HttpError) else None,
+        attempts=max(record.attempts for record in records),
+        dead=sum(record.status == "dead" for record in records),
+        error=str(error),
+    ))
+
+# Un registro 'dead' ya no se entregará: su ID de evento se borra de processed_event (en la transacción de
+# 'session') y de la memoria de este proceso, para que el reintento de Guesty se vuelva a encolar
+def forget_dead_events(session, records):
+    event_keys = {webhook_event_key(json_loads(record.payload)) for record in records if record.status == "dead"} - {None}
+    if not event_keys:
+        return
+    session.execute(delete(ProcessedEvent).where(ProcessedEvent.event_id.in_([str(event_key) for event_key in event_keys])))
+    for event_key in event_keys:
+        recent_event_ids.discard(str(event_key))
+
+# Apunta el fallo de un bloque del outbox en 'session' (ver mark_outbox_failure y forget_dead_events)
+def fail_outbox_records(session, records, error):
+    mark_outbox_failure(records, error)
+    forget_dead_events(session, records)
+
+# Reparte un bloque del outbox en colas por destino (target_key de route_event): cada cola se escribe
+# y se reintenta por separado. Todos los eventos de una reserva van a la cola de su primer evento,
+# en orden, aunque un cambio de checkIn los enrute a otra pestaña.
+def group_outbox_by_target(records):
+    groups = {}
+    reservation_groups = {}
+    for record in records:
+        data = json_loads(record.payload)
+        key = reservation_groups.setdefault(record.reservation_id, target_key(route_event(data)))
+        groups.setdefault(key, []).append((record, data))
+    return groups
+
+# Entrega la cola de un destino (según SHEETS_SINK_MODE); devuelve la excepción en lugar de lanzarla
+def flush_target_batch(events):
+    try:
+        if SHEETS_SINK_MODE == "log":
+            flush_log_batch(events)
+        else:
+            flush_sheets_batch(events)
+        return None
+    except Exception as e:
+        return e
+
+# Igual, desde un hilo del pool de destinos (con su propia sesión de scoped_session)
+def flush_target_batch_in_pool(events):
+    try:
+        return flush_target_batch(events)
+    finally:
+        Session.remove()
+
+metrics.describe("sheets_target_batches_total", "counter", "Bloques entregados a Google Sheets por destino y resultado.")
+
+class OutboxDrainer:
+    """Pool de hilos de fondo que drenan el outbox por shards y entregan cada bloque con flush_sheets_batch."""
+
+    def __init__(self, flush_interval_ms, max_rows, workers):
+        self._flush_interval = flush_interval_ms / 1000.0
+        self._max_rows = max_rows
+        self._workers = workers
+        self._threads = []
+        self._target_pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Los hilos se arrancan de forma perezosa, así cada worker de gunicorn (tras el fork) tiene los suyos propios.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._threads, self._target_pool, self._pid = [], None, os.getpid() # Heredados de otro proceso: no sirven
+            if self._target_pool is None:
+                self._target_pool = ThreadPoolExecutor(max_workers=max(SHEETS_TARGET_CONCURRENCY, 1), thread_name_prefix="outbox-target")
+            if len(self._threads) == self._workers and all(thread.is_alive() for thread in self._threads):
+                return
+            self._threads = [
+                thread if thread is not None and thread.is_alive() else self._start_worker(worker_index)
+                for worker_index, thread in enumerate(self._threads + [None] * (self._workers - len(self._threads)))
+            ]
+
+    def _start_worker(self, worker_index):
+        thread = threading.Thread(target=self._run, args=(worker_index,), name=f"outbox-drainer-{worker_index}", daemon=True)
+        thread.start()
+        return thread
+
+    def _acquire_shards(self, owner):
+        session = Session()
+        now = utcnow()
+        try:
+            pending_shards = session.scalars(pending_shards_select(now)).all()
+            if not pending_shards:
+                session.commit()
+                return []
+            shards = session.scalars(acquire_shard_leases_stmt(shards_to_claim(pending_shards), owner, now)).all()
+            session.commit()
+            return shards
+        except Exception:
+            session.rollback()
+            raise
+
+    def _release_shards(self, shards, owner):
+        session = Session()
+        try:
+            session.execute(release_shard_leases_stmt(shards, owner))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error("Error liberando los shards del outbox (caducarán solos)", extra=log_fields(shards=shards, error=str(e)))
+
+    def _claim_batch(self, session, shards):
+        now = utcnow()
+        try:
+            records = session.scalars(claimable_outbox_select(now, self._max_rows, shards)).all()
+            for record in records:
+                record.locked_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+            session.commit()
+            return records
+        except Exception:
+            session.rollback()
+            raise
+
+    # Entrega cada cola por destino y devuelve {destino: excepción o None}
+    def _flush_groups(self, groups):
+        if len(groups) == 1:
+            # Un solo destino (siempre, sin enrutado): se entrega en este mismo hilo
+            errors = {key: flush_target_batch([data for _, data in group]) for key, group in groups.items()}
+            if any(errors.values()):
+                Session().rollback()
+            return errors
+        futures = {
+            key: self._target_pool.submit(flush_target_batch_in_pool, [data for _, data in group])
+            for key, group in groups.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def _deliver(self, session, shards, owner, records):
+        groups = group_outbox_by_target(records)
+        with outbox_lease_heartbeat(shards, owner, [record.id for record in records]):
+            errors = self._flush_groups(groups)
+        for key, group in groups.items():
+            error = errors[key]
+            metrics.inc("sheets_target_batches_total", target=key, result="ok" if error is None else "error")
+            if error is None:
+                for record, _ in group:
+                    session.delete(record)
+            else:
+                fail_outbox_records(session, [record for record, _ in group], error)
+        session.commit()
+
+    # Un ciclo de drenado: toma shards, entrega un bloque de sus eventos y los libera. Los registros van en
+    # una OutboxSession propia, separada de la sesión del hilo que usa flush_sheets_batch.
+    def _drain_once(self, owner):
+        shards = self._acquire_shards(owner)
+        if not shards:
+            return 0
+        try:
+            with OutboxSession() as session:
+                records = self._claim_batch(session, shards)
+                if records:
+                    self._deliver(session, shards, owner, records)
+                return len(records)
+        finally:
+            self._release_shards(shards, owner)
+
+    def _run(self, worker_index):
+        owner = f"{socket.gethostname()}:{os.getpid()}:{worker_index}"
+        next_prune_at = time.monotonic()
+        next_compaction_at = time.monotonic() + SHEETS_COMPACTION_INTERVAL_SECONDS
+        next_verification_at = time.monotonic() + SHEETS_ROW_VERIFY_INTERVAL_SECONDS
+        startup_warmup.wait(*startup_steps_for_writes(direct=True)) # Tablas y encabezado listos antes de drenar
+        if worker_index == 0:
+            # Precarga de la caché del índice en este hilo de fondo, fuera del camino de las solicitudes
+            warm_reservation_cache()
+            Session.remove()
+
+        while True:
+            if worker_index == 0 and time.monotonic() >= next_prune_at:
+                prune_processed_events()
+                Session.remove()
+                next_prune_at = time.monotonic() + DEDUP_PRUNE_INTERVAL_SECONDS
+            if worker_index == 0 and SHEETS_SINK_MODE == "log" and SHEETS_COMPACTION_INTERVAL_SECONDS > 0 and time.monotonic() >= next_compaction_at:
+                run_log_compaction()
+                next_compaction_at = time.monotonic() + SHEETS_COMPACTION_INTERVAL_SECONDS
+            if worker_index == 0 and SHEETS_SINK_MODE == "rows" and SHEETS_ROW_VERIFY_INTERVAL_SECONDS > 0 and time.monotonic() >= next_verification_at:
+                run_row_verification()
+                Session.remove()
+                next_verification_at = time.monotonic() + SHEETS_ROW_VERIFY_INTERVAL_SECONDS
+            try:
+                drained = self._drain_once(owner)
+            except Exception as e:
+                drained = 0
+                logger.error("Error en el drenado del outbox", extra=log_fields(error=str(e)))
+            finally:
+                Session.remove() # Cada hilo de fondo usa su propia sesión de scoped_session
+
+            # Con un bloque lleno se sigue drenando sin esperar; si no, se espera a la siguiente ventana
+            if drained < self._max_rows:
+                time.sleep(self._flush_interval)
+
+outbox_drainer = OutboxDrainer(SHEETS_FLUSH_INTERVAL_MS, SHEETS_FLUSH_MAX_ROWS, OUTBOX_WORKERS)
+
+# Profundidad del outbox en cada scrape: eventos esperando a Sheets (p. ej. por falta de cuota) y 'dead'
+def outbox_depth_metrics():
+    try:
+        depth = {"pending": 0, "dead": 0}
+        depth.update(Session().query(WebhookOutbox.status, func.count()).group_by(WebhookOutbox.status).all())
+    except Exception as e:
+        Session().rollback()
+        logger.error("Error contando el outbox para /metrics", extra=log_fields(error=str(e)))
+        return []
+    return [("webhook_outbox_depth", {"status": status}, count) for status, count in depth.items()]
+
+metrics.register_collector(outbox_depth_metrics)
+metrics.describe("webhook_outbox_depth", "gauge", "Webhooks en el outbox por estado (pending/dead).")
+
+# --- ESCRITURA DIRECTA (WRITE_BEHIND_ENABLED=False): LEASE DEL SHARD EN LA DB ---
+# Las escrituras directas de una reserva se serializan con el mismo lease por shard que usa el drenador
+# (outbox_shard_lease), así no se pisan ni entre hilos ni entre workers de gunicorn ni con el drenador
+# que entrega los eventos que acabaron en el outbox. Si el lease no llega a tiempo el evento se encola.
+DIRECT_LEASE_POLL_SECONDS = float(os.getenv("DIRECT_LEASE_POLL_SECONDS", 0.05))
+
+# Dueño del lease de una solicitud directa: único por hilo (cada hilo de solicitudes es un "worker")
+def direct_lease_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:direct-{threading.get_ident()}"
+
+# Toma el lease del shard de la reserva esperando como mucho 'max_wait' segundos; devuelve si lo tiene
+@contextmanager
+def direct_shard_lease(reservation_id, max_wait):
+    shard, owner = outbox_shard(reservation_id), direct_lease_owner()
+    deadline = time.monotonic() + max_wait
+    while True:
+        with db_connection() as connection:
+            acquired = connection.execute(acquire_shard_leases_stmt([shard], owner, utcnow())).scalars().all()
+        if acquired or time.monotonic() >= deadline:
+            break
+        time.sleep(min(DIRECT_LEASE_POLL_SECONDS, max(deadline - time.monotonic(), 0.0)))
+    if not acquired:
+        metrics.inc("direct_lease_timeouts_total")
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        try:
+            with db_connection() as connection:
+                connection.execute(release_shard_leases_stmt([shard], owner))
+        except Exception as e:
+            logger.error("Error liberando el shard de la escritura directa (caducará solo)", extra=log_fields(shard=shard, error=str(e)))
+
+metrics.describe("direct_lease_timeouts_total", "counter", "Escrituras directas que no consiguieron el lease de su shard a tiempo y pasaron al outbox.")
+
+# --- ARRANQUE RÁPIDO: CALENTAMIENTO EN SEGUNDO PLANO Y TIEMPOS DE ARRANQUE ---
+# El servidor acepta conexiones en cuanto se importa el módulo. Lo caro (crear/verificar las tablas, abrir
+# la primera conexión del pool, construir el cliente de Sheets con su token y asegurar el encabezado) lo
+# hace un hilo de fondo, paso a paso; cada solicitud espera solo a los pasos que necesita y siguen pendientes.
+STARTUP_WARMUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_WARMUP_TIMEOUT_SECONDS", 30))
+
+# Segundos de cada etapa del arranque ('import' y los pasos del calentamiento), también en /metrics
+startup_timings = OrderedDict()
+
+def startup_timing_metrics():
+    return [("startup_stage_seconds", {"stage": stage}, round(seconds, 4)) for stage, seconds in list(startup_timings.items())]
+
+metrics.register_collector(startup_timing_metrics)
+metrics.describe("startup_stage_seconds", "gauge", "Duración de cada etapa del arranque del proceso (importación y calentamiento).")
+
+# Abre (y devuelve al pool) la primera conexión de la DB
+def warm_db_pool():
+    with get_engine().connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+def warm_sheets_client():
+    if sheets_service is not None:
+        sheets_service.warm_up()
+
+# Pasos del calentamiento como (nombre, función, fatal). Con 'ensure_schema' también se crean/migran las
+# tablas y se asegura el encabezado (start_process_services); sin él solo se calientan los clientes.
+def startup_steps(ensure_schema=False):
+    steps = []
+    if ensure_schema:
+        steps.append(("db_tables", create_db_tables, False))
+    steps.append(("db_pool", warm_db_pool, False))
+    steps.append(("sheets_client", warm_sheets_client, False))
+    if ensure_schema:
+        steps.append(("sheets_header", ensure_header_row_exists_global, True))
+    return steps
+
+class StartupWarmup:
+    """Hilo de fondo que ejecuta los pasos de arranque en orden; si falla un paso fatal, termina el proceso."""
+
+    def __init__(self):
+        self._done = {}
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, steps=None):
+        # Igual que el drenador del outbox: una vez por proceso, así cada worker de gunicorn (tras el fork) tiene el suyo
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            steps = steps if steps is not None else startup_steps()
+            self._done = {name: threading.Event() for name, _, _ in steps}
+            self._thread = threading.Thread(target=self._run, args=(steps,), name="startup-warmup", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, steps):
+        for name, function, fatal in steps:
+            started = time.perf_counter()
+            try:
+                function()
+            except Exception as e:
+                if fatal:
+                    logger.critical("FATAL ERROR: falló un paso obligatorio del arranque", extra=log_fields(step=name, error=str(e)))
+                    # sys.exit desde un hilo solo termina el hilo: se vacían los logs (atexit) y se sale del proceso
+                    atexit._run_exitfuncs()
+                    os._exit(1)
+                logger.error("Error en un paso del arranque", extra=log_fields(step=name, error=str(e)))
+            finally:
+                Session.remove()
+            startup_timings[name] = time.perf_counter() - started
+            self._done[name].set()
+        logger.info("Arranque completado", extra=log_fields(
+            duration_seconds=round(time.perf_counter() - MODULE_IMPORT_STARTED_AT, 2),
+            steps_ms={stage: round(seconds * 1000) for stage, seconds in startup_timings.items()},
+        ))
+
+    # Pasos indicados que siguen en marcha (los que no forman parte de este arranque no cuentan)
+    def pending(self, *names):
+        return [name for name in names if name in self._done and not self._done[name].is_set()]
+
+    # Espera a los pasos indicados que sigan pendientes, como mucho STARTUP_WARMUP_TIMEOUT_SECONDS en total
+    def wait(self, *names):
+        pending = self.pending(*names)
+        if not pending:
+            return
+        deadline = time.monotonic() + STARTUP_WARMUP_TIMEOUT_SECONDS
+        for name in pending:
+            if not self._done[name].wait(max(deadline - time.monotonic(), 0)):
+                logger.warning("Un paso del arranque no terminó a tiempo: se sigue sin esperarlo", extra=log_fields(step=name, timeout_seconds=STARTUP_WARMUP_TIMEOUT_SECONDS))
+                return
+
+startup_warmup = StartupWarmup()
+
+# Pasos de los que depende cada escritura: sin tablas no hay outbox ni índice, y sin encabezado
+# un append a una pestaña vacía ocuparía la fila 1
+def startup_steps_for_writes(direct):
+    return ("db_tables", "sheets_header") if direct else ("db_tables",)
+
+# Arranque de un proceso servidor, una sola vez por proceso: tablas y migraciones, encabezado y clientes
+# (en segundo plano) y el drenador del outbox, que entrega lo pendiente de antes del reinicio sin esperar
+# a un webhook nuevo. Lo llaman 'python app.py', cada worker de gunicorn (post_worker_init en
+# gunicorn.conf.py) y, por si el servidor WSGI no pasa por ninguno de los dos, la primera solicitud.
+def start_process_services():
+    startup_warmup.start(startup_steps(ensure_schema=True))
+    outbox_drainer.start()
+
+@app.before_request
+def start_startup_warmup():
+    start_process_services()
+
 # --- Ruta del Webhook de Flask ---
 @app.route("/webhook", methods=["POST"])
+@metrics.timer("webhook_request_duration_seconds")
 def webhook():
-    data = request.json
-    print(f"Webhook recibido: {json.dumps(data, indent=2)}")
+    with metrics.timer("webhook_stage_duration_seconds", stage="parse"):
+        try:
+            data = json_loads(request.get_data())
+        except ValueError as e:
+            return jsonify({"message": f"JSON no válido: {e}"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"message": "Se esperaba un objeto JSON"}), 400
+    # Solo un resumen: el payload completo (decenas de KB) se vuelve a serializar únicamente en DEBUG
+    logger.info("Webhook recibido", extra=log_fields(
+        event=data.get("event"),
+        eventId=(data.get("meta") or {}).get("eventId"),
+        reservation_id=(data.get("reservation") or {}).get("_id"),
+        payload_bytes=request.content_length,
+    ))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Payload del webhook", extra=log_fields(payload=data))
 
     webhook_event_type = data.get("event") 
     
     if webhook_event_type not in ["reservation.new", "reservation.updated"]:
-        print(f"Evento no procesado: {webhook_event_type}. Solo procesamos 'reservation.new' y 'reservation.updated'.")
+        logger.info("Evento no procesado: solo se procesan 'reservation.new' y 'reservation.updated'", extra=log_fields(event=webhook_event_type))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="ignored")
         return jsonify({"message": f"Evento '{webhook_event_type}' no procesado"}), 200
 
-    return update_google_sheets(data)
+    event_key = webhook_event_key(data)
+    if startup_warmup.pending(*startup_steps_for_writes(direct=not WRITE_BEHIND_ENABLED)):
+        with metrics.timer("webhook_stage_duration_seconds", stage="warmup"):
+            startup_warmup.wait(*startup_steps_for_writes(direct=not WRITE_BEHIND_ENABLED))
 
-# --- Punto de entrada principal para Flask ---
-if __name__ == "__main__":
-    create_db_tables()
+    if not WRITE_BEHIND_ENABLED:
+        if event_key and is_duplicate_event(event_key):
+            logger.info("Evento duplicado ignorado", extra=log_fields(event_key=event_key))
+            metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="duplicate")
+            return jsonify({"message": f"Evento {event_key} ya procesado"}), 200
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="direct")
+        reservation_id = (data.get("reservation") or {}).get("_id")
+        if not reservation_id:
+            return update_google_sheets(data) # Responde 400 sin tocar Sheets
+        with sheets_deadline(SHEETS_DIRECT_MAX_WAIT_SECONDS), direct_shard_lease(reservation_id, sheets_deadline_remaining()) as leased:
+            if leased:
+                response_body, status = update_google_sheets(data)
+            else:
+                response_body, status = enqueue_direct_fallback(data, f"Shard {outbox_shard(reservation_id)} ocupado") or ({"message": "Fallo al encolar el webhook"}, 500)
+        if event_key and status == 200:
+            remember_processed_event(event_key, data)
+        return response_body, status
 
+    if event_key and recent_event_ids.seen(event_key):
+        logger.info("Evento duplicado ignorado", extra=log_fields(event_key=event_key))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="duplicate")
+        return jsonify({"message": f"Evento {event_key} ya procesado"}), 200
+
+    reservation_id = (data.get("reservation") or {}).get("_id")
+    if not reservation_id:
+        logger.warning("Reservation ID is missing in the reservation data")
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="rejected")
+        return jsonify({"message": "Reservation ID is missing"}), 400
+
+    # Se responde de inmediato tras guardar en el outbox; la escritura en Sheets la hace el drenador en bloque.
     try:
-        ensure_header_row_exists_global() 
+        queued = enqueue_webhook(data, event_key)
     except Exception as e:
-        print(f"FATAL ERROR: Could not ensure Google Sheets header row: {e}")
-        import sys
-        sys.exit(1)
+        Session().rollback()
+        logger.error("Error guardando el webhook en el outbox", extra=log_fields(reservation_id=reservation_id, error=str(e)))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="error")
+        return jsonify({"message": f"Fallo al encolar el webhook: {str(e)}"}), 500
+    if not queued:
+        logger.info("Evento duplicado ignorado", extra=log_fields(event_key=event_key))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="duplicate")
+        return jsonify({"message": f"Evento {event_key} ya procesado"}), 200
+    metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="queued")
+    return jsonify({"message": f"Reserva {reservation_id} encolada para Google Sheets"}), 202
 
-    port = int(os.environ.get("PORT", 5000))
-    app.run(debug=os.environ.get("FLASK_DEBUG", "False") == "True", host="0.0.0.0", port=port)
+# --- Ruta de ingesta en bloque ---
+# Responde 202 en cuanto el bloque está en el outbox (o 200 si no había nada nuevo que encolar)
+@app.route("/webhook/batch", methods=["POST"])
+@metrics.timer("webhook_batch_request_duration_seconds")
+def webhook_batch():
+    body = None if (request.content_length or 0) > WEBHOOK_BATCH_MAX_BYTES else read_limited_body(request.stream, WEBHOOK_BATCH_MAX_BYTES)
+    if body is None:
+        return jsonify({"message": f"Cuerpo demasiado grande; el máximo por solicitud es {WEBHOOK_BATCH_MAX_BYTES} bytes"}), 413
+    try:
+        items = parse_batch_body(body, request.mimetype)
+    except ValueError as e:
+        logger.warning("Cuerpo de /webhook/batch no válido", extra=log_fields(error=str(e)))
+        return jsonify({"message": f"Cuerpo no válido: {e}"}), 400
+    if len(items) > WEBHOOK_BATCH_MAX_EVENTS:
+        return jsonify({"message": f"Demasiados eventos ({len(items)}); el máximo por solicitud es {WEBHOOK_BATCH_MAX_EVENTS}"}), 413
+
+    startup_warmup.wait(*startup_steps_for_writes(direct=False))
+    try:
+        summary = ingest_batch(items)
+    except Exception as e:
+        logger.error("Error encolando un bloque de eventos", extra=log_fields(events=len(items), error=str(e)))
+        metrics.inc("webhook_batch_events_total", len(items), result="error")
+        return jsonify({"message": f"Fallo al encolar el bloque: {str(e)}"}), 500
+    logger.info("Bloque de webhooks recibido", extra=log_fields(**summary))
+    if summary["queued"]:
+        outbox_drainer.start()
+    return jsonify(summary), 202 if summary["queued"] else 200
 
+# --- Ruta de consulta de reservas (espejo local, sin llamar a Sheets) ---
+@app.route("/reservations", methods=["GET"])
+@metrics.timer("reservations_request_duration_seconds")
+def reservations():
+    if not reservations_authorized(request.headers.get("Authorization")):
+        return jsonify({"message": "No autorizado"}), 401, {"WWW-Authenticate": "Bearer"}
+    try:
+        query = parse_reservations_query(request.args)
+        include_pii = reservations_include_pii(request.args)
+    except ValueError as e:
+        return jsonify({"message": f"Parámetros no válidos: {e}"}), 400
+    startup_warmup.wait("db_tables")
+    with db_connection() as connection:
+        rows = connection.execute(reservations_page_select(**query)).all()
+    return jsonify(reservations_page(rows, query["limit"], include_pii))
+
+# --- Ruta de métricas (formato de texto de Prometheus) ---
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Tiempo de importación del módulo (Flask, SQLAlchemy, modelos y configuración), sin el calentamiento
+startup_timings["import"] = time.perf_counter() - MODULE_IMPORT_STARTED_AT
+logger.info("Módulo importado; el calentamiento sigue en segundo plano", extra=log_fields(import_ms=round(startup_timings["import"] * 1000)))
+
+# --- Punto de entrada principal para Flask ---
+# Se aceptan conexiones de inmediato: tablas, pool, cliente de Sheets y encabezado se preparan en segundo
+# plano (startup_warmup) y si no se puede asegurar el encabezado el proceso termina igual que antes.
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 5000))
+    if SERVER_MODE == "async":
+        import uvicorn
+        # app_async hace 'import app': se le da este mismo módulo para no importar app.py otra vez (con
+        # otro logger, otras métricas y otro drenador) bajo el nombre 'app'
+        sys.modules["app"] = sys.modules[__name__]
+        startup_warmup.start(startup_steps(ensure_schema=True))
+        uvicorn.run("app_async:asgi_app", host="0.0.0.0", port=port)
+    else:
+        start_process_services()
+        app.run(debug=os.environ.get("FLASK_DEBUG", "False") == "True", host="0.0.0.0", port=port)
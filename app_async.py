@@ -0,0 +1,627 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import timedelta
+from urllib.parse import quote
+
+import httpx
+from googleapiclient.errors import HttpError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+# --- MODO ASGI (ASÍNCRONO) DEL SERVIDOR DE WEBHOOKS ---
+# Mismo contrato de /webhook y misma fila de 'field_names' que app.py, pero las llamadas a
+# Google Sheets van por un cliente HTTP asíncrono con un pool de conexiones compartido y la
+# DB por un motor asíncrono de SQLAlchemy: un solo proceso mantiene cientos de webhooks en vuelo.
+#
+# Arranque:  SERVER_MODE=async python app.py
+#   o bien:  gunicorn -k uvicorn.workers.UvicornWorker app_async:asgi_app
+import app as sync_app
+from app import (
+    DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_PRE_PING, DB_POOL_RECYCLE_SECONDS, DB_POOL_TIMEOUT_SECONDS, DEDUP_PRUNE_INTERVAL_SECONDS, DEDUP_TTL_SECONDS, INDEX_ENTRY_COLUMNS, OUTBOX_LEASE_RENEW_SECONDS, OUTBOX_LEASE_SECONDS,
+    OUTBOX_WORKERS, RESERVATION_CACHE_SIZE, SHEETS_API_ENDPOINT, SHEETS_CALL_MAX_ATTEMPTS,
+    SHEETS_COMPACTION_INTERVAL_SECONDS, SHEETS_FLUSH_INTERVAL_MS, SHEETS_FLUSH_MAX_ROWS, SHEETS_RETRY_BASE_SECONDS,
+    SHEETS_RETRY_MAX_SECONDS, SHEETS_ROW_ANCHORS, SHEETS_ROW_VERIFY_INTERVAL_SECONDS, SHEETS_SINK_MODE, IndexEntry, ProcessedEvent, ReservationIndex,
+    WebhookOutbox, a1_range, acquire_shard_leases_stmt, active_append_target, append_candidates, append_maybe_applied, appended_rows_index,
+    WEBHOOK_BATCH_MAX_BYTES, WEBHOOK_BATCH_MAX_EVENTS, anchor_index_rows, anchored_partial_writes, apply_row_anchor_matches, confirm_deleted_rows, drop_deleted_rows, backoff_delay_seconds, cache_index_rows, cached_index_entries, enqueue_webhook_stmt, ingest_batch, instrument_db_pool, claimable_outbox_select, coalesce_events, ensure_log_tab, event_label, forget_deleted_rows_stmts, index_entries_from_rows, index_entries_select,
+    group_outbox_by_target, http_error_status, is_retryable_sheets_error, json_dumps, json_loads, log_deleted_rows, log_fields, log_batch_mirror_rows, logger, fail_outbox_records,
+    metrics, new_outbox_record, new_processed_event, parse_batch_body, parse_reservations_query, pending_shards_select, plan_log_batch, plan_sheets_batch,
+    reconcile_anchored_rows, recent_event_ids, rewrite_found_rows_ranges, row_anchor_capacity, row_anchor_filters, row_anchor_matches, unanchored_entries, record_appends_in_doubt, record_sheets_error, release_shard_leases_stmt, renew_outbox_leases_stmts, report_lost_shard_leases, reservation_index_upsert_stmt, reservation_mirror_upsert_stmt,
+    reservations_authorized, reservations_include_pii, reservations_page, reservations_page_select, resolve_appends_in_doubt, sheets_batch_mirror_rows,
+    reservation_row_cache, run_log_compaction, run_row_verification, shards_to_claim, sheet_snapshot_dirty_stmt, sheet_tab_rows_stmt,
+    sheets_call, sheets_rate_limiter, startup_steps, startup_steps_for_writes, startup_warmup, utcnow, webhook_event_key,
+)
+
+SHEETS_API_BASE_URL = f"{SHEETS_API_ENDPOINT}v4/"
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", 20))
+ASYNC_HTTP_TIMEOUT_SECONDS = float(os.getenv("ASYNC_HTTP_TIMEOUT_SECONDS", 30))
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", 10))
+
+# --- MOTOR ASÍNCRONO DE LA BASE DE DATOS ---
+# Misma DATABASE_URL que el modo síncrono, cambiando el driver por su equivalente asíncrono
+def async_database_url(url):
+    for sync_prefix, async_prefix in (
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgres://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://"),
+    ):
+        if url.startswith(sync_prefix):
+            return async_prefix + url[len(sync_prefix):]
+    return url
+
+# Mismo reciclado y ping que el pool síncrono (DB_POOL_*); el tamaño es propio porque aquí no hay un hilo
+# por solicitud: ASYNC_DB_POOL_SIZE acota las transacciones simultáneas del event loop.
+if DATABASE_URL.startswith("sqlite"):
+    async_engine = create_async_engine(async_database_url(DATABASE_URL), pool_pre_ping=DB_POOL_PRE_PING)
+else:
+    async_engine = create_async_engine(
+        async_database_url(DATABASE_URL),
+        pool_size=ASYNC_DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+        pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+async_autocommit_engine = async_engine.execution_options(isolation_level="AUTOCOMMIT")
+instrument_db_pool(async_engine.sync_engine.pool, "async")
+
+# --- CLIENTE ASÍNCRONO DE LA API DE GOOGLE SHEETS ---
+class AsyncSheetsClient:
+    """Llama a la API REST de Sheets v4 con httpx, reutilizando conexiones keep-alive."""
+
+    def __init__(self, sheets_service):
+        # Las credenciales son las del cliente síncrono (perezoso): se cargan con el primer token
+        self._sheets_service = sheets_service
+        self._credentials = None
+        self._token_lock = asyncio.Lock()
+        self._client = httpx.AsyncClient(
+            base_url=SHEETS_API_BASE_URL,
+            timeout=ASYNC_HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+            ),
+        )
+
+    # Mismo refresco que el cliente síncrono (google_auth_httplib2, bajo su lock): sin depender de 'requests'
+    def _refresh_credentials(self):
+        credentials = self._sheets_service.credentials
+        if not credentials.valid:
+            self._sheets_service.refresh_token()
+        return credentials
+
+    # Cargar las credenciales y refrescar el token usa la librería síncrona de google-auth: se hace en un
+    # hilo aparte y solo una corrutina a la vez, para no bloquear el event loop.
+    async def _access_token(self):
+        if self._sheets_service is None:
+            raise RuntimeError("Servicio de Google Sheets no disponible.")
+        async with self._token_lock:
+            if self._credentials is None or not self._credentials.valid:
+                self._credentials = await asyncio.to_thread(self._refresh_credentials)
+        return self._credentials.token
+
+    async def _request(self, method, path, params=None, body=None):
+        token = await self._access_token()
+        headers = {"Authorization": f"Bearer {token}"}
+        content = None
+        if body is not None:
+            content = json_dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        response = await self._client.request(method, path, params=params, content=content, headers=headers)
+        if response.status_code >= 400:
+            import httplib2 # Ya importado por el calentamiento del cliente síncrono
+            # Mismo tipo de error que googleapiclient, para reutilizar el backoff del outbox (Retry-After incluido)
+            resp = httplib2.Response({"status": response.status_code, **{k.lower(): v for k, v in response.headers.items()}})
+            raise HttpError(resp, response.content, uri=str(response.url))
+        return json_loads(response.content)
+
+    # El limitador usa un lock de hilos y flock sobre su fichero de estado: sus llamadas van a un hilo aparte
+    async def acquire(self, kind):
+        wait = await asyncio.to_thread(sheets_rate_limiter.reserve, kind)
+        if wait > 0:
+            with sheets_rate_limiter.waiting(kind):
+                await asyncio.sleep(wait)
+
+    # Igual que execute_sheets del modo síncrono: limitador compartido y reintentos en 429/5xx,
+    # pero esperando con asyncio.sleep
+    async def _limited_request(self, stage, method, path, kind="write", idempotent=True, params=None, body=None):
+        attempts = 0
+        while True:
+            attempts += 1
+            await self.acquire(kind)
+            try:
+                with sheets_call(stage):
+                    result = await self._request(method, path, params=params, body=body)
+            except HttpError as error:
+                await asyncio.to_thread(record_sheets_error, kind, error, attempts)
+                if attempts >= SHEETS_CALL_MAX_ATTEMPTS or not is_retryable_sheets_error(error, idempotent):
+                    raise
+                delay = backoff_delay_seconds(attempts, error, SHEETS_RETRY_BASE_SECONDS, SHEETS_RETRY_MAX_SECONDS)
+                logger.warning("Error reintentable de Google Sheets: se repite la llamada", extra=log_fields(stage=stage, status=http_error_status(error), attempt=attempts + 1, max_attempts=SHEETS_CALL_MAX_ATTEMPTS, delay_seconds=round(delay, 1)))
+                await asyncio.sleep(delay)
+                continue
+            sheets_rate_limiter.on_success(kind) # Solo cuenta en memoria, sin tocar el fichero
+            return result
+
+    async def values_batch_update(self, spreadsheet_id, data):
+        return await self._limited_request(
+            "sheets_batch_update", "POST", f"spreadsheets/{spreadsheet_id}/values:batchUpdate",
+            body={"valueInputOption": "RAW", "data": data},
+        )
+
+    # Con anclas de fila: 'data' son DataFilterValueRange (ver row_write_data)
+    async def values_batch_update_by_data_filter(self, spreadsheet_id, data):
+        return await self._limited_request(
+            "sheets_batch_update", "POST", f"spreadsheets/{spreadsheet_id}/values:batchUpdateByDataFilter",
+            body={"valueInputOption": "RAW", "data": data},
+        )
+
+    # Fila actual de unas anclas (ver locate_anchored_rows): una lectura
+    async def developer_metadata_search(self, spreadsheet_id, data_filters):
+        return await self._limited_request(
+            "sheets_anchor", "POST", f"spreadsheets/{spreadsheet_id}/developerMetadata:search",
+            kind="read", body={"dataFilters": data_filters},
+        )
+
+    async def values_append(self, spreadsheet_id, range_name, values):
+        return await self._limited_request(
+            "sheets_append", "POST", f"spreadsheets/{spreadsheet_id}/values/{quote(range_name)}:append",
+            idempotent=False,
+            params={"valueInputOption": "RAW"},
+            body={"values": values},
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+sheets_client = AsyncSheetsClient(sync_app.sheets_service)
+
+# --- Funciones auxiliares asíncronas para el índice de reservas ---
+
+# Resuelve las entradas del índice de un bloque de reservas: de la caché y, las que no están, con un
+# único SELECT ... IN (...).
+async def find_reservation_rows_in_db(session, reservation_ids):
+    known_entries, missing = cached_index_entries(reservation_ids)
+    if missing:
+        result = await session.execute(index_entries_select(missing))
+        known_entries.update(index_entries_from_rows(result.all()))
+    return known_entries
+
+async def warm_reservation_cache():
+    if RESERVATION_CACHE_SIZE <= 0:
+        return
+    try:
+        async with AsyncSession() as session:
+            result = await session.stream(
+                select(*INDEX_ENTRY_COLUMNS)
+                .order_by(ReservationIndex.id.desc())
+                .limit(RESERVATION_CACHE_SIZE)
+            )
+            loaded = 0
+            async for reservation_id, *entry_fields in result:
+                if reservation_row_cache.warm(reservation_id, IndexEntry(*entry_fields)):
+                    loaded += 1
+        logger.info("Caché del índice precargada", extra=log_fields(reservations=loaded))
+    except Exception as e:
+        logger.error("Error precargando la caché del índice", extra=log_fields(error=str(e)))
+
+async def prune_processed_events():
+    try:
+        async with AsyncSession() as session:
+            cutoff = utcnow() - timedelta(seconds=DEDUP_TTL_SECONDS)
+            result = await session.execute(ProcessedEvent.__table__.delete().where(ProcessedEvent.received_at < cutoff))
+            await session.commit()
+        if result.rowcount:
+            logger.info("Eventos procesados antiguos eliminados de la tabla de deduplicación", extra=log_fields(events=result.rowcount))
+    except Exception as e:
+        logger.error("Error purgando la tabla de eventos procesados", extra=log_fields(error=str(e)))
+
+# --- DRENADO ASÍNCRONO DEL OUTBOX ---
+
+# La pestaña activa de un destino se resuelve con la versión síncrona en un hilo aparte: solo hace
+# I/O cuando hay que crear una pestaña (primera vez o rollover), el resto es un SELECT pequeño.
+async def append_target_for(route):
+    def resolve():
+        try:
+            return active_append_target(route)
+        finally:
+            sync_app.Session.remove()
+    return await asyncio.to_thread(resolve)
+
+# Un helper síncrono de app.py en un hilo aparte, liberando después la sesión de ese hilo
+async def run_sync_helper(function, *args):
+    def call():
+        try:
+            return function(*args)
+        finally:
+            sync_app.Session.remove()
+    return await asyncio.to_thread(call)
+
+# Versión asíncrona de flush_sheets_batch: misma planificación, I/O sin bloquear el event loop
+async def flush_sheets_batch(session, events):
+    pending = coalesce_events(events)
+    known_entries = await find_reservation_rows_in_db(session, list(pending))
+    candidates = append_candidates(pending, known_entries)
+    if candidates: # Appends dudosos: casi nunca hay, y comprobarlos lee la hoja con el cliente síncrono
+        known_entries.update(await run_sync_helper(resolve_appends_in_doubt, candidates))
+    row_data_by_id = {reservation_id: entry["row_data"] for reservation_id, entry in pending.items()}
+    deleted_rows = await locate_anchored_rows(known_entries, row_data_by_id)
+    await forget_deleted_rows(session, deleted_rows)
+    drop_deleted_rows(pending, known_entries, deleted_rows)
+    updates, appends, index_rows = plan_sheets_batch(pending, known_entries)
+
+    try:
+        for spreadsheet_id, batch in updates.items():
+            if SHEETS_ROW_ANCHORS:
+                result = await sheets_client.values_batch_update_by_data_filter(spreadsheet_id, batch["ranges"])
+                written_rows, missing_rows = reconcile_anchored_rows(batch["index_rows"], batch["ranges"], result)
+                if missing_rows: # Confirmarlo lee la columna de reservation_id con el cliente síncrono
+                    found_rows, deleted_rows = await run_sync_helper(confirm_deleted_rows, missing_rows)
+                    await forget_deleted_rows(session, deleted_rows)
+                    if found_rows:
+                        await sheets_client.values_batch_update(spreadsheet_id, rewrite_found_rows_ranges(found_rows, row_data_by_id))
+                        written_rows.extend(found_rows)
+            else:
+                await sheets_client.values_batch_update(spreadsheet_id, batch["ranges"])
+                written_rows = batch["index_rows"]
+            index_rows.extend(written_rows)
+            logger.info("Batch update escrito en Google Sheets", extra=log_fields(spreadsheet_id=spreadsheet_id, ranges=len(batch["ranges"]), events=len(events)))
+
+        for route, route_appends in appends.items():
+            target = await append_target_for(route)
+            reserved = bool(await run_sync_helper(row_anchor_capacity, target, [reservation_id for reservation_id, _ in route_appends]))
+            if reserved:
+                await sheets_client.acquire("write") # Turno del ancla pagado antes del append (ver reserve_row_anchor)
+            try:
+                append_result = await sheets_client.values_append(
+                    target.spreadsheet_id, a1_range(target.tab), [entry["row_data"] for _, entry in route_appends]
+                )
+            except Exception as error:
+                if append_maybe_applied(error):
+                    await run_sync_helper(record_appends_in_doubt, target, [reservation_id for reservation_id, _ in route_appends], error)
+                raise
+            new_rows = appended_rows_index(route_appends, append_result.get('updates', {}).get('updatedRange', ''), target)
+            await run_sync_helper(anchor_index_rows, target, new_rows, "append", (), reserved) # El sheetId sale de la caché
+            index_rows.extend(new_rows)
+            if new_rows:
+                await session.execute(sheet_tab_rows_stmt(target, new_rows[-1]["sheet_row_number"])) # Se confirma con el índice
+                logger.info("Filas nuevas añadidas en Google Sheets", extra=log_fields(tab=target.tab, rows=len(new_rows), first_row=new_rows[0]["sheet_row_number"], last_row=new_rows[-1]["sheet_row_number"]))
+    finally:
+        # Lo que sí se escribió se indexa aunque una llamada posterior haya fallado (igual que en modo síncrono)
+        if index_rows:
+            try:
+                await session.execute(reservation_index_upsert_stmt(index_rows))
+                with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+                    await session.commit()
+                cache_index_rows(index_rows)
+            except Exception as e:
+                await session.rollback()
+                for row in index_rows:
+                    reservation_row_cache.invalidate(row["reservation_id"])
+                logger.error("Error actualizando reservas en el índice de la DB", extra=log_fields(reservations=len(index_rows), error=str(e)))
+        await mirror_reservations(session, sheets_batch_mirror_rows(pending, known_entries, updates, index_rows))
+
+# Versión asíncrona de locate_anchored_rows: la búsqueda de anclas sin bloquear el event loop
+async def locate_anchored_rows(known_entries, row_data_by_id):
+    deleted = []
+    for spreadsheet_id, entries in anchored_partial_writes(known_entries, row_data_by_id).items():
+        result = await sheets_client.developer_metadata_search(spreadsheet_id, row_anchor_filters(entries))
+        located, missing = apply_row_anchor_matches(entries, row_anchor_matches(result))
+        known_entries.update(located)
+        if missing: # Casi nunca: se confirma leyendo la columna de reservation_id con el cliente síncrono
+            found, gone = await run_sync_helper(confirm_deleted_rows, missing)
+            known_entries.update(unanchored_entries(known_entries, found))
+            deleted.extend(gone)
+    return deleted
+
+# Versión asíncrona de forget_deleted_rows
+async def forget_deleted_rows(session, rows):
+    if not rows:
+        return
+    log_deleted_rows(rows)
+    try:
+        for stmt in forget_deleted_rows_stmts(rows):
+            await session.execute(stmt)
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logger.error("Error quitando del índice reservas borradas de la hoja", extra=log_fields(reservations=len(rows), error=str(e)))
+
+def run_row_verification_in_thread():
+    try:
+        run_row_verification()
+    finally:
+        sync_app.Session.remove()
+
+# Versión asíncrona de mirror_reservations: un fallo no afecta a lo ya escrito en Sheets
+async def mirror_reservations(session, rows):
+    if not rows:
+        return
+    try:
+        await session.execute(reservation_mirror_upsert_stmt(rows))
+        await session.commit()
+        metrics.inc("reservation_mirror_rows_total", len(rows))
+    except Exception as e:
+        await session.rollback()
+        logger.error("Error guardando reservas en el espejo local de la hoja", extra=log_fields(reservations=len(rows), error=str(e)))
+
+# Versión asíncrona de flush_log_batch (SHEETS_SINK_MODE=log): solo appends al registro, sin índice.
+# La pestaña de registro se asegura con la versión síncrona en un hilo (solo la primera vez hace I/O).
+async def flush_log_batch(session, events):
+    for target, rows in plan_log_batch(events).items():
+        log = await asyncio.to_thread(ensure_log_tab, target)
+        await sheets_client.values_append(log.spreadsheet_id, a1_range(log.tab), rows)
+        metrics.inc("sheets_log_rows_total", len(rows))
+        await session.execute(sheet_snapshot_dirty_stmt(target))
+        await session.commit()
+        logger.info("Eventos añadidos al registro", extra=log_fields(tab=log.tab, rows=len(rows), events=len(events)))
+    await mirror_reservations(session, log_batch_mirror_rows(events))
+
+# Entrega la cola de un destino con su propia sesión; devuelve la excepción en lugar de lanzarla
+async def flush_target_batch(events):
+    async with AsyncSession() as session:
+        try:
+            if SHEETS_SINK_MODE == "log":
+                await flush_log_batch(session, events)
+            else:
+                await flush_sheets_batch(session, events)
+            return None
+        except Exception as e:
+            return e
+
+# Como outbox_lease_heartbeat: prolonga los leases de un bloque cada OUTBOX_LEASE_RENEW_SECONDS hasta que se cancela
+async def renew_outbox_leases(shards, owner, record_ids):
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE_RENEW_SECONDS)
+        try:
+            async with AsyncSession() as session:
+                shard_stmt, records_stmt = renew_outbox_leases_stmts(shards, owner, record_ids, utcnow())
+                renewed_shards = (await session.scalars(shard_stmt)).all()
+                await session.execute(records_stmt)
+                await session.commit()
+            report_lost_shard_leases(shards, renewed_shards)
+        except Exception as e:
+            logger.error("Error renovando el lease de los shards del outbox", extra=log_fields(shards=shards, error=str(e)))
+
+# Mismo esquema de shards que OutboxDrainer: se toman shards, se entrega un bloque y se liberan
+async def drain_outbox_once(owner):
+    async with AsyncSession() as session:
+        now = utcnow()
+        pending_shards = (await session.scalars(pending_shards_select(now))).all()
+        if not pending_shards:
+            await session.commit()
+            return 0
+        shards = (await session.scalars(acquire_shard_leases_stmt(shards_to_claim(pending_shards), owner, now))).all()
+        await session.commit()
+        if not shards:
+            return 0
+
+        try:
+            records = (await session.scalars(claimable_outbox_select(now, SHEETS_FLUSH_MAX_ROWS, shards))).all()
+            for record in records:
+                record.locked_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+            await session.commit()
+            if not records:
+                return 0
+
+            # Una cola por destino, entregadas en paralelo (como el pool de hilos del modo síncrono), con los
+            # leases renovados mientras dura la entrega
+            groups = group_outbox_by_target(records)
+            renewal = asyncio.create_task(renew_outbox_leases(shards, owner, [record.id for record in records]))
+            try:
+                errors = await asyncio.gather(*(flush_target_batch([data for _, data in group]) for group in groups.values()))
+            finally:
+                renewal.cancel()
+                await asyncio.gather(renewal, return_exceptions=True)
+            for (key, group), error in zip(groups.items(), errors):
+                metrics.inc("sheets_target_batches_total", target=key, result="ok" if error is None else "error")
+                group_records = [record for record, _ in group]
+                if error is None:
+                    for record in group_records:
+                        await session.delete(record)
+                else:
+                    await session.run_sync(lambda sync_session, group_records=group_records, error=error: fail_outbox_records(sync_session, group_records, error))
+            await session.commit()
+            return len(records)
+        finally:
+            await session.rollback()
+            await session.execute(release_shard_leases_stmt(shards, owner))
+            await session.commit()
+
+async def run_outbox_drainer(worker_index):
+    owner = f"{socket.gethostname()}:{os.getpid()}:async-{worker_index}"
+    await asyncio.to_thread(startup_warmup.wait, *startup_steps_for_writes(direct=True)) # Tablas y encabezado listos antes de drenar
+    if worker_index == 0:
+        await warm_reservation_cache()
+    next_prune_at = asyncio.get_running_loop().time()
+    next_compaction_at = asyncio.get_running_loop().time() + SHEETS_COMPACTION_INTERVAL_SECONDS
+    next_verification_at = asyncio.get_running_loop().time() + SHEETS_ROW_VERIFY_INTERVAL_SECONDS
+    while True:
+        if worker_index == 0 and asyncio.get_running_loop().time() >= next_prune_at:
+            await prune_processed_events()
+            next_prune_at = asyncio.get_running_loop().time() + DEDUP_PRUNE_INTERVAL_SECONDS
+        if worker_index == 0 and SHEETS_SINK_MODE == "log" and SHEETS_COMPACTION_INTERVAL_SECONDS > 0 and asyncio.get_running_loop().time() >= next_compaction_at:
+            # Poco frecuente y casi todo I/O de Sheets en bloque: la versión síncrona en un hilo aparte
+            await asyncio.to_thread(run_log_compaction)
+            next_compaction_at = asyncio.get_running_loop().time() + SHEETS_COMPACTION_INTERVAL_SECONDS
+        if worker_index == 0 and SHEETS_SINK_MODE == "rows" and SHEETS_ROW_VERIFY_INTERVAL_SECONDS > 0 and asyncio.get_running_loop().time() >= next_verification_at:
+            await asyncio.to_thread(run_row_verification_in_thread) # Igual que la compactación: poco frecuente y en bloque
+            next_verification_at = asyncio.get_running_loop().time() + SHEETS_ROW_VERIFY_INTERVAL_SECONDS
+        try:
+            drained = await drain_outbox_once(owner)
+        except Exception as e:
+            drained = 0
+            logger.error("Error en el drenado del outbox", extra=log_fields(error=str(e)))
+        # Con un bloque lleno se sigue drenando sin esperar; si no, se espera a la siguiente ventana
+        if drained < SHEETS_FLUSH_MAX_ROWS:
+            await asyncio.sleep(SHEETS_FLUSH_INTERVAL_MS / 1000.0)
+
+# Igual que enqueue_webhook del modo síncrono: una sola sentencia en PostgreSQL y, en SQLite, el ID del
+# evento en la misma transacción. Devuelve False si el evento ya estaba registrado.
+async def enqueue_webhook(data, event_key=None):
+    if async_engine.dialect.name == "postgresql":
+        async with async_autocommit_engine.connect() as connection:
+            return (await connection.execute(enqueue_webhook_stmt(data, event_key))).first() is not None
+    try:
+        async with AsyncSession() as session:
+            if event_key:
+                session.add(new_processed_event(event_key, data))
+            session.add(new_outbox_record(data))
+            await session.commit()
+    except IntegrityError:
+        return False
+    return True
+
+# --- Ruta del Webhook (ASGI) ---
+async def webhook(request):
+    with metrics.timer("webhook_request_duration_seconds"):
+        return await handle_webhook(request)
+
+async def handle_webhook(request):
+    with metrics.timer("webhook_stage_duration_seconds", stage="parse"):
+        try:
+            data = json_loads(await request.body())
+        except ValueError as e:
+            return JSONResponse({"message": f"JSON no válido: {e}"}, status_code=400)
+    if not isinstance(data, dict):
+        return JSONResponse({"message": "Se esperaba un objeto JSON"}, status_code=400)
+    logger.info("Webhook recibido", extra=log_fields(
+        event=data.get("event"),
+        eventId=(data.get("meta") or {}).get("eventId"),
+        reservation_id=(data.get("reservation") or {}).get("_id"),
+        payload_bytes=request.headers.get("content-length"),
+    ))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Payload del webhook", extra=log_fields(payload=data))
+
+    webhook_event_type = data.get("event")
+
+    if webhook_event_type not in ["reservation.new", "reservation.updated"]:
+        logger.info("Evento no procesado: solo se procesan 'reservation.new' y 'reservation.updated'", extra=log_fields(event=webhook_event_type))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="ignored")
+        return JSONResponse({"message": f"Evento '{webhook_event_type}' no procesado"}, status_code=200)
+
+    reservation_id = (data.get("reservation") or {}).get("_id")
+    if not reservation_id:
+        logger.warning("Reservation ID is missing in the reservation data")
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="rejected")
+        return JSONResponse({"message": "Reservation ID is missing"}, status_code=400)
+
+    if startup_warmup.pending(*startup_steps_for_writes(direct=False)):
+        with metrics.timer("webhook_stage_duration_seconds", stage="warmup"):
+            await asyncio.to_thread(startup_warmup.wait, *startup_steps_for_writes(direct=False))
+
+    event_key = webhook_event_key(data)
+    if event_key and recent_event_ids.seen(event_key):
+        logger.info("Evento duplicado ignorado", extra=log_fields(event_key=event_key))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="duplicate")
+        return JSONResponse({"message": f"Evento {event_key} ya procesado"}, status_code=200)
+
+    try:
+        with metrics.timer("webhook_stage_duration_seconds", stage="db_commit"):
+            queued = await enqueue_webhook(data, event_key)
+    except Exception as e:
+        logger.error("Error guardando el webhook en el outbox", extra=log_fields(reservation_id=reservation_id, error=str(e)))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="error")
+        return JSONResponse({"message": f"Fallo al encolar el webhook: {str(e)}"}, status_code=500)
+    if event_key:
+        recent_event_ids.add(event_key)
+    if not queued:
+        logger.info("Evento duplicado ignorado", extra=log_fields(event_key=event_key))
+        metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="duplicate")
+        return JSONResponse({"message": f"Evento {event_key} ya procesado"}, status_code=200)
+    metrics.inc("webhook_events_total", event=event_label(webhook_event_type), result="queued")
+    return JSONResponse({"message": f"Reserva {reservation_id} encolada para Google Sheets"}, status_code=202)
+
+# --- Ruta de ingesta en bloque (ASGI) ---
+# Los INSERT de varias filas son los del modo síncrono (ingest_batch), en un hilo aparte
+def ingest_batch_in_thread(items):
+    startup_warmup.wait(*startup_steps_for_writes(direct=False))
+    try:
+        return ingest_batch(items)
+    finally:
+        sync_app.Session.remove()
+
+# Cuerpo de la solicitud hasta WEBHOOK_BATCH_MAX_BYTES (None si lo supera), como read_limited_body
+async def read_limited_body(request):
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > WEBHOOK_BATCH_MAX_BYTES:
+        return None
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > WEBHOOK_BATCH_MAX_BYTES:
+            return None
+    return b"".join(chunks)
+
+async def webhook_batch(request):
+    with metrics.timer("webhook_batch_request_duration_seconds"):
+        body = await read_limited_body(request)
+        if body is None:
+            return JSONResponse({"message": f"Cuerpo demasiado grande; el máximo por solicitud es {WEBHOOK_BATCH_MAX_BYTES} bytes"}, status_code=413)
+        try:
+            items = parse_batch_body(body, request.headers.get("content-type", "").split(";")[0].strip())
+        except ValueError as e:
+            logger.warning("Cuerpo de /webhook/batch no válido", extra=log_fields(error=str(e)))
+            return JSONResponse({"message": f"Cuerpo no válido: {e}"}, status_code=400)
+        if len(items) > WEBHOOK_BATCH_MAX_EVENTS:
+            return JSONResponse({"message": f"Demasiados eventos ({len(items)}); el máximo por solicitud es {WEBHOOK_BATCH_MAX_EVENTS}"}, status_code=413)
+
+        try:
+            summary = await asyncio.to_thread(ingest_batch_in_thread, items)
+        except Exception as e:
+            logger.error("Error encolando un bloque de eventos", extra=log_fields(events=len(items), error=str(e)))
+            metrics.inc("webhook_batch_events_total", len(items), result="error")
+            return JSONResponse({"message": f"Fallo al encolar el bloque: {str(e)}"}, status_code=500)
+        logger.info("Bloque de webhooks recibido", extra=log_fields(**summary))
+        return JSONResponse(summary, status_code=202 if summary["queued"] else 200)
+
+# --- Ruta de consulta de reservas (ASGI, espejo local) ---
+async def reservations(request):
+    with metrics.timer("reservations_request_duration_seconds"):
+        if not reservations_authorized(request.headers.get("authorization")):
+            return JSONResponse({"message": "No autorizado"}, status_code=401, headers={"WWW-Authenticate": "Bearer"})
+        try:
+            query = parse_reservations_query(request.query_params)
+            include_pii = reservations_include_pii(request.query_params)
+        except ValueError as e:
+            return JSONResponse({"message": f"Parámetros no válidos: {e}"}, status_code=400)
+        if startup_warmup.pending("db_tables"):
+            await asyncio.to_thread(startup_warmup.wait, "db_tables")
+        async with async_autocommit_engine.connect() as connection:
+            rows = (await connection.execute(reservations_page_select(**query))).all()
+        return JSONResponse(reservations_page(rows, query["limit"], include_pii))
+
+async def metrics_endpoint(request):
+    # render() consulta la DB (profundidad del outbox) y toma el flock del limitador: fuera del event loop
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
+async def lifespan(app):
+    # Tablas, migraciones y encabezado también con uvicorn/gunicorn directo; no-op si ya lo arrancó 'python app.py'
+    startup_warmup.start(startup_steps(ensure_schema=True))
+    drainer_tasks = [asyncio.create_task(run_outbox_drainer(worker_index)) for worker_index in range(OUTBOX_WORKERS)]
+    try:
+        yield
+    finally:
+        for drainer_task in drainer_tasks:
+            drainer_task.cancel()
+        await sheets_client.aclose()
+        await async_engine.dispose()
+
+asgi_app = Starlette(
+    routes=[
+        Route("/webhook", webhook, methods=["POST"]),
+        Route("/webhook/batch", webhook_batch, methods=["POST"]),
+        Route("/reservations", reservations, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
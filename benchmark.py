@@ -0,0 +1,852 @@
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from sqlalchemy import create_engine, text
+
+# Mide el rendimiento de /webhook sin tocar la hoja real: levanta una API falsa de Sheets v4
+# (latencia configurable, 429 inyectados y cuota por minuto), arranca app.py contra ella y una
+# DB local, y lanza webhooks de Guesty realistas con IDs de reserva sesgados (unas pocas
+# reservas reciben la mayoría de las actualizaciones, como en producción).
+# Uso: python benchmark.py [--events 5000] [--concurrency 16] [--server-mode sync|async] [--sink-mode rows|log]
+#                          [--payload-kb 30] [--json-only] [--shuffle-rows] [--no-row-anchors]
+#                          [--output resultado.json] [--baseline base.json]
+
+# --- API FALSA DE GOOGLE SHEETS v4 ---
+
+LOG_TAB_SUFFIX = "_log" # SHEETS_LOG_TAB_SUFFIX con el que se arranca app.py
+RESERVATIONS_API_TOKEN = "benchmark-token" # Token de /reservations del servidor bajo prueba
+
+DEVELOPER_METADATA_MAX_CHARS = 30000 # Límite de Sheets de developer metadata por hoja (clave + valor)
+ANCHOR_METADATA_KEY = "reservation_id" # SHEETS_ROW_ANCHOR_KEY con el que se arranca app.py (el de por defecto)
+RESERVATION_ID_COLUMN_INDEX = 3 # Columna 'D' (reservation_id) de SHEET_FIELDS en app.py
+
+A1_RANGE_PATTERN = re.compile(r"^(?:'?(?P<tab>[^'!]+)'?!)?(?P<c1>[A-Z]+)?(?P<r1>\d+)?(?::(?P<c2>[A-Z]+)?(?P<r2>\d+)?)?$")
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + (ord(letter) - 64)
+    return index - 1
+
+def parse_a1_range(a1_range):
+    if "!" not in a1_range:
+        return a1_range.strip("'"), 0, 1, None # Pestaña completa
+    match = A1_RANGE_PATTERN.match(a1_range)
+    if not match:
+        raise ValueError(f"Rango A1 no soportado por la API falsa: {a1_range}")
+    tab = match.group("tab")
+    first_column = column_index(match.group("c1")) if match.group("c1") else 0
+    first_row = int(match.group("r1")) if match.group("r1") else 1
+    last_row = int(match.group("r2")) if match.group("r2") else None
+    if ":" not in a1_range.rsplit("!", 1)[1] and match.group("r1"):
+        last_row = first_row # Una sola celda ('D5')
+    return tab, first_column, first_row, last_row
+
+class FakeSheetsState:
+    """Contenido de las pestañas y contadores de la API falsa (compartidos entre hilos del servidor)."""
+
+    def __init__(self, latency_ms, latency_jitter_ms, error_rate, quota_per_minute, retry_after):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.quota_per_minute = quota_per_minute
+        self.retry_after = retry_after
+        self.tabs = {}
+        self.anchors = {} # pestaña -> {metadataValue: índice 0-based de la fila}; se mueven con la fila al barajar
+        self.calls = Counter()
+        self.rejected = Counter()
+        self.rows_written = 0
+        self.faults_enabled = False # Sin 429 durante el arranque de app.py (comprobación del encabezado)
+        self._recent_calls = deque()
+        self._lock = threading.Lock()
+
+    # Devuelve el motivo del 429 si la llamada se rechaza, o None si se atiende
+    def admit(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            if not self.faults_enabled:
+                return None
+            now = time.monotonic()
+            while self._recent_calls and self._recent_calls[0] <= now - 60:
+                self._recent_calls.popleft()
+            if self.quota_per_minute and len(self._recent_calls) >= self.quota_per_minute:
+                self.rejected["quota"] += 1
+                return "quota"
+            if self.error_rate and random.random() < self.error_rate:
+                self.rejected["injected"] += 1
+                return "injected"
+            self._recent_calls.append(now)
+            return None
+
+    def _rows(self, tab):
+        return self.tabs.setdefault(tab, [])
+
+    def write(self, a1_range, values):
+        with self._lock:
+            tab, first_column, first_row, _ = parse_a1_range(a1_range)
+            rows = self._rows(tab)
+            for offset, values_row in enumerate(values):
+                while len(rows) < first_row + offset:
+                    rows.append([])
+                row = rows[first_row + offset - 1]
+                if len(row) < first_column:
+                    row.extend([""] * (first_column - len(row)))
+                row[first_column:first_column + len(values_row)] = values_row
+                self.rows_written += 1
+
+    def append(self, a1_range, values):
+        with self._lock:
+            tab = parse_a1_range(a1_range)[0]
+            rows = self._rows(tab)
+            while rows and not any(cell != "" for cell in rows[-1]):
+                rows.pop()
+            first_row = len(rows) + 1
+            rows.extend([list(values_row) for values_row in values])
+            self.rows_written += len(values)
+            return f"{tab}!A{first_row}:{first_row + len(values) - 1}"
+
+    def read(self, a1_range, major_dimension):
+        with self._lock:
+            tab, first_column, first_row, last_row = parse_a1_range(a1_range)
+            rows = self._rows(tab)[first_row - 1:last_row]
+            values = [row[first_column:] for row in rows]
+        while values and not values[-1]:
+            values.pop()
+        if major_dimension == "COLUMNS":
+            column = [row[0] if row else "" for row in values]
+            return [column] if column else []
+        return values
+
+    def add_tab(self, tab):
+        with self._lock:
+            if tab in self.tabs:
+                return False
+            self.tabs[tab] = []
+            return True
+
+    def _tab_for_sheet_id(self, sheet_id):
+        return list(self.tabs)[sheet_id] # sheetId = posición de la pestaña, como en sheet_properties()
+
+    # createDeveloperMetadata sobre una fila (las anclas de app.py) y deleteDeveloperMetadata por valor.
+    # Devuelve el mensaje de error si la ubicación no es una fila válida o, como la API real, si las anclas
+    # superan DEVELOPER_METADATA_MAX_CHARS (entonces no se aplica ninguna petición del lote)
+    def update_anchors(self, requests):
+        with self._lock:
+            previous = {tab: dict(anchors) for tab, anchors in self.anchors.items()}
+            for request_body in requests:
+                if "deleteDeveloperMetadata" in request_body:
+                    lookup = request_body["deleteDeveloperMetadata"]["dataFilter"]["developerMetadataLookup"]
+                    self.anchors.get(self._tab_for_sheet_id(lookup["metadataLocation"]["sheetId"]), {}).pop(lookup.get("metadataValue"), None)
+                    continue
+                metadata = request_body["createDeveloperMetadata"]["developerMetadata"]
+                dimension_range = metadata["location"]["dimensionRange"]
+                if dimension_range["sheetId"] >= len(self.tabs) or dimension_range.get("dimension") != "ROWS":
+                    self.anchors = previous
+                    return "Invalid developer metadata location."
+                tab = self._tab_for_sheet_id(dimension_range["sheetId"])
+                self.anchors.setdefault(tab, {})[metadata["metadataValue"]] = dimension_range["startIndex"]
+            size = sum(len(ANCHOR_METADATA_KEY) + len(value) for anchors in self.anchors.values() for value in anchors)
+            if size > DEVELOPER_METADATA_MAX_CHARS:
+                self.anchors = previous
+                return f"Developer metadata would exceed the {DEVELOPER_METADATA_MAX_CHARS} character limit."
+            return None
+
+    # deleteDimension de filas (el recorte del registro ya compactado); las anclas de debajo suben con sus filas
+    def delete_rows(self, dimension_range):
+        with self._lock:
+            tab = self._tab_for_sheet_id(dimension_range["sheetId"])
+            start, end = dimension_range["startIndex"], dimension_range["endIndex"]
+            del self.tabs[tab][start:end]
+            anchors = self.anchors.get(tab, {})
+            for value, row_index in list(anchors.items()):
+                if start <= row_index < end:
+                    del anchors[value]
+                elif row_index >= end:
+                    anchors[value] = row_index - (end - start)
+
+    # values().batchUpdateByDataFilter: filtros a1Range o developerMetadataLookup por valor. Como la API
+    # real, un filtro que no encuentra nada (fila borrada) no escribe ni aparece en 'responses'
+    def write_by_data_filter(self, data):
+        responses = []
+        for value_range in data:
+            data_filter = value_range["dataFilter"]
+            if "a1Range" in data_filter:
+                self.write(data_filter["a1Range"], value_range.get("values", []))
+                responses.append({"updatedRange": data_filter["a1Range"], "dataFilter": data_filter})
+                continue
+            lookup = data_filter["developerMetadataLookup"]
+            with self._lock:
+                tab = self._tab_for_sheet_id(lookup["metadataLocation"]["sheetId"])
+                row_index = self.anchors.get(tab, {}).get(lookup.get("metadataValue"))
+            if row_index is None:
+                continue
+            self.write(f"{tab}!A{row_index + 1}", value_range.get("values", []))
+            responses.append({"updatedRange": f"{tab}!A{row_index + 1}:Z{row_index + 1}", "dataFilter": data_filter})
+        return responses
+
+    # developerMetadata().search con un developerMetadataLookup por pestaña (sheetId)
+    def search_anchors(self, lookup):
+        with self._lock:
+            tab = self._tab_for_sheet_id(lookup["metadataLocation"]["sheetId"])
+            return [
+                {"developerMetadata": {
+                    "metadataKey": lookup.get("metadataKey"), "metadataValue": value,
+                    "location": {"locationType": "ROW", "dimensionRange": {"sheetId": lookup["metadataLocation"]["sheetId"], "dimension": "ROWS", "startIndex": row_index, "endIndex": row_index + 1}},
+                }}
+                for value, row_index in self.anchors.get(tab, {}).items()
+                if lookup.get("metadataValue") in (None, value)
+            ]
+
+    # Simula a alguien ordenando la hoja a mano: baraja las filas de datos de las pestañas de estado
+    # actual (el encabezado se queda) y sus anclas se mueven con ellas, como en Sheets
+    def shuffle_rows(self, rng):
+        with self._lock:
+            for tab, rows in self.tabs.items():
+                if tab.endswith(LOG_TAB_SUFFIX) or len(rows) < 3:
+                    continue
+                order = list(range(1, len(rows)))
+                rng.shuffle(order)
+                new_index = {old_index: new_index for new_index, old_index in enumerate(order, start=1)}
+                rows[1:] = [rows[old_index] for old_index in order]
+                anchors = self.anchors.get(tab, {})
+                for value, row_index in anchors.items():
+                    anchors[value] = new_index.get(row_index, row_index)
+
+    # IDs de reserva repetidos en las pestañas de estado actual: una escritura en la fila equivocada deja uno
+    def duplicate_reservation_ids(self):
+        with self._lock:
+            seen = Counter(
+                row[RESERVATION_ID_COLUMN_INDEX]
+                for tab, rows in self.tabs.items() if not tab.endswith(LOG_TAB_SUFFIX)
+                for row in rows[1:] if len(row) > RESERVATION_ID_COLUMN_INDEX and row[RESERVATION_ID_COLUMN_INDEX]
+            )
+        return sum(count - 1 for count in seen.values() if count > 1)
+
+    # Filas de datos (sin encabezado) sumando todas las pestañas, o solo las de registro ('_log') con 'log_tabs'
+    def data_rows(self, log_tabs=False):
+        with self._lock:
+            return sum(
+                max(len(rows) - 1, 0) for tab, rows in self.tabs.items()
+                if tab.endswith(LOG_TAB_SUFFIX) == log_tabs
+            )
+
+    def sheet_properties(self):
+        with self._lock:
+            return [
+                {"properties": {"sheetId": index, "title": tab, "gridProperties": {"rowCount": max(len(rows), 1000)}}}
+                for index, (tab, rows) in enumerate(self.tabs.items())
+            ]
+
+class FakeSheetsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, como la API real
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        if not raw_body or "json" not in (self.headers.get("Content-Type") or ""):
+            return {} # El intercambio del token llega como formulario
+        return json.loads(raw_body)
+
+    def _handle(self, http_method):
+        state = self.server.state
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        query = parse_qs(url.query)
+        params = {key: values[0] for key, values in query.items()}
+        body = self._read_body() if http_method in ("POST", "PUT") else {}
+
+        # Intercambio JWT -> token de acceso de la cuenta de servicio falsa
+        if path == "/token":
+            self._send_json(200, {"access_token": "benchmark-token", "expires_in": 3600, "token_type": "Bearer"})
+            return
+
+        match = re.match(r"^/v4/spreadsheets/(?P<spreadsheet_id>[^/:]+)(?P<rest>[/:].*)?$", path)
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": f"Ruta desconocida: {path}"}})
+            return
+        rest = match.group("rest") or ""
+        if rest == "" and http_method == "GET":
+            method = "get"
+        elif rest == "/values:batchUpdate":
+            method = "batchUpdate"
+        elif rest == "/values:batchUpdateByDataFilter":
+            method = "batchUpdateByDataFilter"
+        elif rest == "/values:batchGet" and http_method == "GET":
+            method = "batchGet"
+        elif rest == "/developerMetadata:search":
+            method = "developerMetadata.search"
+        elif rest == ":batchUpdate":
+            method = "spreadsheets.batchUpdate"
+        elif rest.endswith(":append"):
+            method = "append"
+        elif rest.startswith("/values/"):
+            method = "values.get" if http_method == "GET" else "update"
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": f"Operación no soportada: {http_method} {path}"}})
+            return
+
+        latency = state.latency_ms + random.uniform(0, state.latency_jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+        rejection = state.admit(method)
+        if rejection:
+            headers = {"Retry-After": str(state.retry_after)} if state.retry_after else None
+            self._send_json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": f"Cuota excedida ({rejection})"}}, headers)
+            return
+
+        if method == "get":
+            self._send_json(200, {"sheets": state.sheet_properties()})
+        elif method == "values.get":
+            a1_range = rest[len("/values/"):]
+            values = state.read(a1_range, params.get("majorDimension", "ROWS"))
+            self._send_json(200, {"range": a1_range, "values": values} if values else {"range": a1_range})
+        elif method == "update":
+            a1_range = rest[len("/values/"):]
+            state.write(a1_range, body.get("values", []))
+            self._send_json(200, {"updatedRange": a1_range, "updatedRows": len(body.get("values", []))})
+        elif method == "spreadsheets.batchUpdate":
+            # addSheet (las pestañas nuevas del enrutado y del rollover), deleteDimension (recorte del registro)
+            # o createDeveloperMetadata (anclas de fila)
+            requests = body.get("requests", [])
+            if any("createDeveloperMetadata" in request_body or "deleteDeveloperMetadata" in request_body for request_body in requests):
+                error = state.update_anchors(requests)
+                if error:
+                    self._send_json(400, {"error": {"code": 400, "message": error}})
+                    return
+                self._send_json(200, {"replies": [{next(iter(request_body)): {}} for request_body in requests]})
+                return
+            for request_body in requests:
+                if "deleteDimension" in request_body:
+                    state.delete_rows(request_body["deleteDimension"]["range"])
+                    continue
+                title = request_body.get("addSheet", {}).get("properties", {}).get("title")
+                if title and not state.add_tab(title):
+                    self._send_json(400, {"error": {"code": 400, "message": f"A sheet with the name \"{title}\" already exists."}})
+                    return
+            self._send_json(200, {"replies": [{} for _ in body.get("requests", [])]})
+        elif method == "batchUpdate":
+            for value_range in body.get("data", []):
+                state.write(value_range["range"], value_range.get("values", []))
+            self._send_json(200, {"totalUpdatedRows": sum(len(value_range.get("values", [])) for value_range in body.get("data", []))})
+        elif method == "batchUpdateByDataFilter":
+            responses = state.write_by_data_filter(body.get("data", []))
+            self._send_json(200, {"responses": responses, "totalUpdatedRows": len(responses)})
+        elif method == "batchGet":
+            value_ranges = []
+            for a1_range in query.get("ranges", []):
+                values = state.read(a1_range, params.get("majorDimension", "ROWS"))
+                value_ranges.append({"range": a1_range, "values": values} if values else {"range": a1_range})
+            self._send_json(200, {"valueRanges": value_ranges})
+        elif method == "developerMetadata.search":
+            matched = [match for data_filter in body.get("dataFilters", []) for match in state.search_anchors(data_filter["developerMetadataLookup"])]
+            self._send_json(200, {"matchedDeveloperMetadata": matched} if matched else {})
+        else:
+            updated_range = state.append(rest[len("/values/"):-len(":append")], body.get("values", []))
+            self._send_json(200, {"updates": {"updatedRange": updated_range, "updatedRows": len(body.get("values", []))}})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+def start_fake_sheets(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSheetsHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Cuenta de servicio con clave RSA real (google-auth firma el JWT) pero con token_uri local
+def fake_service_account(token_uri):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("utf-8")
+    service_account_info = {
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": private_key_pem,
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+    return base64.b64encode(json.dumps(service_account_info).encode("utf-8")).decode("ascii")
+
+# --- GENERADOR DE WEBHOOKS DE GUESTY ---
+
+CITIES = ["Madrid", "Barcelona", "Valencia", "Sevilla", "Málaga", "Bilbao"]
+PLATFORMS = ["airbnb2", "bookingCom", "homeaway2", "manual", "direct"]
+FIRST_NAMES = ["Lucía", "Hugo", "Martina", "Mateo", "Sofía", "Leo", "Emma", "Daniel"]
+LAST_NAMES = ["García", "Martínez", "López", "Sánchez", "Pérez", "Gómez", "Smith", "Müller"]
+STATUSES = ["inquiry", "reserved", "confirmed", "confirmed", "confirmed", "canceled"]
+
+def new_reservation(index, rng):
+    check_in = datetime(2025, 1, 1) + timedelta(days=rng.randrange(365))
+    nights = rng.randint(1, 14)
+    first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    listing_number = rng.randrange(200)
+    nightly_rate = rng.randint(60, 400)
+    return {
+        "_id": f"{index:024x}",
+        "accountId": "5f0000000000000000000001",
+        "guestId": uuid.UUID(int=rng.getrandbits(128)).hex[:24],
+        "listingId": f"{listing_number:024x}",
+        "conversationId": uuid.UUID(int=rng.getrandbits(128)).hex[:24],
+        "checkIn": check_in.strftime("%Y-%m-%dT15:00:00.000Z"),
+        "checkOut": (check_in + timedelta(days=nights)).strftime("%Y-%m-%dT11:00:00.000Z"),
+        "nightsCount": nights,
+        "guestsCount": rng.randint(1, 6),
+        "status": "inquiry",
+        "integration": {"platform": rng.choice(PLATFORMS)},
+        "guest": {
+            "firstName": first_name,
+            "lastName": last_name,
+            "fullName": f"{first_name} {last_name}",
+            "emails": [f"{first_name.lower()}.{index}@example.com"],
+            "phones": [f"+34600{index % 1000000:06d}"],
+        },
+        "money": {"subTotalPrice": nightly_rate * nights, "fareCleaning": rng.choice([0, 40, 60, 80]), "hostServiceFee": round(nightly_rate * nights * 0.03, 2)},
+        "listing": {"nickname": f"Apartamento {listing_number}", "address": {"city": rng.choice(CITIES)}},
+    }
+
+# Campos que Guesty envía además de los que usa app.py (desglose de la factura, textos del anuncio,
+# campos personalizados, mensajes): engordan la reserva hasta unos 'payload_kb' KB como en producción
+def pad_reservation(reservation, payload_kb, rng):
+    invoice_items, custom_fields, posts = [], [], []
+    reservation["money"]["invoiceItems"] = invoice_items
+    reservation["customFields"] = custom_fields
+    reservation["conversation"] = {"posts": posts}
+    reservation["listing"]["publicDescription"] = {
+        "summary": " ".join(rng.choice(CITIES) for _ in range(40)),
+        "space": "Luminoso apartamento con terraza, cocina equipada y wifi de fibra. " * 8,
+    }
+    reservation["listing"]["amenities"] = [f"amenity_{n}" for n in range(60)]
+    while len(json.dumps(reservation)) < payload_kb * 1024:
+        invoice_items.append({
+            "_id": uuid.UUID(int=rng.getrandbits(128)).hex[:24], "title": "Noche", "amount": rng.randint(60, 400),
+            "currency": "EUR", "type": "ACCOMMODATION_FARE", "normalType": "AF", "isLocked": False,
+            "secondIdentifier": "NIGHT", "createdAt": "2025-01-01T00:00:00.000Z",
+        })
+        custom_fields.append({"fieldId": uuid.UUID(int=rng.getrandbits(128)).hex[:24], "value": rng.choice(CITIES)})
+        posts.append({"sentAt": "2025-01-01T00:00:00.000Z", "module": "email", "body": "Hola, ¿a qué hora podemos hacer el check-in? Gracias. " * 3})
+    return reservation
+
+# Pesos de Zipf: la reserva de rango k recibe eventos con probabilidad proporcional a 1/k^skew
+def zipf_cumulative_weights(count, skew):
+    cumulative = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / (rank ** skew)
+        cumulative.append(total)
+    return cumulative
+
+# Genera los cuerpos JSON (ya serializados) de 'count' webhooks. La primera aparición de cada
+# reserva es 'reservation.new'; las siguientes, 'reservation.updated' con lastUpdatedAt creciente.
+# Una fracción 'duplicate_rate' son reentregas del evento anterior con el mismo eventId.
+def generate_events(count, reservations, skew, duplicate_rate, seed, payload_kb=0):
+    rng = random.Random(seed)
+    cumulative = zipf_cumulative_weights(reservations, skew)
+    ranks = list(range(reservations))
+    rng.shuffle(ranks) # Las reservas "calientes" no son siempre las primeras en crearse
+    known = {}
+    clock = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    bodies = []
+    for _ in range(count):
+        if bodies and rng.random() < duplicate_rate:
+            bodies.append(rng.choice(bodies[-50:]))
+            continue
+        index = ranks[rng.choices(range(reservations), cum_weights=cumulative)[0]]
+        clock += timedelta(seconds=rng.randint(1, 30))
+        reservation = known.get(index)
+        if reservation is None:
+            reservation = known[index] = new_reservation(index, rng)
+            if payload_kb:
+                pad_reservation(reservation, payload_kb, rng)
+            event = "reservation.new"
+        else:
+            reservation["status"] = rng.choice(STATUSES)
+            reservation["guestsCount"] = rng.randint(1, 6)
+            reservation["money"]["subTotalPrice"] = rng.randint(60, 400) * reservation["nightsCount"]
+            event = "reservation.updated"
+        reservation["lastUpdatedAt"] = clock.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        bodies.append(json.dumps({
+            "event": event,
+            "meta": {"eventId": str(uuid.UUID(int=rng.getrandbits(128))), "messageId": str(uuid.UUID(int=rng.getrandbits(128)))},
+            "reservation": reservation,
+        }).encode("utf-8"))
+    return bodies, len(known)
+
+# --- SERVIDOR BAJO PRUEBA Y CARGA ---
+
+def start_app(args, fake_server, database_url, work_dir):
+    port = args.app_port
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": database_url,
+        "GOOGLE_CREDENTIALS": fake_service_account(f"http://127.0.0.1:{fake_server.server_port}/token"),
+        "SHEETS_API_ENDPOINT": f"http://127.0.0.1:{fake_server.server_port}/",
+        "SPREADSHEET_ID": "benchmark",
+        "RANGE_NAME": args.range_name,
+        "SERVER_MODE": args.server_mode,
+        "WRITE_BEHIND_ENABLED": "True" if args.write_behind else "False",
+        "SHEETS_RATE_LIMIT_STATE_FILE": os.path.join(work_dir, "sheets_rate_limit.json"),
+        "SHEETS_ROUTES_FILE": os.path.abspath(args.routes_file) if args.routes_file else "",
+        "SHEETS_TAB_MAX_ROWS": str(args.tab_max_rows),
+        "SHEETS_SINK_MODE": args.sink_mode,
+        "SHEETS_LOG_TAB_SUFFIX": LOG_TAB_SUFFIX,
+        "SHEETS_COMPACTION_INTERVAL_SECONDS": str(args.compaction_interval),
+        "SHEETS_ROW_ANCHORS": "True" if args.row_anchors else "False",
+        "RESERVATIONS_API_TOKEN": RESERVATIONS_API_TOKEN,
+        "LOG_LEVEL": "WARNING",
+        "PORT": str(port),
+    })
+    log_path = os.path.join(work_dir, "app.log")
+    log_file = open(log_path, "w")
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")],
+        env=env, stdout=log_file, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/metrics")
+            if connection.getresponse().status == 200:
+                return process, log_path, time.monotonic() - started
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    with open(log_path) as app_log:
+        startup_output = "".join(app_log.readlines()[-20:])
+    raise RuntimeError(f"app.py no arrancó en {args.startup_timeout}s. Últimas líneas de su salida:\n{startup_output}")
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+# Lanza los webhooks con 'concurrency' conexiones keep-alive (bucle cerrado: cada conexión envía
+# el siguiente evento en cuanto recibe la respuesta del anterior)
+def run_load(port, bodies, concurrency, path="/webhook", content_type="application/json"):
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    next_index = iter(range(len(bodies)))
+
+    def worker():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        local_latencies = []
+        local_statuses = Counter()
+        for index in next_index:
+            started = time.perf_counter()
+            try:
+                connection.request("POST", path, body=bodies[index], headers={"Content-Type": content_type})
+                response = connection.getresponse()
+                response.read()
+                local_statuses[response.status] += 1
+            except (OSError, http.client.HTTPException):
+                local_statuses["error"] += 1
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            local_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sorted(latencies), statuses
+
+# Recorre el espejo local completo con /reservations (paginación por cursor) y devuelve cuántas
+# reservas tiene y la latencia de cada página
+def read_mirror(port, page_size=500):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    latencies = []
+    total = 0
+    cursor = None
+    while True:
+        started = time.perf_counter()
+        connection.request(
+            "GET", f"/reservations?limit={page_size}" + (f"&cursor={cursor}" if cursor else ""),
+            headers={"Authorization": f"Bearer {RESERVATIONS_API_TOKEN}"},
+        )
+        response = connection.getresponse()
+        page = json.loads(response.read())
+        latencies.append(time.perf_counter() - started)
+        if response.status != 200:
+            raise RuntimeError(f"/reservations respondió {response.status}: {page}")
+        total += len(page["reservations"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            connection.close()
+            return total, sorted(latencies)
+
+# Espera a que el drenador vacíe el outbox (filas 'dead' aparte) y devuelve lo que tardó
+def wait_for_drain(database_url, timeout):
+    engine = create_engine(database_url)
+    started = time.perf_counter()
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with engine.connect() as connection:
+                    pending = connection.execute(text("SELECT COUNT(*) FROM webhook_outbox WHERE status = 'pending'")).scalar()
+            except Exception:
+                pending = None # Tabla aún sin crear o modo síncrono sin outbox
+            if not pending:
+                return time.perf_counter() - started, pending or 0
+            time.sleep(0.1)
+        return time.perf_counter() - started, pending
+    finally:
+        engine.dispose()
+
+# Modo 'log': espera a que una compactación deje en las pestañas de estado actual una fila por reserva
+def wait_for_compaction(state, distinct_reservations, timeout):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if state.data_rows() >= distinct_reservations:
+            return time.perf_counter() - started
+        time.sleep(0.1)
+    return time.perf_counter() - started
+
+def run_benchmark(args):
+    state = FakeSheetsState(args.latency_ms, args.latency_jitter_ms, args.error_rate, args.quota_per_minute, args.retry_after)
+    fake_server = start_fake_sheets(state)
+    bodies, distinct_reservations = generate_events(args.events, args.reservations, args.skew, args.duplicate_rate, args.seed, args.payload_kb)
+
+    with tempfile.TemporaryDirectory(prefix="guesty-benchmark-") as work_dir:
+        database_url = args.database_url or f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+        process, log_path, startup_seconds = start_app(args, fake_server, database_url, work_dir)
+        try:
+            calls_before = sum(state.calls.values())
+            state.faults_enabled = True
+            if args.batch_size > 0:
+                # Bloques NDJSON a /webhook/batch: latencias y códigos HTTP son por bloque, no por evento
+                batches = [b"\n".join(bodies[start:start + args.batch_size]) for start in range(0, len(bodies), args.batch_size)]
+                load_args = (batches, args.concurrency, "/webhook/batch", "application/x-ndjson")
+            else:
+                load_args = (bodies, args.concurrency)
+            if args.shuffle_rows:
+                # Mitad de la carga, la hoja se "ordena" a mano y el resto de la carga contra las filas movidas
+                half = len(load_args[0]) // 2
+                first_elapsed, first_latencies, statuses = run_load(args.app_port, load_args[0][:half], *load_args[1:])
+                state.shuffle_rows(random.Random(args.seed))
+                elapsed, latencies, second_statuses = run_load(args.app_port, load_args[0][half:], *load_args[1:])
+                elapsed += first_elapsed
+                latencies = sorted(first_latencies + latencies)
+                statuses.update(second_statuses)
+            else:
+                elapsed, latencies, statuses = run_load(args.app_port, *load_args)
+            drain_seconds, pending_left = wait_for_drain(database_url, args.drain_timeout) # También sin write-behind: los 429 pasan al outbox
+            compaction_seconds = wait_for_compaction(state, distinct_reservations, args.drain_timeout) if args.sink_mode == "log" else None
+            calls_before_reads = sum(state.calls.values())
+            mirror_rows, mirror_latencies = read_mirror(args.app_port)
+            mirror_sheets_calls = sum(state.calls.values()) - calls_before_reads
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            fake_server.shutdown()
+        if process.returncode not in (0, -15) and statuses.get("error"):
+            print(f"⚠️ app.py terminó con código {process.returncode}; últimas líneas de {log_path}:")
+            with open(log_path) as log_file:
+                print("".join(log_file.readlines()[-20:]))
+
+    sheets_calls = sum(state.calls.values()) - calls_before
+    data_rows = state.data_rows() # En todas las pestañas (enrutado y rollover); en modo 'log', las de estado actual
+    return {
+        "config": {
+            "server_mode": args.server_mode, "write_behind": args.write_behind, "sink_mode": args.sink_mode, "events": args.events,
+            "concurrency": args.concurrency, "batch_size": args.batch_size, "payload_kb": args.payload_kb, "reservations": args.reservations, "skew": args.skew,
+            "duplicate_rate": args.duplicate_rate, "latency_ms": args.latency_ms, "error_rate": args.error_rate,
+            "quota_per_minute": args.quota_per_minute, "row_anchors": args.row_anchors, "shuffle_rows": args.shuffle_rows, "database": "sqlite" if database_url.startswith("sqlite") else "external",
+        },
+        "startup_seconds": round(startup_seconds, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "events_per_second": round(len(bodies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "status_codes": {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+        "load_seconds": round(elapsed, 3),
+        "drain_seconds": round(drain_seconds, 3),
+        "outbox_pending_after_drain": pending_left,
+        "sheets_calls": dict(state.calls),
+        "sheets_calls_per_event": round(sheets_calls / len(bodies), 4) if bodies else 0.0,
+        "sheets_429": dict(state.rejected),
+        "sheets_rows_written": state.rows_written,
+        "distinct_reservations": distinct_reservations,
+        "sheet_data_rows": data_rows,
+        "sheet_duplicate_ids": state.duplicate_reservation_ids(),
+        "sheet_log_rows": state.data_rows(log_tabs=True),
+        "compaction_seconds": round(compaction_seconds, 3) if compaction_seconds is not None else None,
+        "mirror_rows": mirror_rows,
+        "mirror_page_ms": {
+            "p50": round(percentile(mirror_latencies, 0.50) * 1000, 2),
+            "max": round(mirror_latencies[-1] * 1000, 2),
+        },
+        "mirror_sheets_calls": mirror_sheets_calls,
+    }
+
+# --- INFORME ---
+
+COMPARED_METRICS = [
+    ("req/s", lambda result: result["requests_per_second"], True),
+    ("p50 ms", lambda result: result["latency_ms"]["p50"], False),
+    ("p95 ms", lambda result: result["latency_ms"]["p95"], False),
+    ("p99 ms", lambda result: result["latency_ms"]["p99"], False),
+    ("drenado s", lambda result: result["drain_seconds"], False),
+    ("llamadas Sheets/evento", lambda result: result["sheets_calls_per_event"], False),
+]
+
+# Micro-benchmark del JSON de app.py sin levantar nada: parsear el cuerpo del webhook y volver a
+# serializarlo (payload del outbox), con la librería estándar y con orjson si está instalado
+def run_json_benchmark(args):
+    bodies, _ = generate_events(args.events, args.reservations, args.skew, args.duplicate_rate, args.seed, args.payload_kb)
+    payloads = [json.loads(body) for body in bodies]
+    libraries = {"json": (json.loads, lambda value: json.dumps(value, ensure_ascii=False))}
+    try:
+        import orjson
+        libraries["orjson"] = (orjson.loads, lambda value: orjson.dumps(value).decode("utf-8"))
+    except ImportError:
+        print("⚠️ orjson no está instalado: solo se mide la librería estándar.")
+    sizes = sorted(len(body) for body in bodies)
+    print(f"✅ JSON: {len(bodies)} webhooks, tamaño p50 {percentile(sizes, 0.5) / 1024:.1f} KB | máx {sizes[-1] / 1024:.1f} KB")
+    for name, (loads, dumps) in libraries.items():
+        started = time.perf_counter()
+        for body in bodies:
+            loads(body)
+        loads_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        for payload in payloads:
+            dumps(payload)
+        dumps_seconds = time.perf_counter() - started
+        print(f"   {name:<8} loads {loads_seconds / len(bodies) * 1e6:8.1f} µs/evento | dumps {dumps_seconds / len(bodies) * 1e6:8.1f} µs/evento")
+
+def print_report(result, baseline=None):
+    config = result["config"]
+    print(f"✅ Benchmark: {config['events']} eventos, {config['concurrency']} conexiones, modo {config['server_mode']}"
+          f"{' con write-behind' if config['write_behind'] else ' síncrono'}, latencia Sheets {config['latency_ms']} ms")
+    print(f"   Arranque de app.py:  {result.get('startup_seconds')}s hasta aceptar conexiones")
+    print(f"   Throughput:          {result['requests_per_second']} req/s, {result.get('events_per_second')} eventos/s ({result['load_seconds']}s de carga)")
+    latency = result["latency_ms"]
+    print(f"   Latencia /webhook:   p50 {latency['p50']} ms | p95 {latency['p95']} ms | p99 {latency['p99']} ms | máx {latency['max']} ms")
+    print(f"   Códigos HTTP:        {result['status_codes']}")
+    print(f"   Drenado del outbox:  {result['drain_seconds']}s (pendientes al final: {result['outbox_pending_after_drain']})")
+    print(f"   Llamadas a Sheets:   {result['sheets_calls']} -> {result['sheets_calls_per_event']} por evento")
+    print(f"   429 de Sheets:       {result['sheets_429'] or 'ninguno'}")
+    print(f"   Filas en la hoja:    {result['sheet_data_rows']} (reservas distintas generadas: {result['distinct_reservations']})")
+    if config.get("shuffle_rows"):
+        print(f"   Hoja barajada:       a mitad de carga; IDs de reserva repetidos al final: {result['sheet_duplicate_ids']}"
+              f"{' (anclas de fila desactivadas)' if not config.get('row_anchors', True) else ''}")
+    if config.get("sink_mode") == "log":
+        print(f"   Registro de eventos: {result['sheet_log_rows']} filas; compactación lista en {result['compaction_seconds']}s tras el drenado")
+    if "mirror_rows" in result:
+        mirror_page = result["mirror_page_ms"]
+        print(f"   Espejo /reservations: {result['mirror_rows']} reservas; página de 500 p50 {mirror_page['p50']} ms | máx {mirror_page['max']} ms"
+              f" ({result['mirror_sheets_calls']} llamadas a Sheets)")
+    if result["sheet_data_rows"] != result["distinct_reservations"] and not result["outbox_pending_after_drain"]:
+        print("⚠️ El número de filas no coincide con el de reservas distintas: revisa duplicados o eventos perdidos.")
+    if result.get("sheet_duplicate_ids"):
+        print("⚠️ Hay IDs de reserva repetidos en la hoja: alguna escritura cayó en la fila de otra reserva.")
+    if baseline:
+        print("   Comparación con la línea base:")
+        for label, extract, higher_is_better in COMPARED_METRICS:
+            before, after = extract(baseline), extract(result)
+            change = ((after - before) / before * 100) if before else 0.0
+            better = (change > 0) == higher_is_better if change else True
+            print(f"     {label:<24} {before:>10} -> {after:<10} ({change:+.1f}%){'' if better else ' ⚠️'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de /webhook contra una API falsa de Google Sheets.")
+    parser.add_argument("--events", type=int, default=5000, help="Webhooks a enviar")
+    parser.add_argument("--concurrency", type=int, default=16, help="Conexiones simultáneas del generador de carga")
+    parser.add_argument("--reservations", type=int, default=1000, help="Reservas distintas entre las que se reparten los eventos")
+    parser.add_argument("--skew", type=float, default=1.1, help="Exponente de Zipf del reparto de eventos por reserva (0 = uniforme)")
+    parser.add_argument("--duplicate-rate", type=float, default=0.02, help="Fracción de reentregas con el mismo eventId")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla del generador de eventos")
+    parser.add_argument("--latency-ms", type=float, default=150, help="Latencia base de cada llamada a la API falsa")
+    parser.add_argument("--latency-jitter-ms", type=float, default=50, help="Latencia adicional aleatoria (uniforme) por llamada")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de responder 429 a una llamada")
+    parser.add_argument("--quota-per-minute", type=int, default=0, help="Llamadas por minuto antes de responder 429 (0 = sin cuota)")
+    parser.add_argument("--retry-after", type=int, default=0, help="Segundos de Retry-After en los 429 (0 = sin cabecera, como la API real)")
+    parser.add_argument("--server-mode", choices=["sync", "async"], default="sync", help="SERVER_MODE de app.py")
+    parser.add_argument("--no-write-behind", dest="write_behind", action="store_false", help="Escritura directa en Sheets dentro de la solicitud")
+    parser.add_argument("--no-row-anchors", dest="row_anchors", action="store_false", help="SHEETS_ROW_ANCHORS=False: escribe por número de fila sin anclas")
+    parser.add_argument("--shuffle-rows", action="store_true", help="Baraja las filas de la hoja falsa a mitad de carga (alguien ordenando la hoja)")
+    parser.add_argument("--database-url", default=None, help="DB del índice (por defecto, SQLite temporal); p. ej. postgresql://localhost/bench")
+    parser.add_argument("--range-name", default="Reservas", help="Pestaña de la hoja falsa")
+    parser.add_argument("--routes-file", default=None, help="SHEETS_ROUTES_FILE para app.py (las hojas falsas comparten pestañas)")
+    parser.add_argument("--tab-max-rows", type=int, default=200000, help="SHEETS_TAB_MAX_ROWS para app.py (rollover de pestañas)")
+    parser.add_argument("--sink-mode", choices=["rows", "log"], default="rows", help="SHEETS_SINK_MODE de app.py")
+    parser.add_argument("--compaction-interval", type=int, default=2, help="SHEETS_COMPACTION_INTERVAL_SECONDS de app.py (modo 'log')")
+    parser.add_argument("--batch-size", type=int, default=0, help="Eventos por solicitud a /webhook/batch (0 = uno por solicitud a /webhook)")
+    parser.add_argument("--payload-kb", type=float, default=0, help="Engorda cada reserva hasta unos N KB con campos típicos de Guesty (0 = solo los que usa app.py)")
+    parser.add_argument("--json-only", action="store_true", help="Solo mide parseo y serialización JSON (librería estándar frente a orjson), sin arrancar app.py")
+    parser.add_argument("--app-port", type=int, default=5055, help="Puerto en el que se arranca app.py")
+    parser.add_argument("--startup-timeout", type=float, default=30, help="Segundos máximos de arranque de app.py")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="Segundos máximos de espera al drenado del outbox")
+    parser.add_argument("--output", default=None, help="Guarda el resultado en JSON (para usarlo como línea base)")
+    parser.add_argument("--baseline", default=None, help="Resultado JSON anterior con el que comparar")
+    args = parser.parse_args()
+
+    if args.json_only:
+        run_json_benchmark(args)
+        sys.exit(0)
+    result = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+        print(f"ℹ️ Resultado guardado en {args.output}")
@@ -0,0 +1,24 @@
+import argparse
+import time
+
+# Importar app inicializa el servicio de Google Sheets y la conexión a la DB con las mismas
+# variables de entorno que usa el servidor (GOOGLE_CREDENTIALS, DATABASE_URL, SPREADSHEET_ID, RANGE_NAME).
+from app import Session, compact_log_tabs, create_db_tables, parse_target_key
+
+# Reescribe las pestañas de estado actual a partir de sus registros '<pestaña>_log' (SHEETS_SINK_MODE=log).
+# Sin --target compacta todos los destinos con eventos nuevos desde la última compactación: para
+# programarlo con cron en lugar de dentro del servidor, arranca este con SHEETS_COMPACTION_INTERVAL_SECONDS=0.
+# Uso: python compactar_log.py [--target spreadsheet_id/pestaña ...] [--force]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compacta los registros de eventos en sus pestañas de estado actual.")
+    parser.add_argument("--target", action="append", default=[], help="Hoja y pestaña de estado actual como 'spreadsheet_id/pestaña' (repetible)")
+    parser.add_argument("--force", action="store_true", help="Compacta aunque no haya eventos nuevos desde la última vez")
+    args = parser.parse_args()
+
+    create_db_tables()
+    started = time.monotonic()
+    targets = [parse_target_key(key) for key in args.target]
+    compacted = compact_log_tabs(targets or None, force=args.force or bool(targets))
+    Session.remove()
+    print(f"✅ {compacted} pestañas compactadas en {time.monotonic() - started:.1f}s.")
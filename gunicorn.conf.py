@@ -0,0 +1,11 @@
+# gunicorn carga este archivo solo si se arranca desde este directorio (gunicorn app:app).
+# Cada worker, en cuanto ha cargado la aplicación y antes de su primera solicitud, crea/migra las tablas,
+# asegura el encabezado y arranca el drenador del outbox: lo pendiente de antes de un reinicio se entrega
+# sin esperar a que llegue un webhook nuevo.
+
+def post_worker_init(worker):
+    # Con -k uvicorn.workers.UvicornWorker (app_async:asgi_app) lo hace el lifespan de Starlette
+    if "uvicorn" in worker.cfg.worker_class_str.lower():
+        return
+    from app import start_process_services
+    start_process_services()
@@ -0,0 +1,127 @@
+import argparse
+import time
+
+# Importar app inicializa el servicio de Google Sheets y la conexión a la DB con las mismas
+# variables de entorno que usa el servidor (GOOGLE_CREDENTIALS, DATABASE_URL, SPREADSHEET_ID, RANGE_NAME).
+from app import (
+    DEFAULT_SHEET_TARGET, ReservationIndex, Session, a1_range, column_letter, create_db_tables,
+    execute_sheets, field_names, parse_target_key, sheets_service, target_key, upsert_reservation_index,
+)
+
+# Reconstruye la tabla 'reservation_index' de un destino (hoja/pestaña) a partir de la hoja en una sola pasada.
+# Solo lee la columna de reservation_id (D), en páginas grandes, y hace upsert en bloques.
+# Uso: python reconstruir_indice.py [--target spreadsheet_id/pestaña] [--page-size 20000] [--chunk-size 5000] [--dry-run] [--prune]
+# Con enrutado (SHEETS_ROUTES_FILE) se ejecuta una vez por cada pestaña.
+
+RESERVATION_ID_COLUMN = column_letter(field_names.index("reservation_id") + 1) # 'D'
+
+# Número total de filas de la pestaña, para saber cuándo dejar de paginar
+def get_sheet_row_count(sheet_instance, target):
+    result = execute_sheets(sheet_instance.get(
+        spreadsheetId=target.spreadsheet_id,
+        fields="sheets.properties(title,gridProperties.rowCount)"
+    ), "sheets_rebuild_index", kind="read")
+    for sheet in result.get("sheets", []):
+        properties = sheet.get("properties", {})
+        if properties.get("title") == target.tab:
+            return properties.get("gridProperties", {}).get("rowCount", 0)
+    raise RuntimeError(f"No se encontró la pestaña '{target.tab}' en la hoja {target.spreadsheet_id}.")
+
+# Generador de (número de fila, reservation_id) leyendo solo la columna D por páginas.
+# Con majorDimension=COLUMNS la respuesta es una sola lista por página, sin filas anidadas.
+def iter_sheet_reservation_ids(sheet_instance, target, page_size):
+    row_count = get_sheet_row_count(sheet_instance, target)
+    start_row = 2 # La fila 1 es el encabezado
+    while start_row <= row_count:
+        end_row = min(start_row + page_size - 1, row_count)
+        result = execute_sheets(sheet_instance.values().get(
+            spreadsheetId=target.spreadsheet_id,
+            range=a1_range(target.tab, f"{RESERVATION_ID_COLUMN}{start_row}:{RESERVATION_ID_COLUMN}{end_row}"),
+            majorDimension="COLUMNS"
+        ), "sheets_rebuild_index", kind="read")
+        columns = result.get("values", [])
+        for offset, value in enumerate(columns[0] if columns else []):
+            value = str(value).strip()
+            if value:
+                yield start_row + offset, value
+        start_row = end_row + 1
+
+# Agrupa un iterable en listas de como máximo 'size' elementos
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def rebuild_index(target, page_size, chunk_size, dry_run=False, prune=False):
+    if sheets_service is None:
+        raise RuntimeError("Servicio de Google Sheets no disponible.")
+
+    started = time.monotonic()
+    sheet_instance = sheets_service.spreadsheets()
+    seen = set()
+    duplicates = []
+    rows_in_sheet = 0
+
+    # Se descartan las apariciones repetidas de un mismo ID: se queda la primera, igual que la búsqueda lineal original
+    def unique_rows():
+        nonlocal rows_in_sheet
+        for row_number, reservation_id in iter_sheet_reservation_ids(sheet_instance, target, page_size):
+            rows_in_sheet += 1
+            if reservation_id in seen:
+                duplicates.append((reservation_id, row_number))
+                continue
+            seen.add(reservation_id)
+            # La huella se borra: no se sabe qué hay ahora en la fila y el siguiente evento la reescribe entera
+            yield {
+                "target": target_key(target), "reservation_id": reservation_id, "sheet_row_number": row_number,
+                "row_hash": None, "row_data": None,
+            }
+
+    upserted = 0
+    for chunk in chunked(unique_rows(), chunk_size):
+        if not dry_run:
+            upsert_reservation_index(chunk)
+        upserted += len(chunk)
+        print(f"... {upserted} reservas procesadas ({time.monotonic() - started:.1f}s)")
+
+    # Huérfanos: reservas del índice de este destino que ya no aparecen en la pestaña
+    orphans = [
+        reservation_id
+        for (reservation_id,) in Session().query(ReservationIndex.reservation_id)
+        .filter(ReservationIndex.target == target_key(target)).yield_per(10000)
+        if reservation_id not in seen
+    ]
+    if prune and orphans and not dry_run:
+        for chunk in chunked(orphans, chunk_size):
+            Session().query(ReservationIndex).filter(
+                ReservationIndex.target == target_key(target), ReservationIndex.reservation_id.in_(chunk)
+            ).delete(synchronize_session=False)
+        Session().commit()
+
+    print(f"✅ Índice de '{target_key(target)}' reconstruido en {time.monotonic() - started:.1f}s{' (dry-run, sin cambios en la DB)' if dry_run else ''}.")
+    print(f"   Filas con reservation_id en la hoja: {rows_in_sheet}")
+    print(f"   Reservas indexadas (upsert): {upserted}")
+    print(f"   Duplicados en la hoja: {len(duplicates)}")
+    for reservation_id, row_number in duplicates[:50]:
+        print(f"     - {reservation_id} repetido en la fila {row_number}")
+    print(f"   Huérfanos en el índice (no están en la hoja): {len(orphans)}{' - eliminados' if prune and not dry_run else ''}")
+    for reservation_id in orphans[:50]:
+        print(f"     - {reservation_id}")
+    print("ℹ️ Los workers en ejecución vuelven a leer cada reserva de la DB cuando caduca su entrada en caché (RESERVATION_CACHE_TTL_SECONDS); reinícialos para aplicarlo ya.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruye reservation_index a partir de la hoja de Google Sheets.")
+    parser.add_argument("--target", default=target_key(DEFAULT_SHEET_TARGET), help="Hoja y pestaña como 'spreadsheet_id/pestaña' (por defecto SPREADSHEET_ID/RANGE_NAME)")
+    parser.add_argument("--page-size", type=int, default=20000, help="Filas leídas por llamada a values().get")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Filas por cada INSERT ... ON CONFLICT")
+    parser.add_argument("--dry-run", action="store_true", help="Solo informa, no escribe en la DB")
+    parser.add_argument("--prune", action="store_true", help="Elimina del índice las reservas que ya no están en la hoja")
+    args = parser.parse_args()
+
+    create_db_tables()
+    rebuild_index(parse_target_key(args.target), args.page_size, args.chunk_size, dry_run=args.dry_run, prune=args.prune)
@@ -0,0 +1,74 @@
+import argparse
+import sys
+import time
+
+# Importar app inicializa el servicio de Google Sheets y la conexión a la DB con las mismas
+# variables de entorno que usa el servidor (GOOGLE_CREDENTIALS, DATABASE_URL, SPREADSHEET_ID, RANGE_NAME).
+from app import (
+    Session, WebhookOutbox, create_db_tables, ensure_header_row_exists_global, ingest_batch, iter_ndjson, outbox_drainer,
+)
+
+# Pasa el histórico de reservas de Guesty por el mismo camino que /webhook/batch, leyendo archivos NDJSON
+# (un webhook completo o una reserva de la API de Guesty por línea) como un stream, por bloques.
+# Sin --no-drain entrega el outbox desde este mismo proceso hasta vaciarlo; los leases por shard permiten
+# que el servidor drene a la vez. Con --no-drain solo encola y lo entrega el servidor en marcha.
+# Uso: python reproducir_historial.py reservas.ndjson [más.ndjson ...] [--chunk-size 1000] [--no-drain]
+#      (con '-' se lee de la entrada estándar)
+
+# Bloques de como máximo 'size' objetos de un iterable
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def pending_outbox_rows():
+    try:
+        return Session().query(WebhookOutbox).filter(WebhookOutbox.status == "pending").count()
+    finally:
+        Session.remove()
+
+def replay_file(path, chunk_size, totals, started):
+    stream = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        for chunk in chunked(iter_ndjson(stream), chunk_size):
+            summary = ingest_batch(chunk)
+            Session.remove()
+            for result, count in summary.items():
+                totals[result] += count
+            print(f"... {totals['received']} eventos leídos, {totals['queued']} encolados ({time.monotonic() - started:.1f}s)")
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+def wait_for_outbox(started):
+    pending = pending_outbox_rows()
+    while pending:
+        print(f"... {pending} eventos pendientes en el outbox ({time.monotonic() - started:.1f}s)")
+        time.sleep(5)
+        pending = pending_outbox_rows()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encola (y entrega) el histórico de reservas de Guesty desde archivos NDJSON.")
+    parser.add_argument("files", nargs="+", help="Archivos NDJSON ('-' para la entrada estándar)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Eventos por transacción al encolar")
+    parser.add_argument("--no-drain", dest="drain", action="store_false", help="Solo encola: lo entrega el servidor en marcha")
+    args = parser.parse_args()
+
+    create_db_tables()
+    started = time.monotonic()
+    totals = {"received": 0, "queued": 0, "duplicate": 0, "ignored": 0, "rejected": 0}
+    if args.drain:
+        ensure_header_row_exists_global()
+        outbox_drainer.start() # Entrega mientras se sigue leyendo
+    for path in args.files:
+        replay_file(path, args.chunk_size, totals, started)
+    print(f"✅ {totals['received']} eventos leídos: {totals['queued']} encolados, {totals['duplicate']} duplicados, "
+          f"{totals['ignored']} ignorados y {totals['rejected']} rechazados ({time.monotonic() - started:.1f}s).")
+    if args.drain:
+        wait_for_outbox(started)
+        print(f"✅ Outbox vacío: histórico entregado a Google Sheets en {time.monotonic() - started:.1f}s.")
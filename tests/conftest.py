@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py lee su configuración al importarse: DB SQLite temporal, sin Google Sheets y sin ficheros
+# compartidos con un servidor local que esté corriendo.
+TEST_DIR = tempfile.mkdtemp(prefix="guesty_sheets_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"
+os.environ["SHEETS_RATE_LIMIT_STATE_FILE"] = os.path.join(TEST_DIR, "sheets_rate_limit.json")
+os.environ["LOG_LEVEL"] = "CRITICAL"
+for name in ("GOOGLE_CREDENTIALS", "SHEETS_ROUTES_FILE", "SHEETS_EXTRA_FIELDS_FILE"):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as sheets_app # noqa: E402
+
+sheets_app.create_db_tables()
+
+@pytest.fixture
+def app():
+    return sheets_app
+
+# Tablas del outbox, del índice y de eventos procesados (y sus cachés en memoria) vacías en cada prueba
+# que usa la DB; el drenador no se arranca al encolar
+@pytest.fixture
+def db(app, monkeypatch):
+    monkeypatch.setattr(app, "recent_event_ids", app.RecentEventIds(app.DEDUP_MEMORY_SIZE, app.DEDUP_MEMORY_TTL_SECONDS))
+    monkeypatch.setattr(app.outbox_drainer, "start", lambda: None)
+    with app.get_engine().begin() as connection:
+        for model in (app.WebhookOutbox, app.ReservationIndex, app.ProcessedEvent, app.ReservationMirror):
+            connection.execute(app.delete(model))
+        connection.execute(app.update(app.OutboxShardLease).values(owner=None, locked_until=None))
+    app.reservation_row_cache.clear()
+    yield app
+    app.Session.remove()
+
+# Cliente HTTP de Flask sin los servicios del proceso (calentamiento con Sheets y drenador del outbox)
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setattr(db, "start_process_services", lambda: None)
+    return db.app.test_client()
+
+# Webhook de Guesty mínimo con los campos que usa el mapeo de la hoja
+def make_event(reservation_id, topic="reservation.new", updated_at=None, **reservation):
+    data = {
+        "event": topic,
+        "meta": {"eventId": f"{reservation_id}-{topic}-{updated_at}", "messageId": "m-1"},
+        "reservation": {"_id": reservation_id, "listingId": "L1", "checkIn": "2026-03-01", "status": "confirmed", **reservation},
+    }
+    if updated_at:
+        data["reservation"]["lastUpdatedAt"] = updated_at
+    return data
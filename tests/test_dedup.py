@@ -0,0 +1,84 @@
+from datetime import datetime
+
+from conftest import make_event
+
+def outbox_records(app):
+    return app.Session().scalars(app.select(app.WebhookOutbox)).all()
+
+def test_duplicate_event_is_not_enqueued_twice(db):
+    data = make_event("r1")
+    event_key = db.webhook_event_key(data)
+    assert db.enqueue_webhook(data, event_key)
+    assert not db.enqueue_webhook(data, event_key)
+    assert len(outbox_records(db)) == 1
+
+# Un registro 'dead' libera su ID de evento: el reintento de Guesty se vuelve a encolar
+def test_dead_record_releases_its_event_id(db):
+    data = make_event("r1")
+    event_key = db.webhook_event_key(data)
+    assert db.enqueue_webhook(data, event_key)
+    session = db.Session()
+    record = outbox_records(db)[0]
+    record.attempts = db.OUTBOX_MAX_ATTEMPTS - 1
+    db.fail_outbox_records(session, [record], RuntimeError("Sheets caído"))
+    session.commit()
+
+    assert record.status == "dead"
+    assert db.enqueue_webhook(data, event_key)
+    assert sorted(record.status for record in outbox_records(db)) == ["dead", "pending"]
+
+def test_retried_record_keeps_its_event_id(db):
+    data = make_event("r1")
+    event_key = db.webhook_event_key(data)
+    assert db.enqueue_webhook(data, event_key)
+    session = db.Session()
+    db.fail_outbox_records(session, outbox_records(db), RuntimeError("Sheets caído"))
+    session.commit()
+    assert not db.enqueue_webhook(data, event_key)
+
+# --- /webhook ---
+
+def test_webhook_answers_duplicate_without_enqueueing(db, client):
+    data = make_event("r1")
+    assert client.post("/webhook", json=data).status_code == 202
+    response = client.post("/webhook", json=data)
+    assert response.status_code == 200
+    assert "ya procesado" in response.get_json()["message"]
+    assert len(outbox_records(db)) == 1
+
+# Otro worker ya lo encoló: este proceso no lo tiene en memoria, pero sí está en processed_event
+def test_webhook_dedups_events_seen_by_another_worker(db, client):
+    data = make_event("r1")
+    with db.get_engine().begin() as connection:
+        connection.execute(db.insert(db.ProcessedEvent), [db.processed_event_values(db.webhook_event_key(data), data)])
+    assert client.post("/webhook", json=data).status_code == 200
+    assert outbox_records(db) == []
+
+def test_webhook_accepts_retry_of_dead_event(db, client):
+    data = make_event("r1")
+    assert client.post("/webhook", json=data).status_code == 202
+    session = db.Session()
+    record = outbox_records(db)[0]
+    record.attempts = db.OUTBOX_MAX_ATTEMPTS - 1
+    db.fail_outbox_records(session, [record], RuntimeError("Sheets caído"))
+    session.commit()
+    assert client.post("/webhook", json=data).status_code == 202
+
+# Escritura directa: una versión más antigua que la ya escrita se responde 200 sin llamar a Sheets
+def test_webhook_skips_stale_event_in_direct_mode(db, client, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_BEHIND_ENABLED", False)
+    monkeypatch.setattr(db, "sheets_service", NoSheets())
+    db.upsert_reservation_index([{
+        "target": db.target_key(db.DEFAULT_SHEET_TARGET), "reservation_id": "r1", "sheet_row_number": 2,
+        "last_event_at": datetime(2026, 1, 2), "row_hash": None, "row_data": None, "sheet_id": None,
+    }])
+    response = client.post("/webhook", json=make_event("r1", topic="reservation.updated", updated_at="2026-01-01T00:00:00Z"))
+    assert response.status_code == 200
+    assert "atrasado" in response.get_json()["message"]
+
+class NoSheets:
+    def spreadsheets(self):
+        return self
+
+    def __getattr__(self, name):
+        raise AssertionError(f"Llamada inesperada a Google Sheets: {name}")
@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import make_event
+
+# Construcción de la fila tal y como la hacía update_google_sheets antes del mapeo declarativo
+def baseline_row(data):
+    reservation_data = data.get("reservation", {})
+    meta = data.get("meta", {})
+    guest_data = reservation_data.get("guest", {})
+    money_data = reservation_data.get("money", {})
+    listing_data = reservation_data.get("listing", {})
+    return [
+        data.get("event", ""), meta.get("eventId", ""), meta.get("messageId", ""), reservation_data.get("_id"),
+        reservation_data.get("accountId", ""), reservation_data.get("guestId", ""), reservation_data.get("listingId", ""),
+        reservation_data.get("conversationId", ""), reservation_data.get("checkIn", ""), reservation_data.get("checkOut", ""),
+        reservation_data.get("guestsCount", 0), reservation_data.get("integration", {}).get("platform", ""),
+        reservation_data.get("status", ""), guest_data.get("firstName", ""),
+        guest_data.get("lastName") or (guest_data.get("fullName", "").split()[-1] if guest_data.get("fullName") else ""),
+        money_data.get("subTotalPrice", 0), money_data.get("fareCleaning", 0), money_data.get("hostServiceFee", 0), 0,
+        listing_data.get("nickname", "") or listing_data.get("name", ""), listing_data.get("address", {}).get("city", ""),
+        guest_data.get("emails", [""])[0] if guest_data.get("emails") else "",
+        guest_data.get("phones", [""])[0] if guest_data.get("phones") else "",
+        reservation_data.get("nightsCount", 0),
+    ]
+
+FULL_RESERVATION = {
+    "accountId": "A1", "guestId": "G1", "conversationId": "C1", "checkOut": "2026-03-05", "guestsCount": 3,
+    "integration": {"platform": "airbnb2"}, "nightsCount": 4,
+    "guest": {"firstName": "Lucía", "lastName": "García", "emails": ["lucia@example.com"], "phones": ["+34600000000"]},
+    "money": {"subTotalPrice": 480.5, "fareCleaning": 40, "hostServiceFee": 12.3},
+    "listing": {"nickname": "Ático centro", "name": "Ático", "address": {"city": "Madrid"}},
+}
+
+@pytest.mark.parametrize("reservation", [
+    FULL_RESERVATION,
+    {},
+    {"guest": {"fullName": "Hugo de la Fuente", "emails": [], "phones": []}},
+    {"guest": {"firstName": "Emma"}, "listing": {"name": "Estudio", "address": {}}},
+    {"integration": {}, "money": {"subTotalPrice": 0}},
+], ids=["full", "empty", "full_name", "listing_name", "partial_money"])
+def test_compiled_extractor_matches_baseline_row(app, reservation):
+    data = make_event("r1", **reservation)
+    assert app.build_row_data(data) == baseline_row(data)
+
+def test_compiled_extractor_tolerates_unexpected_types(app):
+    data = make_event("r1", guest="Lucía García", money=None)
+    row = app.build_row_data(data)
+    assert row[app.field_names.index("guestFirstName")] == ""
+    assert row[app.field_names.index("totalAmount")] == 0
+    assert row[app.field_names.index("reservation_id")] == "r1"
+
+def test_compile_row_extractor_rejects_repeated_columns(app):
+    with pytest.raises(ValueError):
+        app.compile_row_extractor([app.SheetField("a", ["event"], ""), app.SheetField("a", ["meta.eventId"], "")])
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+def index_row(app, reservation_id, row_number, row_data=None):
+    return {
+        "target": app.target_key(app.DEFAULT_SHEET_TARGET), "reservation_id": reservation_id, "sheet_row_number": row_number,
+        "last_event_at": datetime(2026, 1, 1), **app.row_fingerprint_columns(row_data or ["a", "b"]), "sheet_id": None,
+    }
+
+def delete_index(app):
+    with app.get_engine().begin() as connection:
+        connection.execute(app.delete(app.ReservationIndex))
+
+# Lo escrito en el índice se sirve desde la caché (con la huella) sin volver a la DB
+def test_written_entries_are_served_from_cache(db):
+    row = index_row(db, "r1", 5)
+    db.upsert_reservation_index([row])
+    delete_index(db)
+
+    entry = db.find_reservations_in_db(["r1", "r2"])["r1"]
+    assert entry.row_hash == row["row_hash"]
+    assert entry.last_event_at == datetime(2026, 1, 1)
+    assert db.find_reservation_in_db("r1") == entry
+
+def test_cache_misses_are_read_from_db_once(db):
+    db.upsert_reservation_index([index_row(db, "r1", 5)])
+    db.reservation_row_cache.clear()
+    assert db.find_reservations_in_db(["r1"])["r1"].sheet_row_number == 5
+    delete_index(db)
+    assert db.find_reservations_in_db(["r1"])["r1"].sheet_row_number == 5 # Ya en caché
+
+def test_location_only_rows_keep_cached_fingerprint(db):
+    row = index_row(db, "r1", 5)
+    db.upsert_reservation_index([row])
+    db.upsert_reservation_index([{"target": row["target"], "reservation_id": "r1", "sheet_row_number": 9, "sheet_id": 0}])
+    entry = db.reservation_row_cache.get("r1")
+    assert (entry.sheet_row_number, entry.sheet_id, entry.row_hash) == (9, 0, row["row_hash"])
+
+def test_expired_entries_are_reread(app, monkeypatch):
+    cache = app.ReservationRowCache(10, ttl_seconds=60)
+    entry = app.IndexEntry(5, None, None, None, app.target_key(app.DEFAULT_SHEET_TARGET), None)
+    cache.put("r1", entry)
+    assert cache.get("r1") == entry
+    now = app.time.monotonic()
+    monkeypatch.setattr(app.time, "monotonic", lambda: now + 61)
+    assert cache.get("r1") is None
+    assert cache.peek("r1") == entry # Su destino sigue sirviendo para elegir pestaña
@@ -0,0 +1,11 @@
+from conftest import make_event
+
+def test_metrics_endpoint_exposes_webhook_counters_and_histograms(client):
+    client.post("/webhook", json=make_event("r1"))
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    assert 'webhook_events_total{event="reservation.new",result="queued"}' in body
+    assert "# TYPE webhook_request_duration_seconds histogram" in body
+    assert 'webhook_stage_duration_seconds_bucket{stage="db_commit",le="+Inf"}' in body
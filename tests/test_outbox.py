@@ -0,0 +1,27 @@
+from conftest import make_event
+
+def test_mark_outbox_failure_schedules_retry_then_dead(db):
+    record = db.new_outbox_record(make_event("r1"))
+    before = db.utcnow()
+    db.mark_outbox_failure([record], RuntimeError("Sheets caído"))
+    assert record.status == "pending"
+    assert record.attempts == 1
+    assert record.next_attempt_at > before
+    assert record.last_error == "Sheets caído"
+
+    record.attempts = db.OUTBOX_MAX_ATTEMPTS - 1
+    db.mark_outbox_failure([record], RuntimeError("Sheets caído"))
+    assert record.status == "dead"
+
+# Los registros reclamados se usan tras el commit del reclamo sin releerlos de la DB uno a uno
+def test_claimed_records_stay_loaded_after_commit(db):
+    session = db.Session()
+    session.add_all([db.new_outbox_record(make_event("r1")), db.new_outbox_record(make_event("r2"))])
+    session.commit()
+
+    drainer = db.OutboxDrainer(1000, 10, 1)
+    with db.OutboxSession() as outbox_session:
+        records = drainer._claim_batch(outbox_session, list(range(db.OUTBOX_SHARDS)))
+        assert sorted(record.reservation_id for record in records) == ["r1", "r2"]
+        assert all(not db.inspect(record).expired_attributes for record in records)
+        assert all(record.locked_until > db.utcnow() for record in records)
@@ -0,0 +1,38 @@
+import os
+
+def make_limiter(app, tmp_path, rate=60):
+    return app.SheetsRateLimiter(os.path.join(tmp_path, "limiter.json"), {"read": rate, "write": rate}, 6, 1, 10)
+
+def count_state_cycles(limiter, monkeypatch):
+    cycles = []
+    locked_state = limiter._locked_state
+    def counting():
+        cycles.append(1)
+        return locked_state()
+    monkeypatch.setattr(limiter, "_locked_state", counting)
+    return cycles
+
+# Cada llamada a Sheets toma el fichero de estado una sola vez: el éxito se aplica en el siguiente reserve
+def test_success_is_folded_into_next_reserve(app, tmp_path, monkeypatch):
+    limiter = make_limiter(app, str(tmp_path))
+    limiter.on_throttled("write", 0) # Ritmo a la mitad: 30/min
+    cycles = count_state_cycles(limiter, monkeypatch)
+
+    limiter.on_success("write")
+    limiter.on_success("write")
+    assert cycles == []
+    limiter.reserve("write")
+    assert len(cycles) == 1
+    assert limiter.stats()["write"]["rate"] == 32
+
+def test_success_never_exceeds_configured_rate(app, tmp_path):
+    limiter = make_limiter(app, str(tmp_path))
+    limiter.on_success("read")
+    limiter.reserve("read")
+    assert limiter.stats()["read"]["rate"] == 60
+
+def test_throttle_halves_rate_and_pauses(app, tmp_path):
+    limiter = make_limiter(app, str(tmp_path))
+    limiter.on_throttled("write", 30)
+    assert limiter.stats()["write"]["rate"] == 30
+    assert limiter.reserve("write") > 29
@@ -0,0 +1,46 @@
+import pytest
+
+from conftest import make_event
+
+TOKEN = "test-token"
+
+@pytest.fixture
+def mirror(db, monkeypatch):
+    monkeypatch.setattr(db, "RESERVATIONS_API_TOKEN", TOKEN)
+    rows = [
+        db.reservation_mirror_row(f"r{day}", db.build_row_data(make_event(
+            f"r{day}", checkIn=f"2026-03-0{day}", guest={"firstName": "Lucía", "emails": ["lucia@example.com"]},
+        )), None, db.DEFAULT_SHEET_TARGET)
+        for day in (3, 1, 2)
+    ]
+    db.mirror_reservations(rows)
+    return db
+
+def get(client, token=TOKEN, **params):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    return client.get("/reservations", query_string=params, headers=headers)
+
+def test_reservations_requires_bearer_token(mirror, client):
+    assert get(client, token=None).status_code == 401
+    response = get(client, token="otro")
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+
+def test_reservations_without_configured_token_is_closed(mirror, client, monkeypatch):
+    monkeypatch.setattr(mirror, "RESERVATIONS_API_TOKEN", "")
+    assert get(client, token="").status_code == 401
+
+def test_reservations_paginates_by_check_in(mirror, client):
+    first = get(client, limit=2).get_json()
+    assert [reservation["reservation_id"] for reservation in first["reservations"]] == ["r1", "r2"]
+    second = get(client, limit=2, cursor=first["next_cursor"]).get_json()
+    assert [reservation["reservation_id"] for reservation in second["reservations"]] == ["r3"]
+    assert second["next_cursor"] is None
+
+def test_reservations_omits_guest_pii_by_default(mirror, client):
+    reservation = get(client).get_json()["reservations"][0]
+    assert not mirror.RESERVATIONS_PII_COLUMNS & reservation.keys()
+    with_pii = get(client, includePii="true").get_json()["reservations"][0]
+    assert with_pii["guestFirstName"] == "Lucía"
+    assert with_pii["guest_email"] == "lucia@example.com"
+    assert get(client, includePii="quizá").status_code == 400
@@ -0,0 +1,80 @@
+from conftest import make_event
+
+SHEET_ID = 0
+
+def index_row(app, reservation_id, row_number, sheet_id=SHEET_ID):
+    return {"target": app.target_key(app.DEFAULT_SHEET_TARGET), "reservation_id": reservation_id, "sheet_row_number": row_number, "sheet_id": sheet_id}
+
+def lookup_range(app, reservation_id):
+    return {"dataFilter": {"developerMetadataLookup": app.row_anchor_lookup(SHEET_ID, reservation_id)}, "values": [[]]}
+
+def lookup_response(app, reservation_id, row_number):
+    return {"dataFilter": {"developerMetadataLookup": app.row_anchor_lookup(SHEET_ID, reservation_id)}, "updatedRange": f"test!A{row_number}:X{row_number}"}
+
+def test_reconcile_anchored_rows_relocates_and_reports_missing(app):
+    moved, missing, by_number = index_row(app, "r1", 5), index_row(app, "r2", 6), index_row(app, "r3", 7, sheet_id=None)
+    ranges = [lookup_range(app, "r1"), lookup_range(app, "r2"), {"dataFilter": {"a1Range": "test!A7:X7"}, "values": [[]]}]
+    response = {"responses": [lookup_response(app, "r1", 9), {"dataFilter": {"a1Range": "test!A7:X7"}, "updatedRange": "test!A7:X7"}]}
+
+    kept, not_found = app.reconcile_anchored_rows([moved, missing, by_number], ranges, response)
+    assert kept == [moved, by_number]
+    assert moved["sheet_row_number"] == 9
+    assert not_found == [missing]
+
+# Una fila anclada escrita por tramos va por rango A1 y no se da por perdida aunque no busque su ancla
+def test_reconcile_anchored_rows_ignores_rows_written_by_a1_range(app):
+    partial = index_row(app, "r1", 5)
+    ranges = [{"dataFilter": {"a1Range": "test!K5:K5"}, "values": [[4]]}]
+    kept, not_found = app.reconcile_anchored_rows([partial], ranges, {"responses": []})
+    assert (kept, not_found) == ([partial], [])
+
+def test_confirm_deleted_rows_reads_the_sheet_first(app, monkeypatch):
+    monkeypatch.setattr(app, "read_reservation_id_column", lambda target: {2: "r9", 3: "r1", 4: "r1"})
+    lost_anchor, deleted = index_row(app, "r1", 8), index_row(app, "r2", 9)
+    found, gone = app.confirm_deleted_rows([lost_anchor, deleted])
+    assert found == [lost_anchor]
+    assert lost_anchor["sheet_row_number"] == 3 # Repetida: la primera, como reconstruir_indice.py
+    assert lost_anchor["sheet_id"] is None
+    assert gone == [deleted]
+
+def test_apply_row_anchor_matches(app):
+    entries = {
+        "r1": app.IndexEntry(5, None, None, None, app.target_key(app.DEFAULT_SHEET_TARGET), SHEET_ID),
+        "r2": app.IndexEntry(6, None, None, None, app.target_key(app.DEFAULT_SHEET_TARGET), SHEET_ID),
+    }
+    located, missing = app.apply_row_anchor_matches(entries, {(SHEET_ID, "r1"): 12})
+    assert located["r1"].sheet_row_number == 12
+    assert [row["reservation_id"] for row in missing] == ["r2"]
+
+def test_row_write_data_uses_anchor_only_for_full_rewrites(app):
+    row = app.build_row_data(make_event("r1", guestsCount=2))
+    fingerprint = app.row_fingerprint_columns(row)
+    anchored = app.IndexEntry(5, None, fingerprint["row_hash"], fingerprint["row_data"], app.target_key(app.DEFAULT_SHEET_TARGET), SHEET_ID)
+    changed = app.build_row_data(make_event("r1", topic="reservation.updated", guestsCount=3))
+
+    ranges, mode = app.row_write_data("r1", anchored, changed)
+    assert mode == "partial"
+    assert all("a1Range" in value_range["dataFilter"] for value_range in ranges)
+
+    ranges, mode = app.row_write_data("r1", anchored._replace(row_hash=None), changed)
+    assert mode == "full"
+    assert ranges[0]["dataFilter"] == {"developerMetadataLookup": app.row_anchor_lookup(SHEET_ID, "r1")}
+
+def test_row_anchor_capacity_respects_budget_and_pause(app, monkeypatch):
+    per_anchor = len(app.SHEETS_ROW_ANCHOR_KEY) + 2
+    monkeypatch.setattr(app, "row_anchor_chars_used", lambda spreadsheet_id: app.SHEETS_ROW_ANCHOR_MAX_CHARS - 2 * per_anchor)
+    assert app.row_anchor_capacity(app.DEFAULT_SHEET_TARGET, ["r1", "r2", "r3"]) == 2
+
+    monkeypatch.setitem(app.row_anchor_pauses, app.DEFAULT_SHEET_TARGET.spreadsheet_id, app.time.monotonic() + 60)
+    assert app.row_anchor_capacity(app.DEFAULT_SHEET_TARGET, ["r1"]) == 0
+
+def test_row_anchor_chars_used_counts_anchored_rows_of_the_spreadsheet(db):
+    other = db.SheetTarget(db.DEFAULT_SHEET_TARGET.spreadsheet_id + "x", "test")
+    rows = [
+        {**index_row(db, "r1", 2), "last_event_at": None, "row_hash": None, "row_data": None},
+        {**index_row(db, "r22", 3), "last_event_at": None, "row_hash": None, "row_data": None},
+        {**index_row(db, "r3", 4, sheet_id=None), "last_event_at": None, "row_hash": None, "row_data": None},
+        {**index_row(db, "r4", 2), "target": db.target_key(other), "last_event_at": None, "row_hash": None, "row_data": None},
+    ]
+    db.upsert_reservation_index(rows)
+    assert db.row_anchor_chars_used(db.DEFAULT_SHEET_TARGET.spreadsheet_id) == 2 * len(db.SHEETS_ROW_ANCHOR_KEY) + len("r1") + len("r22")
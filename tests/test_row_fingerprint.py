@@ -0,0 +1,46 @@
+from conftest import make_event
+from test_field_mapping import FULL_RESERVATION
+
+# row_update_ranges: escritura omitida, por tramos o completa según la huella guardada
+
+def index_entry(app, row_data, row_number=7):
+    fingerprint = app.row_fingerprint_columns(row_data)
+    return app.IndexEntry(row_number, None, fingerprint["row_hash"], fingerprint["row_data"], app.target_key(app.DEFAULT_SHEET_TARGET), None)
+
+def test_row_update_ranges_full_without_fingerprint(app):
+    row = app.build_row_data(make_event("r1", **FULL_RESERVATION))
+    entry = index_entry(app, row)._replace(row_hash=None, row_data=None)
+    ranges, mode = app.row_update_ranges(entry, row)
+    assert mode == "full"
+    assert ranges == [{"range": f"test!A7:{app.LAST_COLUMN}7", "values": [row]}]
+
+def test_row_update_ranges_skips_unchanged_row(app):
+    row = app.build_row_data(make_event("r1", **FULL_RESERVATION))
+    # Solo cambian las columnas volátiles (event, eventId, messageId): no cuenta como cambio
+    newer = app.build_row_data(make_event("r1", topic="reservation.updated", **FULL_RESERVATION))
+    assert app.row_update_ranges(index_entry(app, row), newer) == ([], "skipped")
+
+def test_row_update_ranges_writes_changed_runs_only(app):
+    row = app.build_row_data(make_event("r1", **FULL_RESERVATION))
+    changed = app.build_row_data(make_event("r1", topic="reservation.updated", **{**FULL_RESERVATION, "guestsCount": 4}))
+    ranges, mode = app.row_update_ranges(index_entry(app, row), changed)
+    guests = app.field_names.index("numberOfGuests")
+    assert mode == "partial"
+    assert ranges == [
+        {"range": "test!A7:C7", "values": [changed[0:3]]},
+        {"range": f"test!{app.column_letter(guests + 1)}7:{app.column_letter(guests + 1)}7", "values": [[4]]},
+    ]
+
+def test_row_update_ranges_full_when_too_many_runs(app):
+    row = app.build_row_data(make_event("r1", **FULL_RESERVATION))
+    changed = list(row)
+    for column in ("accountId", "checkIn", "platform", "listing_city"): # Cuatro tramos separados + los volátiles
+        changed[app.field_names.index(column)] = "cambiado"
+    ranges, mode = app.row_update_ranges(index_entry(app, row), changed)
+    assert mode == "full"
+    assert ranges[0]["values"] == [changed]
+
+def test_row_update_ranges_full_when_column_count_changed(app):
+    row = app.build_row_data(make_event("r1", **FULL_RESERVATION))
+    entry = index_entry(app, row[:-1])
+    assert app.row_update_ranges(entry, row)[1] == "full"
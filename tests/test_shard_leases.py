@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+from conftest import make_event
+
+def acquire(app, shards, owner, now):
+    with app.db_connection() as connection:
+        return sorted(connection.execute(app.acquire_shard_leases_stmt(shards, owner, now)).scalars())
+
+def release(app, shards, owner):
+    with app.db_connection() as connection:
+        connection.execute(app.release_shard_leases_stmt(shards, owner))
+
+def test_shard_lease_is_exclusive_until_released(db):
+    now = db.utcnow()
+    assert acquire(db, [0, 1], "worker-a", now) == [0, 1]
+    assert acquire(db, [1, 2], "worker-b", now) == [2]
+    assert acquire(db, [0, 1], "worker-a", now) == [0, 1] # El dueño renueva su propio lease
+    release(db, [0, 1], "worker-b") # Solo libera el dueño
+    assert acquire(db, [0], "worker-b", now) == []
+    release(db, [0, 1], "worker-a")
+    assert acquire(db, [0], "worker-b", now) == [0]
+
+def test_expired_shard_lease_can_be_taken_over(db):
+    now = db.utcnow()
+    assert acquire(db, [3], "worker-a", now) == [3]
+    later = now + timedelta(seconds=db.OUTBOX_LEASE_SECONDS + 1)
+    assert acquire(db, [3], "worker-b", later) == [3]
+
+# Orden por reserva: mientras un evento espera su reintento, los siguientes de esa reserva no se entregan
+def test_backing_off_reservation_blocks_its_later_events(db):
+    session = db.Session()
+    now = db.utcnow()
+    waiting = db.new_outbox_record(make_event("r1"))
+    waiting.next_attempt_at = now + timedelta(minutes=5) # Reintento programado
+    later = db.new_outbox_record(make_event("r1", topic="reservation.updated"))
+    other = db.new_outbox_record(make_event("r2"))
+    session.add_all([waiting, later, other])
+    session.commit()
+
+    claimable = session.execute(db.claimable_outbox_select(db.utcnow(), 10)).scalars().all()
+    assert [record.reservation_id for record in claimable] == ["r2"]
+
+def test_renew_outbox_leases_extends_owned_shards_and_records(db):
+    session = db.Session()
+    record = db.new_outbox_record(make_event("r1"))
+    session.add(record)
+    session.commit()
+    now = db.utcnow()
+    shard = db.outbox_shard("r1")
+    assert acquire(db, [shard], "worker-a", now) == [shard]
+
+    later = now + timedelta(seconds=db.OUTBOX_LEASE_SECONDS - 1)
+    shard_stmt, records_stmt = db.renew_outbox_leases_stmts([shard], "worker-a", [record.id], later)
+    with db.db_connection() as connection:
+        assert connection.execute(shard_stmt).scalars().all() == [shard]
+        connection.execute(records_stmt)
+    session.refresh(record)
+    assert record.locked_until == later + timedelta(seconds=db.OUTBOX_LEASE_SECONDS)
+    # Renovado: otro worker no lo toma aunque haya pasado el lease original
+    assert acquire(db, [shard], "worker-b", now + timedelta(seconds=db.OUTBOX_LEASE_SECONDS + 1)) == []
+
+def test_renew_outbox_leases_skips_shards_taken_by_another_worker(db):
+    now = db.utcnow()
+    assert acquire(db, [4], "worker-b", now) == [4]
+    shard_stmt, _ = db.renew_outbox_leases_stmts([4], "worker-a", [], now)
+    with db.db_connection() as connection:
+        assert connection.execute(shard_stmt).scalars().all() == []
+
+# La entrega de un bloque más larga que el lease sigue siendo del mismo worker
+def test_drainer_renews_leases_while_delivering(db, monkeypatch):
+    monkeypatch.setattr(db, "OUTBOX_LEASE_RENEW_SECONDS", 0.05)
+    renewals = []
+    monkeypatch.setattr(db, "renew_outbox_leases", lambda shards, owner, record_ids: renewals.append((shards, owner, record_ids)))
+    def slow_flush(events):
+        db.time.sleep(0.3)
+        return None
+    monkeypatch.setattr(db, "flush_target_batch", slow_flush)
+    session = db.Session()
+    session.add(db.new_outbox_record(make_event("r1")))
+    session.commit()
+
+    assert db.OutboxDrainer(1000, 10, 1)._drain_once("worker-a") == 1
+    assert renewals and all(owner == "worker-a" for _, owner, _ in renewals)
+    assert db.Session().scalars(db.select(db.WebhookOutbox)).all() == []
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+from conftest import make_event
+
+def test_is_stale_event(app):
+    older, newer = datetime(2026, 1, 1), datetime(2026, 1, 2)
+    assert app.is_stale_event(older, newer)
+    assert not app.is_stale_event(newer, older)
+    assert not app.is_stale_event(newer, newer) # La misma versión se vuelve a escribir
+    assert not app.is_stale_event(None, newer) # Sin marca de tiempo manda el orden de llegada
+    assert not app.is_stale_event(older, None)
+
+def test_event_timestamp_normalizes_to_naive_utc(app):
+    assert app.event_timestamp(make_event("r1", updated_at="2026-01-01T10:00:00+02:00")) == datetime(2026, 1, 1, 8, 0)
+    assert app.event_timestamp(make_event("r1")) is None
+    assert app.event_timestamp(make_event("r1", updated_at="no es una fecha")) is None
+
+def test_coalesce_events_keeps_newest_version(app):
+    pending = app.coalesce_events([
+        make_event("r1", updated_at="2026-01-02T00:00:00Z", guestsCount=2),
+        make_event("r1", topic="reservation.updated", updated_at="2026-01-01T00:00:00Z", guestsCount=1), # Llega tarde
+        make_event("r2", topic="reservation.updated", guestsCount=5),
+    ])
+    guests = app.field_names.index("numberOfGuests")
+    assert pending["r1"]["row_data"][guests] == 2
+    assert pending["r1"]["last_event_at"] == datetime(2026, 1, 2)
+    assert pending["r1"]["is_new"]
+    assert not pending["r2"]["is_new"]
+
+def known_entry(app, last_event_at):
+    return app.IndexEntry(5, last_event_at, None, None, app.target_key(app.DEFAULT_SHEET_TARGET), None)
+
+def test_plan_sheets_batch_drops_stale_events(app):
+    pending = app.coalesce_events([make_event("r1", topic="reservation.updated", updated_at="2026-01-01T00:00:00Z")])
+    updates, appends, index_rows = app.plan_sheets_batch(pending, {"r1": known_entry(app, datetime(2026, 1, 2))})
+    assert (updates, appends, index_rows) == ({}, {}, [])
+
+def test_plan_sheets_batch_writes_newer_events(app):
+    pending = app.coalesce_events([make_event("r1", topic="reservation.updated", updated_at="2026-01-03T00:00:00Z")])
+    updates, appends, index_rows = app.plan_sheets_batch(pending, {"r1": known_entry(app, datetime(2026, 1, 2))})
+    batch = updates[app.DEFAULT_SHEET_TARGET.spreadsheet_id]
+    assert [row["reservation_id"] for row in batch["index_rows"]] == ["r1"]
+    assert batch["index_rows"][0]["last_event_at"] == datetime(2026, 1, 3)
+    assert appends == {} and index_rows == []
+
+def test_plan_sheets_batch_ignores_updates_of_unknown_reservations(app):
+    pending = app.coalesce_events([make_event("r1", topic="reservation.updated"), make_event("r2")])
+    updates, appends, index_rows = app.plan_sheets_batch(pending, {})
+    assert updates == {}
+    assert [reservation_id for route_appends in appends.values() for reservation_id, _ in route_appends] == ["r2"]
@@ -0,0 +1,23 @@
+import json
+
+from conftest import make_event
+
+def test_webhook_batch_accepts_ndjson(db, client):
+    events = [make_event("r1"), make_event("r2"), {"_id": "r3", "listingId": "L1"}, {"event": "reservation.removed", "reservation": {"_id": "r4"}}]
+    body = "\n".join(json.dumps(event) for event in events + [events[0]])
+    response = client.post("/webhook/batch", data=body, content_type="application/x-ndjson")
+    assert response.status_code == 202
+    summary = response.get_json()
+    assert (summary["received"], summary["queued"], summary["duplicate"], summary["ignored"]) == (5, 3, 1, 1)
+    assert len(db.Session().scalars(db.select(db.WebhookOutbox)).all()) == 3
+
+def test_webhook_batch_rejects_oversized_body(db, client, monkeypatch):
+    monkeypatch.setattr(db, "WEBHOOK_BATCH_MAX_BYTES", 100)
+    response = client.post("/webhook/batch", data=json.dumps([make_event("r1")]), content_type="application/json")
+    assert response.status_code == 413
+    assert db.Session().scalars(db.select(db.WebhookOutbox)).all() == []
+
+def test_webhook_batch_rejects_too_many_events(db, client, monkeypatch):
+    monkeypatch.setattr(db, "WEBHOOK_BATCH_MAX_EVENTS", 1)
+    response = client.post("/webhook/batch", json=[make_event("r1"), make_event("r2")])
+    assert response.status_code == 413
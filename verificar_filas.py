@@ -0,0 +1,28 @@
+import argparse
+import time
+
+# Importar app inicializa el servicio de Google Sheets y la conexión a la DB con las mismas
+# variables de entorno que usa el servidor (GOOGLE_CREDENTIALS, DATABASE_URL, SPREADSHEET_ID, RANGE_NAME).
+from app import SHEETS_ROW_VERIFY_SAMPLE, Session, create_db_tables, parse_target_key, verify_index_tabs
+
+# Comprueba que las filas del índice siguen donde están en la hoja (alguien pudo ordenar o borrar filas)
+# y, si no, relocaliza la pestaña por sus anclas de fila y la columna de reservation_id. De paso ancla las
+# filas verificadas que aún no tenían ancla, mientras quede SHEETS_ROW_ANCHOR_MAX_CHARS. Sin --target verifica todas las pestañas con reservas en el
+# índice: para programarlo con cron en lugar de dentro del servidor, arranca este con
+# SHEETS_ROW_VERIFY_INTERVAL_SECONDS=0. Con --sample 0 comprueba todas las filas (una lectura por pestaña).
+# Uso: python verificar_filas.py [--target spreadsheet_id/pestaña ...] [--sample N]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica y corrige los números de fila del índice de reservas.")
+    parser.add_argument("--target", action="append", default=[], help="Hoja y pestaña como 'spreadsheet_id/pestaña' (repetible)")
+    parser.add_argument("--sample", type=int, default=SHEETS_ROW_VERIFY_SAMPLE, help="Filas al azar a comprobar por pestaña (0 = todas)")
+    args = parser.parse_args()
+
+    create_db_tables()
+    started = time.monotonic()
+    summaries = verify_index_tabs([parse_target_key(key) for key in args.target] or None, sample_size=args.sample)
+    Session.remove()
+    for summary in summaries:
+        print(f"   {summary['target']}: {summary['sampled']} comprobadas, {summary['mismatched']} fuera de sitio, "
+              f"{summary['relocated']} relocalizadas, {summary['anchored']} ancladas, {summary['deleted']} borradas de la hoja")
+    print(f"✅ {len(summaries)} pestañas verificadas en {time.monotonic() - started:.1f}s.")